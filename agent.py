@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+import json
+import time
+
+import alerts
+import instrument
+import mqtt
+
+DEFAULT_TOPIC = 'housemon/agents'
+
+#########################################################
+# The remote end
+#########################################################
+
+class Agent(object):
+    '''
+    Probes the part of a network map that belongs to this agent, and reports the
+    results to the display over mqtt.
+
+    Results are batched. Every interval, one message carries everything that changed
+    since the last one. Every few messages a full frame goes out, so a display that
+    just started catches up. Even an empty frame tells the display we're alive.
+    '''
+    def __init__(self, networkMap, name, params):
+        '''
+        Init
+            :networkMap: the whole map, from the same config the display uses.
+            :name: which agent we are. Endpoints with a matching 'agent' get probed.
+            :params: the map's 'agents' config: host, port, topic, interval, probe_interval and full_every.
+        '''
+        self.map = networkMap
+        self.name = name
+        self.host = params['host']
+        self.port = params.get('port', 1883)
+        self.topic = '%s/%s' % (params.get('topic', DEFAULT_TOPIC), name)
+        self.interval = float(params.get('interval', 5.0))
+        self.probe_interval = float(params.get('probe_interval', 15.0))
+        self.full_every = int(params.get('full_every', 12))
+
+        self.endpoints = [e for e in networkMap.index.values() if e.agent == name and (e.host or e.ip or e.ip6)]
+        if not self.endpoints:
+            print("Agent %s has nothing to probe." % name)
+
+        # what the display was last told about each endpoint
+        self.sent = {}
+        self.frames = 0
+
+        self.client = mqtt.NewClient()
+
+    @instrument.timed('Agent.probe')
+    def probe(self):
+        self.map.getData(self.name)
+
+    @instrument.timed('Agent.publish')
+    def publish(self):
+        ''' Send one frame of results. '''
+        results = [endpoint.getResult() for endpoint in self.endpoints]
+        full = self.frames % self.full_every == 0
+        if not full:
+            results = [result for result in results if self.sent.get(result[0]) != result]
+        for result in results:
+            self.sent[result[0]] = result
+
+        frame = {'a': self.name, 't': round(time.time(), 3), 'f': int(full), 'r': [list(result) for result in results]}
+        self.client.publish(self.topic, json.dumps(frame, separators=(',', ':')))
+        self.frames += 1
+
+    def start(self, scheduler):
+        ''' Called to add the initial processes to the scheduler.'''
+        self.client.connect_async(self.host, port=self.port)
+        self.client.loop_start()
+        scheduler.every(self.probe_interval, self.probe, priority=1, probe=True)
+        scheduler.every(self.interval, self.publish)
+
+#########################################################
+# The display end
+#########################################################
+
+class AgentListener(object):
+    '''
+    Merges the results from the remote agents into the local network map.
+
+    Results go through the endpoints' normal stats_cb, so they look just like a
+    local probe. If an agent goes quiet for longer than the timeout, its endpoints
+    are marked down.
+    '''
+    def __init__(self, networkMap, params):
+        self.map = networkMap
+        self.host = params['host']
+        self.port = params.get('port', 1883)
+        self.topic = params.get('topic', DEFAULT_TOPIC)
+        self.timeout = float(params.get('timeout', 60.0))
+
+        self.expected = set([e.agent for e in networkMap.index.values() if e.agent])
+        self.started = time.time()
+        self.seen = {}
+        # replaced, never changed, so getError can read it without the lock.
+        self.quiet = frozenset()
+        # only the mqtt thread and check take this, never the display.
+        self.write_lock = instrument.TimedLock('AgentListener.write_lock')
+
+        self.client = mqtt.NewClient()
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+
+    def on_connect(self, client, userdata, flags, rc):
+        client.subscribe(self.topic + '/+')
+
+    @instrument.timed('AgentListener.on_message')
+    def on_message(self, client, userdata, msg):
+        try:
+            frame = json.loads(msg.payload)
+            name = frame['a']
+            results = frame['r']
+        except (ValueError, KeyError, TypeError):
+            return
+
+        self.write_lock.acquire(True)
+        self.seen[name] = time.time()
+        back = name in self.quiet
+        if back:
+            self.quiet = self.quiet - set([name])
+        self.write_lock.release()
+        if back:
+            alerts.notify('agent/%s' % name, {'quiet': False, 'name': name})
+
+        for result in results:
+            # (key, ip, ping), and (ip6, ping6) after it for endpoints with a v6 address.
+            key = result[0]
+            endpoint = self.map.index.get(key)
+            if endpoint is None or endpoint.agent != name:
+                continue
+            for ip, ping in zip(result[1::2], result[2::2]):
+                if ip or len(result) == 3:
+                    endpoint.stats_cb(None, ip, ping is not None, ping)
+
+    def check(self):
+        ''' Mark the endpoints of agents that went quiet as down. '''
+        now = time.time()
+        newly_quiet = []
+        self.write_lock.acquire(True)
+        for name in self.expected:
+            if name not in self.quiet and now - self.seen.get(name, self.started) > self.timeout:
+                newly_quiet.append(name)
+        self.quiet = self.quiet | set(newly_quiet)
+        self.write_lock.release()
+        for name in newly_quiet:
+            alerts.notify('agent/%s' % name, {'quiet': True, 'name': name})
+
+        for endpoint in self.map.index.values():
+            if endpoint.agent in newly_quiet and (endpoint.host or endpoint.ip or endpoint.ip6):
+                if endpoint.ip6:
+                    endpoint.stats_cb(None, endpoint.ip6, False, None)
+                if endpoint.ip or not endpoint.ip6:
+                    endpoint.stats_cb(None, endpoint.ip, False, None)
+
+    def getError(self):
+        quiet = sorted(self.quiet)
+        if quiet:
+            return "Agent %s has gone quiet." % quiet[0]
+        return None
+
+    def start(self, scheduler):
+        ''' Called to add the initial processes to the scheduler.'''
+        self.client.connect_async(self.host, port=self.port)
+        self.client.loop_start()
+        scheduler.every(self.timeout / 4, self.check)
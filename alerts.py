@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+
+import collections
+import heapq
+
+import instrument
+import recorder
+
+#########################################################
+# Rules
+#########################################################
+
+# most urgent first
+SEVERITIES = ['critical', 'warning', 'info']
+
+# An active problem. These are replaced, never changed.
+Alert = collections.namedtuple('Alert', ['severity', 'key', 'rule', 'message', 'since'])
+
+class Rule(object):
+    '''
+    Something to look for in an entity's fields.
+
+    check(key, fields, now) returns (message, recheck). message is None when
+    everything is fine. recheck is when to look again if nothing changes, for
+    rules that go off with time, or None.
+
+    The condition has to hold for hold seconds before the alert shows, and be
+    gone for clear seconds before it goes away.
+    '''
+    def __init__(self, name, prefix, check, severity='warning', hold=0.0, clear=5.0, exact=False):
+        self.name = name
+        self.prefix = prefix
+        self.check = check
+        self.severity = severity
+        self.hold = float(hold)
+        self.clear = float(clear)
+        self.exact = exact
+
+    def root(self):
+        return self.prefix.split('/', 1)[0]
+
+    def matches(self, key):
+        if self.exact:
+            return key == self.prefix
+        return key == self.prefix or key.startswith(self.prefix + '/')
+
+def entityName(key, fields):
+    return fields.get('name') or key.rsplit('/', 1)[-1]
+
+def endpointDown(key, fields, now):
+    if fields.get('ok') is False and not fields.get('optional'):
+        return ("%s is down." % entityName(key, fields), None)
+    return (None, None)
+
+def endpointLoss(threshold):
+    def check(key, fields, now):
+        loss = fields.get('loss')
+        if fields.get('ok') and loss is not None and loss >= threshold:
+            return ("%s is dropping %0.0f%% of its pings." % (entityName(key, fields), loss * 100.0), None)
+        return (None, None)
+    return check
+
+def portErrors(key, fields, now):
+    errors = fields.get('port_errors')
+    if errors is not None and errors > fields.get('limit', 0.0):
+        return ("%s has %0.1f errors a second." % (entityName(key, fields), errors), None)
+    return (None, None)
+
+def internetDown(key, fields, now):
+    if 'internet' in fields and fields['internet'] is None:
+        return ("The Intenet is missing. Check for zombies. Better yet, stay inside.", None)
+    return (None, None)
+
+def dnsDown(key, fields, now):
+    if 'dns' in fields and fields['dns'] is None:
+        return ("There is a problem with name lookups on the Internet. Stupid IT guy.", None)
+    return (None, None)
+
+def mqttStale(key, fields, now):
+    if 'last_time' not in fields:
+        return (None, None)
+    deadline = fields['last_time'] + fields['timeout']
+    if now >= deadline:
+        return ("%s is not OK (nothing for %0.0fs)." % (entityName(key, fields), now - fields['last_time']), None)
+    return (None, deadline)
+
+def mqttDisconnected(key, fields, now):
+    if fields.get('connected') is False:
+        return ("The mqtt broker %s isn't connected." % key.split('/', 1)[1], None)
+    return (None, None)
+
+def printerDown(key, fields, now):
+    if fields.get('ok') is False:
+        return ("Octoprint server %s is not responding" % key.split('/', 1)[1], None)
+    return (None, None)
+
+def tooHot(limit):
+    def check(key, fields, now):
+        temperature = fields.get('temperature')
+        if temperature is not None and temperature > limit:
+            return ("%s is running hot (%0.0fC). Maybe it needs a fan." % (key.split('/', 1)[1], temperature), None)
+        return (None, None)
+    return check
+
+def samplerError(key, fields, now):
+    error = fields.get('error')
+    if error:
+        return ("Can't read how %s is doing (%s)." % (key.split('/', 1)[1], error), None)
+    return (None, None)
+
+def agentQuiet(key, fields, now):
+    if fields.get('quiet'):
+        return ("Agent %s has gone quiet." % entityName(key, fields), None)
+    return (None, None)
+
+def widgetError(key, fields, now):
+    return (fields.get('error'), None)
+
+def threshold(params):
+    ''' A rule from the config, for a field going above or below a number. '''
+    field = params.get('field', 'value')
+    above = params.get('above')
+    below = params.get('below')
+    def check(key, fields, now):
+        try:
+            value = float(fields.get(field))
+        except (TypeError, ValueError):
+            return (None, None)
+        if above is not None and value > float(above):
+            return (params.get('message', "%s is %s, over %s." % (entityName(key, fields), value, above)), None)
+        if below is not None and value < float(below):
+            return (params.get('message', "%s is %s, under %s." % (entityName(key, fields), value, below)), None)
+        return (None, None)
+    return check
+
+def defaultRules(params):
+    '''
+    The built in rules, tuned by the alerts part of settings:
+        :down_for: seconds an endpoint has to be down before it's a problem.
+        :loss: fraction of lost pings that's a problem.
+        :max_temperature: for this machine.
+        :thresholds: a list of {key, field, above or below, severity, for, message}.
+    '''
+    down_for = params.get('down_for', 30.0)
+    rules = [
+        Rule('down', 'network', endpointDown, 'critical', hold=down_for),
+        Rule('loss', 'network', endpointLoss(float(params.get('loss', 0.25))), 'warning', hold=down_for),
+        Rule('internet', 'network', internetDown, 'critical', hold=down_for, exact=True),
+        Rule('dns', 'network', dnsDown, 'critical', hold=down_for, exact=True),
+        Rule('port errors', 'network', portErrors, 'warning', hold=down_for),
+        Rule('stale', 'mqtt', mqttStale, 'warning'),
+        Rule('disconnected', 'mqtt', mqttDisconnected, 'warning', hold=10.0),
+        Rule('printer', 'octoprint', printerDown, 'warning', hold=10.0),
+        Rule('hot', 'system', tooHot(float(params.get('max_temperature', 80.0))), 'warning', hold=30.0),
+        Rule('sampler', 'system', samplerError, 'warning'),
+        Rule('agent', 'agent', agentQuiet, 'critical'),
+        Rule('widget', 'widget', widgetError, 'warning'),
+    ]
+    for i, t in enumerate(params.get('thresholds', [])):
+        rules.append(Rule('threshold %d' % i, t['key'], threshold(t), t.get('severity', 'warning'), hold=t.get('for', 0.0)))
+    return rules
+
+#########################################################
+# Engine
+#########################################################
+
+class Condition(object):
+    ''' How one rule is going for one entity. '''
+    def __init__(self):
+        self.since = None
+        self.cleared = None
+        self.message = None
+        self.transitions = collections.deque()
+
+class Engine(object):
+    '''
+    Keeps the set of active alerts up to date, without looking at everything.
+
+    The collectors call notify with the fields of an entity when it changes, from
+    whatever thread they're on. evaluate, from the scheduler, runs only the rules
+    for the entities that changed, or that asked to be looked at again by now.
+
+    An alert that comes and goes flap_count times in flap_window seconds is
+    flapping. It stays up, marked as such, until it settles down.
+    '''
+    def __init__(self, rules, flap_window=300.0, flap_count=4, show=3):
+        self.rules = {}
+        for rule in rules:
+            self.rules.setdefault(rule.root(), []).append(rule)
+        self.flap_window = flap_window
+        self.flap_count = flap_count
+        self.show = show
+
+        # (key, fields) from the collectors. Appending to a deque needs no lock.
+        self.incoming = collections.deque()
+        # last known fields, by key
+        self.entities = {}
+        # (rule name, key): Condition
+        self.conditions = {}
+        # (time, key) to look at again
+        self.deadlines = []
+        # the earliest time in deadlines for each key
+        self.scheduled = {}
+        # (rule name, key): Alert. Replaced, never changed, so it can be read without a lock.
+        self.active = {}
+        # widgets that don't notify, so their getError is polled.
+        self.polled = []
+
+    def notify(self, key, fields):
+        ''' fields of None means the entity is gone, and so are its alerts. '''
+        self.incoming.append((key, fields))
+
+    def watch(self, widget, key):
+        self.polled.append((widget, key))
+
+    def poll(self):
+        for widget, key in self.polled:
+            self.notify(key, {'error': widget.getError()})
+
+    @instrument.timed('alerts.evaluate')
+    def evaluate(self):
+        ''' Returns True if the active alerts changed. '''
+        now = recorder.now()
+        dirty = set()
+        gone = set()
+        while self.incoming:
+            key, fields = self.incoming.popleft()
+            if fields is None:
+                self.entities.pop(key, None)
+                gone.add(key)
+                continue
+            entity = dict(self.entities.get(key, {}))
+            entity.update(fields)
+            self.entities[key] = entity
+            dirty.add(key)
+            gone.discard(key)
+        while self.deadlines and self.deadlines[0][0] <= now:
+            when, key = heapq.heappop(self.deadlines)
+            if self.scheduled.get(key) == when:
+                del self.scheduled[key]
+            dirty.add(key)
+
+        active = dict(self.active)
+        for id in list(self.conditions.keys()):
+            if id[1] in gone:
+                del self.conditions[id]
+                active.pop(id, None)
+        for key in dirty:
+            fields = self.entities.get(key)
+            if fields is None:
+                continue
+            for rule in self.rules.get(key.split('/', 1)[0], []):
+                if rule.matches(key):
+                    self.apply(rule, key, fields, now, active)
+
+        if active != self.active:
+            self.active = active
+            return True
+        return False
+
+    def later(self, when, key):
+        '''
+        Look at key again at when. Every rule for a key is run again when it's
+        looked at, and asks again for what it still needs, so only the earliest
+        time for each key is kept. Otherwise a busy topic leaves a deadline per
+        message in the heap until its timeout is up.
+        '''
+        if key in self.scheduled and self.scheduled[key] <= when:
+            return
+        self.scheduled[key] = when
+        heapq.heappush(self.deadlines, (when, key))
+
+    def apply(self, rule, key, fields, now, active):
+        message, recheck = rule.check(key, fields, now)
+        if recheck is not None:
+            self.later(recheck, key)
+
+        id = (rule.name, key)
+        condition = self.conditions.get(id)
+        if condition is None:
+            if message is None:
+                return
+            condition = self.conditions[id] = Condition()
+
+        # how often it has come and gone lately
+        if (message is None) != (condition.since is None):
+            condition.transitions.append(now)
+        while condition.transitions and condition.transitions[0] < now - self.flap_window:
+            condition.transitions.popleft()
+        flapping = len(condition.transitions) >= self.flap_count
+
+        if message is not None:
+            condition.cleared = None
+            if condition.since is None:
+                condition.since = now
+            condition.message = message
+            if now - condition.since >= rule.hold or id in active:
+                if flapping:
+                    message += ' (flapping)'
+                active[id] = Alert(rule.severity, key, rule.name, message, condition.since)
+            else:
+                self.later(condition.since + rule.hold, key)
+            return
+
+        condition.since = None
+        if id not in active:
+            if not condition.transitions:
+                del self.conditions[id]
+            return
+        if condition.cleared is None:
+            condition.cleared = now
+        if flapping:
+            # keep it up until it settles
+            active[id] = active[id]._replace(message=condition.message + ' (flapping)')
+            self.later(condition.transitions[0] + self.flap_window, key)
+        elif now - condition.cleared >= rule.clear:
+            del active[id]
+            if not condition.transitions:
+                del self.conditions[id]
+        else:
+            self.later(condition.cleared + rule.clear, key)
+
+    def ranked(self):
+        ''' The active alerts, most urgent, then oldest, first. '''
+        return sorted(self.active.values(), key=lambda a: (SEVERITIES.index(a.severity), a.since, a.key))
+
+    def getError(self):
+        ''' A summary of the active alerts, for the footer. '''
+        alerts = self.ranked()
+        if not alerts:
+            return None
+        counts = collections.Counter([a.severity for a in alerts])
+        lines = [', '.join(['%d %s' % (counts[s], s) for s in SEVERITIES if counts[s]])]
+        for alert in alerts[:self.show]:
+            lines.append('  %s' % alert.message)
+        if len(alerts) > self.show:
+            lines.append('  ...and %d more.' % (len(alerts) - self.show))
+        return '\n'.join(lines)
+
+    def start(self, scheduler):
+        ''' Called to add the initial processes to the scheduler.'''
+        scheduler.every(0.5, self.evaluate, priority=2)
+        if self.polled:
+            scheduler.every(5.0, self.poll)
+
+# The Engine, if there is one. The collectors check this, so it costs nothing when it's off.
+engine = None
+
+def notify(key, fields):
+    ''' Called by the collectors when an entity changes. '''
+    if engine is not None:
+        engine.notify(key, fields)
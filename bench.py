@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import random
+import threading
+import time
+import urwid
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+import instrument
+import mqtt
+import pinger
+import printer
+
+#########################################################
+# Fake backends
+#########################################################
+
+class FakeNetwork(object):
+    '''
+    Stands in for ping and DNS. Every host resolves, to a v6 address too with
+    ipv6, and every ping answers after latency seconds, with a made up time so
+    the display has something to redraw.
+    '''
+    def __init__(self, latency=0.0, ipv6=False):
+        self.latency = latency
+        self.ipv6 = ipv6
+        self.pings = 0
+        self.lookups = 0
+
+    def PingAll(self, ips):
+        # all at once, like the real one.
+        if self.latency:
+            time.sleep(self.latency)
+        self.pings += len(ips)
+        return [(True, '%0.3f' % random.uniform(0.2, 40.0)) for ip in ips]
+
+    def Resolve(self, name):
+        self.lookups += 1
+        if self.latency:
+            time.sleep(self.latency)
+        h = hash(name)
+        v4 = '10.%d.%d.%d' % (h % 250, (h >> 8) % 250, (h >> 16) % 250 + 1)
+        v6 = None
+        if self.ipv6:
+            v6 = 'fd00::%x:%x' % ((h >> 8) % 0xffff, h % 0xffff + 1)
+        return (v4, v6)
+
+    def install(self):
+        pinger.PingAll = self.PingAll
+        pinger.Resolve = self.Resolve
+
+class FakeOctoprint(object):
+    ''' Answers /api/printer like octoprint does, with the temperatures drifting a bit every time. '''
+    def __init__(self, address='127.0.0.1'):
+        self.requests = 0
+        octoprint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                octoprint.requests += 1
+                body = json.dumps(octoprint.printer()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server((address, 0), Handler)
+        self.host = '%s:%d' % self.server.server_address
+
+    def printer(self):
+        return {
+            'state': {'text': 'Printing'},
+            'temperature': {'bed': {'actual': round(random.uniform(55.0, 65.0), 1), 'target': 60.0},
+                            'tool0': {'actual': round(random.uniform(195.0, 215.0), 1), 'target': 205.0}},
+        }
+
+    def start(self):
+        t = threading.Thread(target=self.server.serve_forever, args=())
+        t.setDaemon(True)
+        t.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+#########################################################
+# Synthetic configs
+#########################################################
+
+def makeConfig(endpoints, topics, printers, printer_host, per_switch=16):
+    ''' A config like config.yaml, with the number of endpoints, topics and printers asked for. '''
+    switches = []
+    for i in range(0, endpoints, per_switch):
+        children = []
+        for j in range(i, min(i + per_switch, endpoints)):
+            # half by name, so the lookups get exercised too.
+            if j % 2:
+                children.append({'host': 'bench-%d.local' % j})
+            else:
+                children.append({'host': 'Bench %d' % j, 'ip': '10.1.%d.%d' % (j // 250, j % 250 + 1)})
+        switches.append({'name': 'Switch %d' % (i // per_switch), 'divider': True, 'children': children})
+
+    config = [{'network map': {
+        'net_host': 'bench.example.com',
+        'net_ip': '10.0.0.254',
+        'routers': [{'name': 'Router', 'ip': '10.0.0.1', 'columns': 2, 'children': switches}],
+    }}]
+
+    if topics:
+        machines = []
+        for i in range(0, topics, 8):
+            messages = []
+            for j in range(i, min(i + 8, topics)):
+                messages.append({'name': 'Topic %d' % j, 'timeout': 60, 'timed': bool(j % 2),
+                                 'topic': '/bench/%d/%d' % (i // 8, j)})
+            machines.append({'name': 'Machine %d' % (i // 8), 'messages': messages})
+        config.append({'mqtt': {'host': 'bench-broker', 'port': 1883, 'columns': 2, 'machines': machines}})
+
+    for i in range(printers):
+        config.append({'octoprint': {'host': printer_host, 'key': 'BENCH%d' % i}})
+
+    return config
+
+#########################################################
+# Measurements
+#########################################################
+
+def rss():
+    ''' Resident memory of this process, in kB. '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+def waitFor(check, timeout):
+    ''' Poll until check() is True. Returns how long it took, or None if it never was. '''
+    start = time.time()
+    while time.time() - start < timeout:
+        if check():
+            return time.time() - start
+        time.sleep(0.001)
+    return None
+
+def run(endpoints, topics, printers, frames=50, latency=0.0, width=200, ipv6=False):
+    ''' Build the widgets for one size, drive them, and return what was measured. '''
+    random.seed(1)
+    instrument.reset()
+    result = {'endpoints': endpoints, 'topics': topics, 'printers': printers}
+
+    network = FakeNetwork(latency, ipv6)
+    network.install()
+    broker = mqtt.LocalBroker()
+    mqtt.NewClient = broker.client
+    octoprint = FakeOctoprint()
+    octoprint.start()
+
+    rss_before = rss()
+    threads_before = threading.active_count()
+
+    config = makeConfig(endpoints, topics, printers, octoprint.host)
+    netmap = pinger.NetworkMap(config[0]['network map'])
+    widgets = [netmap]
+    mqtt_widgets = [mqtt.MqttWidget(c['mqtt']) for c in config if 'mqtt' in c]
+    printer_widgets = [printer.PrinterWidget(c['octoprint']) for c in config if 'octoprint' in c]
+    widgets += mqtt_widgets + printer_widgets
+    top = urwid.Pile([urwid.LineBox(w) for w in widgets])
+
+    for wid in mqtt_widgets:
+        for mqtt_broker in wid.brokers:
+            mqtt_broker.start()
+    topic_names = ['/bench/%d/%d' % (j // 8, j) for j in range(topics)]
+
+    # one round of probes, and how long until every answer is in.
+    peak_threads = [threading.active_count()]
+    probed = [e for e in netmap.index.values() if e.host or e.ip]
+    start = time.time()
+    netmap.getData()
+    for wid in printer_widgets:
+        wid.getData()
+    def settled():
+        peak_threads[0] = max(peak_threads[0], threading.active_count())
+        return all([e.ping is not None for e in probed]) and \
+            all([w.stats['state']['text'] != 'Unknown' for w in printer_widgets])
+    if waitFor(settled, 30.0 + latency * len(probed)) is None:
+        result['probe_settle_ms'] = None
+    else:
+        result['probe_settle_ms'] = (time.time() - start) * 1000.0
+    result['probes_per_sec'] = len(probed) / max(time.time() - start, 1e-9)
+    result['peak_threads'] = peak_threads[0]
+
+    # mqtt ingest, one publish per topic per round, through the real on_message.
+    published = 0
+    start = time.time()
+    for i in range(max(1, 20000 // max(topics, 1))):
+        for topic in topic_names:
+            broker.publish(topic, str(i))
+            published += 1
+    elapsed = time.time() - start
+    result['mqtt_msgs_per_sec'] = published / max(elapsed, 1e-9) if topics else None
+
+    # frames: some new data, then the draws and a render of the whole screen.
+    frame_times = []
+    for frame in range(frames):
+        for topic in topic_names[frame % 4::4]:
+            broker.publish(topic, str(frame))
+        for e in probed[frame % 4::4]:
+            e.stats_cb(None, e.ip, True, '%0.3f' % random.uniform(0.2, 40.0))
+        for wid in printer_widgets:
+            wid.stats_cb(octoprint.printer())
+
+        start = time.time()
+        netmap.draw()
+        for wid in mqtt_widgets:
+            wid.update()
+        for wid in printer_widgets:
+            wid.update()
+        top.render((width,))
+        frame_times.append(time.time() - start)
+    result['frame_ms_p50'] = instrument.percentile(frame_times, 0.5) * 1000.0
+    result['frame_ms_p99'] = instrument.percentile(frame_times, 0.99) * 1000.0
+
+    # what the status line costs.
+    rounds = 200
+    start = time.time()
+    for i in range(rounds):
+        for wid in widgets:
+            wid.getError()
+    result['get_error_us'] = (time.time() - start) / rounds * 1000000.0
+
+    # time spent waiting on every TimedLock over the whole run.
+    result['lock_wait_ms'] = sum([stat.total for name, stat in instrument.stats.items()
+                                  if name.startswith('lock ')]) * 1000.0
+
+    result['threads'] = threading.active_count() - threads_before
+    result['rss_kb'] = rss() - rss_before
+
+    for wid in mqtt_widgets:
+        for mqtt_broker in wid.brokers:
+            mqtt_broker.stop()
+    octoprint.stop()
+    return result
+
+#########################################################
+# Main
+#########################################################
+
+COLUMNS = [
+    ('endpoints', '%9d'), ('topics', '%7d'), ('printers', '%8d'),
+    ('probe_settle_ms', '%15.1f'), ('probes_per_sec', '%14.0f'), ('peak_threads', '%12d'),
+    ('mqtt_msgs_per_sec', '%17.0f'), ('frame_ms_p50', '%12.2f'), ('frame_ms_p99', '%12.2f'),
+    ('get_error_us', '%12.1f'), ('lock_wait_ms', '%12.2f'), ('threads', '%7d'), ('rss_kb', '%8d'),
+]
+
+def formatRow(result):
+    cells = []
+    for name, fmt in COLUMNS:
+        value = result.get(name)
+        if value is None:
+            width = int(fmt[1:].split('.')[0].rstrip('df'))
+            cells.append('-'.rjust(width))
+        else:
+            cells.append(fmt % value)
+    return ' '.join(cells)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure how housemon scales, against fake backends")
+    parser.add_argument('sizes', nargs='*', default=['10,20,1', '100,200,5', '1000,2000,20'],
+                        help="endpoints,topics,printers for each run (default: 10,20,1 100,200,5 1000,2000,20)")
+    parser.add_argument('--frames', type=int, default=50, help="frames to draw in each run")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds each fake ping and lookup takes")
+    parser.add_argument('--ipv6', action='store_true', help="give every fake host a v6 address too, so both families are pinged")
+    parser.add_argument('--width', type=int, default=200, help="screen columns to render")
+    parser.add_argument('--json', action='store_true', help="print one json object per run instead of a table")
+    parser.add_argument('--stats', action='store_true', help="print the instrumentation table after each run")
+    args = parser.parse_args()
+
+    if not args.json:
+        print(' '.join([name.rjust(int(fmt[1:].split('.')[0].rstrip('df'))) for name, fmt in COLUMNS]))
+    for size in args.sizes:
+        endpoints, topics, printers = [int(n) for n in size.split(',')]
+        result = run(endpoints, topics, printers, frames=args.frames, latency=args.latency, width=args.width,
+                     ipv6=args.ipv6)
+        if args.json:
+            print(json.dumps(result, sort_keys=True))
+        else:
+            print(formatRow(result))
+        if args.stats:
+            print(instrument.report())
+            print('')
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+import hashlib
+import marshal
+import os
+
+import instrument
+
+#########################################################
+# Checking
+#########################################################
+
+class ConfigError(Exception):
+    pass
+
+# keys each built in widget type can't do without. Other types are left to the widget.
+REQUIRED = {
+    'network map': ['net_ip', 'net_host', 'routers'],
+    'mqtt': ['machines'],
+    'octoprint': ['host', 'key'],
+    'touch': ['buttons'],
+}
+
+def validate(config, path='config'):
+    ''' Raise ConfigError, saying where, if the config isn't shaped the way the widgets expect. '''
+    if not isinstance(config, list):
+        raise ConfigError("%s should be a list of widgets" % path)
+    for i, item in enumerate(config):
+        where = '%s[%d]' % (path, i)
+        if not isinstance(item, dict) or len(item) != 1:
+            raise ConfigError("%s should have exactly one widget type in it" % where)
+        type = list(item.keys())[0]
+        params = item[type]
+        where = '%s (%s)' % (where, type)
+        if type == 'columns':
+            validate(params, where)
+            continue
+        if type == 'settings':
+            if not isinstance(params, dict):
+                raise ConfigError("%s should be a map" % where)
+            continue
+        for key in REQUIRED.get(type, []):
+            if not isinstance(params, dict) or key not in params.keys():
+                raise ConfigError("%s is missing %s" % (where, key))
+        if type == 'mqtt':
+            if 'brokers' in params.keys():
+                brokers = params['brokers']
+                if not isinstance(brokers, list) or not brokers:
+                    raise ConfigError("%s: brokers should be a list of at least one broker" % where)
+                for broker in brokers:
+                    if not isinstance(broker, dict) or 'host' not in broker.keys():
+                        raise ConfigError("%s: every broker needs a host" % where)
+            else:
+                for key in ['host', 'port']:
+                    if key not in params.keys():
+                        raise ConfigError("%s is missing %s" % (where, key))
+                brokers = [params]
+            names = [broker.get('name', broker['host']) for broker in brokers]
+            for name in set(names):
+                if names.count(name) > 1:
+                    raise ConfigError("%s: there's more than one broker called %s. Give them each a name." % (where, name))
+            for machine in params['machines']:
+                if machine.get('broker') is not None and machine['broker'] not in names:
+                    raise ConfigError("%s: %s is on broker %s, which isn't one of %s" %
+                                      (where, machine.get('name'), machine['broker'], ', '.join(names)))
+            for machine in params['machines']:
+                for message in machine.get('messages', []):
+                    for key in ['name', 'topic', 'timeout']:
+                        if key not in message.keys():
+                            raise ConfigError("%s: %s is missing %s in one of its messages" % (where, machine.get('name'), key))
+
+#########################################################
+# Loading, with a compiled cache
+#########################################################
+
+# bump this when the cache layout changes.
+CACHE_VERSION = 1
+
+def cacheFilename(filename):
+    directory, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(directory, '.%s.cache' % name)
+
+def fingerprint(filename):
+    ''' (mtime, size) of the file. Cheap, so it's what the watcher polls. '''
+    st = os.stat(filename)
+    return (st.st_mtime, st.st_size)
+
+def load(filename):
+    '''
+    Load and check a config. The checked config is kept, marshalled, next to the
+    yaml, and used instead of parsing again while the yaml's mtime and hash are
+    the same.
+    '''
+    with instrument.span('config.load'):
+        with open(filename, 'rb') as f:
+            text = f.read()
+        digest = hashlib.sha1(text).hexdigest()
+        mtime = fingerprint(filename)[0]
+
+        cache = cacheFilename(filename)
+        try:
+            with open(cache, 'rb') as f:
+                version, cached_mtime, cached_digest, config = marshal.load(f)
+            if version == CACHE_VERSION and cached_mtime == mtime and cached_digest == digest:
+                return config
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+
+        # yaml is slow to import, and only needed when the cache is out of date.
+        import yaml
+        with instrument.span('config.parse'):
+            config = yaml.safe_load(text)
+        validate(config)
+
+        try:
+            with open(cache + '.tmp', 'wb') as f:
+                marshal.dump((CACHE_VERSION, mtime, digest, config), f)
+            os.rename(cache + '.tmp', cache)
+        except (IOError, OSError, ValueError):
+            # somewhere we can't write, so no cache. Still works, just slower.
+            pass
+        return config
+
+#########################################################
+# Hot reload
+#########################################################
+
+class Watcher(object):
+    '''
+    Watches the config file, and when it changes, hands the new config to apply.
+
+    apply(config) changes the running widgets to match, and returns None, or a
+    message about what it couldn't change without a restart. That message, or
+    why the new config was no good, is reported through getError.
+    '''
+    def __init__(self, filename, apply, interval=2.0):
+        self.filename = filename
+        self.apply = apply
+        self.interval = interval
+        self.seen = fingerprint(filename)
+        self.error = None
+        self.reloads = 0
+
+    def check(self):
+        try:
+            current = fingerprint(self.filename)
+        except OSError:
+            # being replaced by an editor, try again next time.
+            return
+        if current == self.seen:
+            return
+        self.seen = current
+
+        try:
+            config = load(self.filename)
+        except Exception as e:
+            self.error = "%s wasn't reloaded: %s" % (self.filename, e)
+            return
+        with instrument.span('config.apply'):
+            try:
+                self.error = self.apply(config)
+            except Exception as e:
+                self.error = "%s was only partly applied: %s" % (self.filename, e)
+        self.reloads += 1
+
+    def getError(self):
+        return self.error
+
+    def start(self, scheduler):
+        ''' Called to add the initial processes to the scheduler.'''
+        scheduler.every(self.interval, self.check)
@@ -1,30 +1,102 @@
 #!/usr/bin/env python
 
-import pinger, printer, mqtt, touch
+import time
+START = time.time()
+
+import alerts
+import configuration
+import instrument
+import recorder
+import scheduler
+import sysinfo
 import urwid
+import argparse
+import importlib
 import threading
-import yaml
-import time
 import os.path
-import platform, socket
+import sys
+import signal
+
+DEFAULT_METRICS_PORT = 9110
+
+# Widget types that come with housemon: (module, class). A module is only imported
+# when the config uses one of its types, so unused widgets cost nothing at startup.
+WIDGET_TYPES = {
+    'mqtt': ('mqtt', 'MqttWidget'),
+    'network map': ('pinger', 'NetworkMap'),
+    'octoprint': ('printer', 'PrinterWidget'),
+    'touch': ('touch', 'TouchWidget'),
+    'system': ('sysinfo', 'SystemWidget'),
+}
+
+# Other packages can add widget types, with an entry point in this group, named
+# after the type, like: 'weather = housemon_weather:WeatherWidget'
+ENTRY_POINT_GROUP = 'housemon.widgets'
+STATS_FILENAME = 'housemon-stats.txt'
+PROFILE_FILENAME = 'housemon-profile.txt'
+
+def show(page):
+    ''' Flip to a page (the instrumentation or the timeline), or back to the dashboard. '''
+    for other in [overlay, timeline_view]:
+        if other is not None and other is not page:
+            other.visible = False
+    if page is None or page.visible:
+        if page is not None:
+            page.visible = False
+        main_wid.body = body
+    else:
+        page.visible = True
+        main_wid.body = urwid.Filler(page, 'top')
+        page.update()
 
 def event(key):
     if key in ['q', 'Q']:
         raise urwid.ExitMainLoop()
+    if timeline_view is not None and timeline_view.visible and timeline_view.key(key):
+        return
+    if key == 'p':
+        # flip between the dashboard and the instrumentation page.
+        show(overlay)
+    if key == 't':
+        if timeline_view is not None:
+            show(timeline_view)
+        else:
+            set_status(u"There is no timeline. Start with --timeline, or set timeline in settings.")
+    if key == 'd':
+        instrument.dump(STATS_FILENAME)
+        set_status(u"Dumped the stats to %s" % STATS_FILENAME)
+    if key == 'P':
+        if profiler.start():
+            set_status(u"Profiling for %0.0f seconds, into %s" % (profiler.duration, PROFILE_FILENAME))
+
+def on_signal(signum, frame):
+    ''' SIGUSR1 dumps the stats, SIGUSR2 starts the profiler. For when there is no keyboard. '''
+    if signum == signal.SIGUSR1:
+        instrument.dump(STATS_FILENAME)
+    elif signum == signal.SIGUSR2:
+        profiler.start()
+
+def set_text(widget, text):
+    ''' Only touch the widget if the text changed, so it doesn't need redrawing. Returns True if it changed. '''
+    if widget.text == text:
+        return False
+    widget.set_text(text)
+    return True
 
 def set_status(state):
-    status.set_text([u"Status: ", state])
+    return set_text(status, u"Status: " + state)
 
-def update(loop, widgets):
+@instrument.timed('display.update')
+def update(widgets):
     final_error = 'I think things are OK, but I have no brain, so use yours.'
     for wid in widgets:
         error = wid.getError()
         if error:
             final_error = error
             break
-    set_status(final_error)
-    set_title()
-    loop.set_alarm_in(1.0, update, widgets)
+    changed = set_status(final_error)
+    changed = set_title() or changed
+    return changed
 
 def uptime_text():
     uptime_value = time.time() - uptime_text.start
@@ -47,15 +119,22 @@ def uptime_text():
 uptime_text.start = time.time()
 
 def set_title():
-    clock.set_text([u'%s' % time.asctime()])
-    threads.set_text([u"Threads:\n%d" % threading.active_count()])
-    hostname.set_text([u"%s:\n%s" % (platform.node(), socket.gethostbyname(platform.node() + '.local'))])
-    uptime.set_text([u"Uptime:\n%s" % uptime_text()])
+    changed = set_text(clock, u'%s' % time.asctime())
+    changed = set_text(threads, u"Threads:\n%d" % threading.active_count()) or changed
+    # only what the sampler already found. Nothing here waits on the system.
+    system = sysinfo.shared().state
+    changed = set_text(hostname, u"%s:\n%s" % (system.hostname, system.ip)) or changed
+    changed = set_text(uptime, u"Uptime:\n%s" % uptime_text()) or changed
+    return changed
 
 class WidgetColumns(urwid.Columns):
-    def __init__(self, widgets):
+    def __init__(self, widgets, types):
         urwid.Columns.__init__(self, [urwid.LineBox(w) for w in widgets])
         self.widgets = widgets
+        self.types = types
+
+    def reconfigure(self, config):
+        return reconfigureWidgets(self.widgets, self.types, config)
 
     def getPalette(self):
         palette = []
@@ -65,9 +144,9 @@ class WidgetColumns(urwid.Columns):
 
         return palette
 
-    def start(self, loop):
+    def start(self, scheduler):
         for wid in self.widgets:
-            wid.start(loop)
+            wid.start(scheduler)
 
     def getError(self):
         for wid in self.widgets:
@@ -76,77 +155,308 @@ class WidgetColumns(urwid.Columns):
                 return error
         return None
 
+    def getMetrics(self):
+        samples = []
+        for wid in self.widgets:
+            samples += wid.getMetrics()
+        return samples
+
+    def getState(self):
+        state = []
+        for wid in self.widgets:
+            state += wid.getState()
+        return state
+
+    def getReplay(self):
+        replay = []
+        for wid in self.widgets:
+            replay += wid.getReplay()
+        return replay
+
+
+def leafWidgets(widgets):
+    ''' All the widgets, with the columns opened up. '''
+    for wid in widgets:
+        if isinstance(wid, WidgetColumns):
+            for sub in leafWidgets(wid.widgets):
+                yield sub
+        else:
+            yield wid
+
+def processStartTime():
+    ''' When the interpreter started, so the startup time includes python itself. '''
+    try:
+        with open('/proc/self/stat') as f:
+            # the command name can have spaces in it, so count from the end of it.
+            ticks = float(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/stat') as f:
+            for line in f:
+                if line.startswith('btime'):
+                    return float(line.split()[1]) + ticks / os.sysconf('SC_CLK_TCK')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return START
+
+def widgetClass(type):
+    ''' Look up the class for a widget type, importing it the first time. '''
+    if type in widgetClass.loaded:
+        return widgetClass.loaded[type]
+
+    if type in WIDGET_TYPES:
+        module, name = WIDGET_TYPES[type]
+        with instrument.span('import ' + module):
+            cls = getattr(importlib.import_module(module), name)
+    else:
+        cls = None
+        try:
+            import pkg_resources
+        except ImportError:
+            pkg_resources = None
+        if pkg_resources:
+            for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP, type):
+                with instrument.span('import ' + entry_point.module_name):
+                    cls = entry_point.load()
+                break
+        if cls is None:
+            raise TypeError("Invalid top level configuration: there is no %s widget" % type)
+
+    widgetClass.loaded[type] = cls
+    return cls
+
+widgetClass.loaded = {}
 
 def createWidget(type, config):
     ''' Big demultiplexer for the different widgets '''
-    if type == 'mqtt':
-        return mqtt.MqttWidget(config)
-    if type == 'network map':
-        return pinger.NetworkMap(config)
-    if type == 'octoprint':
-        return printer.PrinterWidget(config)
-    if type == 'touch':
-        return touch.TouchWidget(config)
     if type == 'columns':
         subwidgets = []
+        subtypes = []
         for subconfig in config:
             subtype = subconfig.keys()[0]
             subwidgets.append(createWidget(subtype, subconfig[subtype]))
-        return WidgetColumns(subwidgets)
-    raise TypeError("Invalid top level configuration")
+            subtypes.append(subtype)
+        return WidgetColumns(subwidgets, subtypes)
+    return widgetClass(type)(config)
+
+def configSettings(config):
+    ''' The settings parts of a config, merged into one dict. '''
+    settings = {}
+    for item in config:
+        if item.keys()[0] == 'settings':
+            settings.update(item['settings'])
+    return settings
+
+def reconfigureWidgets(widgets, types, config, settings=None):
+    '''
+    Change running widgets to match a new config, in place, so they keep their
+    state and connections. settings are the ones it's running with, if config
+    is a whole config and not a list of columns. Returns None, or what needs a
+    restart to change.
+    '''
+    items = [(item.keys()[0], item.values()[0]) for item in config if item.keys()[0] != 'settings']
+    if [type for type, params in items] != types:
+        return "Widgets were added, removed or moved in the config. Restart to see that."
+
+    problems = []
+    for wid, (type, params) in zip(widgets, items):
+        if hasattr(wid, 'reconfigure'):
+            problem = wid.reconfigure(params)
+        else:
+            problem = "The %s widget can't be changed without a restart." % type
+        if problem:
+            problems.append(problem)
+    if settings is not None and configSettings(config) != settings:
+        # nothing reads them after startup.
+        problems.append("The settings changed. Restart to see that.")
+    if problems:
+        return problems[0]
+    return None
 
 if __name__ == '__main__':
 
-    # top and bottom fields.
-    title_name = urwid.Text(u"Evil House Monitor\nv0.1")
-    clock = urwid.Text(u"Clock", align="right")
-    threads = urwid.Text(u"threads", align="center")
-    hostname = urwid.Text(u"hostname", align="center")
-    uptime = urwid.Text(u"uptime", align="center")
-    title = urwid.Columns([title_name, threads, hostname, uptime, clock])
-    set_title()
-    status = urwid.Text(u"Status:")
+    parser = argparse.ArgumentParser(description="Evil House Monitor")
+    parser.add_argument('--config', help="config file to use, instead of config.yaml (or the example)")
+    parser.add_argument('--headless', action='store_true', help="run the collectors without a display")
+    parser.add_argument('--metrics-port', type=int, help="serve Prometheus metrics on this port")
+    parser.add_argument('--web-port', type=int, help="serve a live web page of the house on this port")
+    parser.add_argument('--watch', action='store_true', help="apply changes to the config file without restarting")
+    parser.add_argument('--agent', help="probe only the part of the network map that belongs to this agent, and report it over mqtt")
+    parser.add_argument('--record', help="log everything the collectors see to this file")
+    parser.add_argument('--replay', help="feed a recording to the widgets, instead of probing")
+    parser.add_argument('--replay-speed', type=float, default=1.0, help="how many times faster than real time to replay (0 is as fast as it can)")
+    parser.add_argument('--timeline', help="keep every up and down in this timeline, for uptime stats (a replay only keeps one if it's given here)")
+    args = parser.parse_args()
+
+    if args.replay:
+        # nothing goes out to a real broker while replaying.
+        import mqtt
+        mqtt.NewClient = mqtt.LocalBroker().client
 
     # config
-    if os.path.isfile('config.yaml'):
+    if args.config:
+        config_filename = args.config
+    elif os.path.isfile('config.yaml'):
         config_filename = 'config.yaml'
     else:
         config_filename = 'example/config.yaml'
 
     # Individual widget objects
     widgets = []
-    with open(config_filename, 'r') as config_file:
+    types = []
+    try:
+        config = configuration.load(config_filename)
+    except configuration.ConfigError as e:
+        print("%s: %s" % (config_filename, e))
+        sys.exit(1)
 
-        config = yaml.load(config_file)
+    settings = configSettings(config)
+    for widget_config_map in config:
+        type = widget_config_map.keys()[0]
+        if type == 'settings':
+            continue
+        widgets.append(createWidget(type, widget_config_map[type]))
+        types.append(type)
 
-        for widget_config_map in config:
-            type = widget_config_map.keys()[0]
-            widgets.append(createWidget(type, widget_config_map[type]))
+    metrics_port = args.metrics_port or settings.get('metrics_port')
+    web_port = args.web_port or settings.get('web_port')
+    instrument.enabled = settings.get('instrument', True)
+    profiler = instrument.Profiler(PROFILE_FILENAME, duration=settings.get('profile_seconds', 10.0))
+    signal.signal(signal.SIGUSR1, on_signal)
+    signal.signal(signal.SIGUSR2, on_signal)
 
-    # Create the color pallete
-    palette = [
-        ('title', 'light blue', '', '', 'light blue', ''),
-    ]
+    timeline_filename = args.timeline or settings.get('timeline')
+    if args.replay and not args.timeline:
+        # a replay's times are from the recording, and don't belong in the live timeline.
+        timeline_filename = None
+    timeline_view = None
 
-    for wid in widgets:
-        palette += wid.getPalette()
+    # what the status line looks at, besides the alerts
+    sources = []
+    replayer = None
+    if args.replay:
+        replayer = recorder.Replayer(args.replay, widgets, speed=args.replay_speed)
+        sources.append(replayer)
+    watcher = None
+    if args.watch or settings.get('watch'):
+        watcher = configuration.Watcher(config_filename, lambda config: reconfigureWidgets(widgets, types, config, settings))
+        sources.append(watcher)
+
+    if args.agent:
+        # Just the probes for our part of the map.
+        loop = scheduler.HeadlessLoop()
+        ticker = scheduler.Scheduler(loop, fps=settings.get('fps', 4.0), budget=settings.get('budget', 0.05), headless=True)
+        import agent
+        for wid in leafWidgets(widgets):
+            if getattr(wid, 'agents', None):
+                agent.Agent(wid, args.agent, wid.agents).start(ticker)
+        loop.run()
+        sys.exit(0)
+
+    # The problems in the status line. The collectors tell the rules when something
+    # changes. Widgets that don't (other people's) get their getError polled.
+    alert_settings = settings.get('alerts', {})
+    alerts.engine = alerts.Engine(alerts.defaultRules(alert_settings),
+                                  flap_window=alert_settings.get('flap_window', 300.0),
+                                  flap_count=alert_settings.get('flap_count', 4),
+                                  show=alert_settings.get('show', 3))
+    builtin = [module for module, name in WIDGET_TYPES.values()]
+    for i, wid in enumerate(leafWidgets(widgets)):
+        if wid.__class__.__module__ not in builtin:
+            alerts.engine.watch(wid, 'widget/%s/%d' % (wid.__class__.__name__, i))
+    sources.append(alerts.engine)
 
-    # Create the main loop.
-    divider = urwid.Divider(u'\u2500')
-    header = urwid.Pile([title, divider])
-    body = urwid.Filler(urwid.Pile([urwid.LineBox(w) for w in widgets]), 'top')
-    footer = urwid.Pile([divider, status])
-    main_wid = urwid.Frame(body, header, footer)
-    loop = urwid.MainLoop(main_wid, palette, unhandled_input=event)
-    loop.screen.set_terminal_properties(colors=256)
+    if args.headless:
+        # No terminal, just the collectors.
+        loop = scheduler.HeadlessLoop()
+        ticker = scheduler.Scheduler(loop, fps=settings.get('fps', 4.0), budget=settings.get('budget', 0.05), headless=True,
+                                     probes=not args.replay)
+        if not metrics_port:
+            metrics_port = DEFAULT_METRICS_PORT
+    else:
+        # top and bottom fields.
+        title_name = urwid.Text(u"Evil House Monitor\nv0.1")
+        clock = urwid.Text(u"Clock", align="right")
+        threads = urwid.Text(u"threads", align="center")
+        hostname = urwid.Text(u"hostname", align="center")
+        uptime = urwid.Text(u"uptime", align="center")
+        title = urwid.Columns([title_name, threads, hostname, uptime, clock])
+        sysinfo.shared().start()
+        set_title()
+        status = urwid.Text(u"Status:")
+
+        # Create the color pallete
+        palette = [
+            ('title', 'light blue', '', '', 'light blue', ''),
+        ]
+
+        for wid in widgets:
+            palette += wid.getPalette()
+
+        # Create the main loop.
+        divider = urwid.Divider(u'\u2500')
+        header = urwid.Pile([title, divider])
+        body = urwid.Filler(urwid.Pile([urwid.LineBox(w) for w in widgets]), 'top')
+        footer = urwid.Pile([divider, status])
+        main_wid = urwid.Frame(body, header, footer)
+        loop = scheduler.MainLoop(main_wid, palette, unhandled_input=event)
+        loop.screen.set_terminal_properties(colors=256)
+
+        # Everything runs off of one clock.
+        ticker = scheduler.Scheduler(loop, fps=settings.get('fps', 4.0), budget=settings.get('budget', 0.05),
+                                     probes=not args.replay)
+        ticker.every(1.0, lambda: update(sources), draw=True)
+
+        # The instrumentation page, shown with 'p'.
+        overlay = instrument.Overlay()
+        ticker.every(1.0, overlay.update, draw=True)
 
     # Kick off the updates for each widget.
+    alerts.engine.start(ticker)
     for wid in widgets:
-        wid.start(loop)
+        wid.start(ticker)
 
-    # start this a little later.
-    loop.set_alarm_in(1.0, update, widgets)
+    if metrics_port:
+        import exporter
+        exporter.Exporter(widgets, metrics_port).start(ticker)
 
-    loop.run()
+    if web_port:
+        import web
+        web.WebServer(widgets, web_port).start(ticker)
+
+    if args.record:
+        recorder.recording = recorder.Recorder(args.record)
+        recorder.recording.start(ticker)
 
+    timeline_log = None
+    if timeline_filename:
+        import timeline
+        timeline_log = timeline.Timeline(timeline_filename)
+        timeline.Tracker(timeline_log, widgets).start(ticker)
+        if not args.headless:
+            # The uptime page, shown with 't'.
+            timeline_view = timeline.View(timeline_log)
+            ticker.every(5.0, timeline_view.update, draw=True)
+
+    if replayer:
+        replayer.start(ticker)
+
+    if watcher:
+        watcher.start(ticker)
+
+    # The first thing the loop does is report how long it took to get going,
+    # counting from when python started.
+    def started(loop=None, data=None):
+        elapsed = time.time() - processStartTime()
+        instrument.record('startup', elapsed)
+        if args.headless:
+            print("Started in %0.2fs" % elapsed)
+            sys.stdout.flush()
+        else:
+            set_text(title_name, u"Evil House Monitor\nv0.1 (up in %0.2fs)" % elapsed)
+    loop.set_alarm_in(0, started)
+
+    loop.run()
 
+    if recorder.recording:
+        recorder.recording.close()
+    if timeline_log:
+        timeline_log.close()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+import threading
+
+import instrument
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+#########################################################
+# Prometheus text format
+#########################################################
+
+# name: (type, help)
+METRICS = {
+    'housemon_up': ('gauge', '1 if no widget reports a problem.'),
+    'housemon_error': ('gauge', 'The problem a widget reports, as a label.'),
+    'housemon_internet_up': ('gauge', '1 if the internet address answers pings.'),
+    'housemon_dns_up': ('gauge', '1 if the internet host name resolves.'),
+    'housemon_neighbors_seen': ('gauge', 'Endpoints the neighbour table vouched for, so they were not pinged.'),
+    'housemon_endpoint_up': ('gauge', '1 if the endpoint answered its last ping.'),
+    'housemon_endpoint_rtt_seconds': ('gauge', 'Round trip time of the last ping.'),
+    'housemon_endpoint_loss_ratio': ('gauge', 'Fraction of the recent pings that were lost.'),
+    'housemon_snmp_up': ('gauge', '1 if the switch answered its last SNMP poll.'),
+    'housemon_port_up': ('gauge', '1 if the switch port is up.'),
+    'housemon_port_receive_bytes_per_second': ('gauge', 'Bytes a second into the switch port, since the last poll.'),
+    'housemon_port_transmit_bytes_per_second': ('gauge', 'Bytes a second out of the switch port, since the last poll.'),
+    'housemon_port_errors_per_second': ('gauge', 'Errors a second on the switch port, since the last poll.'),
+    'housemon_mqtt_connected': ('gauge', '1 if the broker connection is up.'),
+    'housemon_mqtt_value': ('gauge', 'Last value of a topic, if it is a number.'),
+    'housemon_mqtt_age_seconds': ('gauge', 'Time since a topic was last seen.'),
+    'housemon_mqtt_fresh': ('gauge', '1 if a topic was seen within its timeout.'),
+    'housemon_printer_up': ('gauge', '1 if octoprint is answering.'),
+    'housemon_printer_temperature_celsius': ('gauge', 'Printer temperatures.'),
+    'housemon_printer_data_age_seconds': ('gauge', 'Time since octoprint last answered.'),
+    'housemon_system_cpu_ratio': ('gauge', 'Fraction of the cpu that was busy since the last sample.'),
+    'housemon_system_load1': ('gauge', 'One minute load average.'),
+    'housemon_system_memory_total_bytes': ('gauge', 'Memory the machine has.'),
+    'housemon_system_memory_available_bytes': ('gauge', 'Memory that is free for use.'),
+    'housemon_system_temperature_celsius': ('gauge', 'Temperature of the first thermal zone.'),
+    'housemon_system_network_receive_bytes_total': ('counter', 'Bytes received on the interface.'),
+    'housemon_system_network_transmit_bytes_total': ('counter', 'Bytes sent on the interface.'),
+}
+
+def unicode_text(value):
+    try:
+        return unicode(value)
+    except NameError:
+        return str(value)
+
+def escape(value):
+    return unicode_text(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render(samples):
+    '''
+    Render (name, labels, value) samples in the Prometheus text format.
+    Samples with a value of None are left out.
+    '''
+    grouped = {}
+    for name, labels, value in samples:
+        if value is None:
+            continue
+        grouped.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name in sorted(grouped.keys()):
+        type, help = METRICS.get(name, ('untyped', ''))
+        lines.append(u'# HELP %s %s' % (name, help))
+        lines.append(u'# TYPE %s %s' % (name, type))
+        for labels, value in grouped[name]:
+            if labels:
+                label_text = u','.join([u'%s="%s"' % (k, escape(v)) for k, v in sorted(labels.items())])
+                lines.append(u'%s{%s} %s' % (name, label_text, repr(float(value))))
+            else:
+                lines.append(u'%s %s' % (name, repr(float(value))))
+    lines.append(u'')
+    return u'\n'.join(lines).encode('utf-8')
+
+def widgetSamples(widgets):
+    ''' All the samples from the widgets, plus what they report through getError. '''
+    samples = []
+    ok = True
+    for wid in widgets:
+        samples += wid.getMetrics()
+        error = wid.getError()
+        if error:
+            ok = False
+            samples.append(('housemon_error', {'widget': wid.__class__.__name__, 'message': error}, 1))
+    samples.append(('housemon_up', {}, int(ok)))
+    return samples
+
+#########################################################
+# HTTP endpoint
+#########################################################
+
+class Exporter(object):
+    '''
+    Serves the current state of the widgets at /metrics.
+
+    The page is rendered by the scheduler, off of the request path, so a scrape is
+    just handing over the last rendered string.
+    '''
+    def __init__(self, widgets, port, address=''):
+        self.widgets = widgets
+        self.body = render([])
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ['/metrics', '/']:
+                    self.send_error(404)
+                    return
+                body = exporter.body
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server((address, port), Handler)
+
+    @instrument.timed('exporter.refresh')
+    def refresh(self):
+        ''' Render the page. '''
+        self.body = render(widgetSamples(self.widgets))
+
+    def start(self, scheduler, interval=1.0):
+        ''' Called to add the initial processes to the scheduler.'''
+        scheduler.every(interval, self.refresh)
+        t = threading.Thread(target=self.server.serve_forever, args=())
+        t.setDaemon(True)
+        t.start()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+import collections
+import functools
+import math
+import sys
+import threading
+import time
+import traceback
+import urwid
+
+#########################################################
+# Counters
+#########################################################
+
+# Set to False to make all the timing a no-op.
+enabled = True
+
+# latency buckets are powers of two, in microseconds. The last one catches everything slower.
+BUCKETS = 26
+
+class Stat(object):
+    ''' Call count, latency histogram and in-flight count for one thing. '''
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.inflight = 0
+        self.errors = 0
+        self.buckets = [0] * BUCKETS
+        self.lock = threading.Lock()
+
+    def begin(self):
+        self.lock.acquire(True)
+        self.inflight += 1
+        self.lock.release()
+
+    def end(self, elapsed, error=False):
+        bucket = min(int(elapsed * 1000000.0).bit_length(), BUCKETS - 1)
+        self.lock.acquire(True)
+        self.inflight -= 1
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        self.buckets[bucket] += 1
+        if error:
+            self.errors += 1
+        self.lock.release()
+
+    def percentile(self, fraction):
+        ''' Roughly, from the histogram. Returns the top of the bucket, in seconds. '''
+        wanted = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return (1 << bucket) / 1000000.0
+        return 0.0
+
+stats = {}
+stats_lock = threading.Lock()
+
+def getStat(name):
+    stat = stats.get(name)
+    if stat is None:
+        stats_lock.acquire(True)
+        stat = stats.setdefault(name, Stat(name))
+        stats_lock.release()
+    return stat
+
+def record(name, elapsed):
+    ''' Count something that was timed some other way. '''
+    if enabled:
+        stat = getStat(name)
+        stat.begin()
+        stat.end(elapsed)
+
+def reset():
+    stats_lock.acquire(True)
+    stats.clear()
+    stats_lock.release()
+
+class span(object):
+    '''
+    Time a block of code:
+
+        with instrument.span('printer.fetch'):
+            ...
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if enabled:
+            self.stat = getStat(self.name)
+            self.stat.begin()
+            self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, tb):
+        if enabled:
+            self.stat.end(time.time() - self.start, type is not None)
+        return False
+
+def timed(name):
+    ''' Decorator that times every call to a function. '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            stat = getStat(name)
+            stat.begin()
+            start = time.time()
+            error = True
+            try:
+                result = function(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                stat.end(time.time() - start, error)
+        return wrapper
+    return decorator
+
+class TimedLock(object):
+    ''' A Lock that records how long everyone waited for it, as "lock <name>". '''
+    def __init__(self, name):
+        self.name = 'lock ' + name
+        self.lock = threading.Lock()
+
+    def acquire(self, blocking=True):
+        if not enabled:
+            return self.lock.acquire(blocking)
+        stat = getStat(self.name)
+        stat.begin()
+        start = time.time()
+        got = self.lock.acquire(blocking)
+        stat.end(time.time() - start, not got)
+        return got
+
+    def release(self):
+        self.lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, type, value, tb):
+        self.release()
+        return False
+
+#########################################################
+# Reports
+#########################################################
+
+def ms(seconds):
+    return '%0.2f' % (seconds * 1000.0)
+
+def percentile(values, fraction):
+    ''' Nearest rank, of a list of samples. Under 100 of them, p99 is the max. 0.0 if there are none. '''
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(int(math.ceil(fraction * len(values))) - 1, 0)]
+
+def report():
+    ''' A table of everything that has been counted, slowest total first. '''
+    stats_lock.acquire(True)
+    rows = list(stats.values())
+    stats_lock.release()
+    rows.sort(key=lambda s: -s.total)
+
+    lines = ['%-40s %8s %6s %5s %9s %9s %9s %9s' % ('name', 'calls', 'busy', 'errs', 'avg ms', 'p50 ms', 'p99 ms', 'max ms')]
+    for stat in rows:
+        avg = 0.0
+        if stat.count:
+            avg = stat.total / stat.count
+        lines.append('%-40s %8d %6d %5d %9s %9s %9s %9s' % (
+            stat.name[:40], stat.count, stat.inflight, stat.errors,
+            ms(avg), ms(stat.percentile(0.5)), ms(stat.percentile(0.99)), ms(stat.max)))
+    lines.append('threads: %d' % threading.active_count())
+    return '\n'.join(lines)
+
+def dump(filename):
+    with open(filename, 'a') as f:
+        f.write('==== %s\n%s\n\n' % (time.asctime(), report()))
+
+class Overlay(urwid.Pile):
+    ''' A page with the report on it, for flipping to from the dashboard. '''
+    def __init__(self):
+        self.text = urwid.Text(u'')
+        urwid.Pile.__init__(self, [urwid.AttrMap(urwid.Text(u'Instrumentation (p to go back, d to dump, P to profile)'), 'title'),
+                                   urwid.Divider(u'\u2500'), self.text])
+        self.visible = False
+
+    def update(self):
+        ''' Draw task. Only does work while the page is showing. '''
+        if not self.visible:
+            return False
+        self.text.set_text(report())
+        return True
+
+#########################################################
+# Sampling profiler
+#########################################################
+
+class Profiler(object):
+    '''
+    Looks at what every thread is doing, every interval, for a while, and writes
+    the most common stacks to a file. Nothing is hooked in while it isn't running.
+    '''
+    def __init__(self, filename, duration=10.0, interval=0.005, depth=8):
+        self.filename = filename
+        self.duration = duration
+        self.interval = interval
+        self.depth = depth
+        self.running = False
+
+    def sample(self, counts, me):
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = traceback.extract_stack(frame)[-self.depth:]
+            counts['\n    '.join(['%s:%d %s' % (f[0], f[1], f[2]) for f in reversed(stack)])] += 1
+
+    def run(self):
+        counts = collections.Counter()
+        me = threading.current_thread().ident
+        end = time.time() + self.duration
+        samples = 0
+        while time.time() < end:
+            self.sample(counts, me)
+            samples += 1
+            time.sleep(self.interval)
+
+        with open(self.filename, 'a') as f:
+            f.write('==== %s, %d samples over %0.1fs\n' % (time.asctime(), samples, self.duration))
+            for stack, count in counts.most_common(30):
+                f.write('%5.1f%% %s\n' % (100.0 * count / max(samples, 1), stack))
+            f.write('\n')
+        self.running = False
+
+    def start(self):
+        ''' Start a run in the background, unless one is already going. Returns True if it started. '''
+        if self.running:
+            return False
+        self.running = True
+        t = threading.Thread(target=self.run, args=())
+        t.setDaemon(True)
+        t.start()
+        return True
@@ -1,64 +1,210 @@
 #!/usr/bin/env python
 
 import paho.mqtt.client as mqtt
-import time
+import collections
+import marshal
+import multiprocessing
+import os
 import threading
+import time
 import urwid
+import zlib
+
+import alerts
+import instrument
+import recorder
+
+def NewClient():
+    ''' Make an mqtt client. Everything gets its client from here, so it can be swapped for a LocalBroker. '''
+    return mqtt.Client()
+
+#########################################################
+# Local stand-in for a broker
+#########################################################
+
+class LocalMessage(object):
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+def TopicMatches(pattern, topic):
+    ''' Does topic match a subscription pattern with + and # in it. '''
+    pattern = pattern.split('/')
+    topic = topic.split('/')
+    for i, level in enumerate(pattern):
+        if level == '#':
+            return True
+        if i >= len(topic):
+            return False
+        if level != '+' and level != topic[i]:
+            return False
+    return len(pattern) == len(topic)
+
+class LocalBroker(object):
+    '''
+    An in-process broker, for testing without a real one.
+
+    It hands out clients that look enough like the paho client for the code here.
+    Publishing delivers the message right away, in the publisher's thread.
+    '''
+    def __init__(self):
+        self.clients = []
+        self.lock = instrument.TimedLock('LocalBroker.lock')
+        self.published = 0
+
+    def client(self):
+        return LocalClient(self)
+
+    def publish(self, topic, payload):
+        self.lock.acquire(True)
+        self.published += 1
+        clients = list(self.clients)
+        self.lock.release()
+        msg = LocalMessage(topic, payload)
+        for client in clients:
+            client.deliver(msg)
+
+class LocalClient(object):
+    def __init__(self, broker):
+        self.broker = broker
+        self.subscriptions = []
+        self.connected = False
+        self.on_connect = None
+        self.on_message = None
+        self.on_disconnect = None
+
+    def connect_async(self, host, port=1883, keepalive=60):
+        pass
+
+    connect = connect_async
+
+    def loop_start(self):
+        self.broker.lock.acquire(True)
+        self.broker.clients.append(self)
+        self.broker.lock.release()
+        self.connected = True
+        if self.on_connect:
+            self.on_connect(self, None, {}, 0)
+
+    def loop_stop(self, force=False):
+        self.disconnect()
+
+    def disconnect(self):
+        self.broker.lock.acquire(True)
+        if self in self.broker.clients:
+            self.broker.clients.remove(self)
+        self.broker.lock.release()
+        if self.connected and self.on_disconnect:
+            self.on_disconnect(self, None, 0)
+        self.connected = False
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.append(topic)
+        return (0, len(self.subscriptions))
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.broker.publish(topic, payload)
+
+    def deliver(self, msg):
+        for pattern in self.subscriptions:
+            if TopicMatches(pattern, msg.topic):
+                if self.on_message:
+                    self.on_message(self, None, msg)
+                return
 
 #########################################################
 # Display stuff
 #########################################################
 
+# The last message on a topic. These are replaced, never changed, so the display
+# can read one without locking, and always gets a consistent set.
+MqttState = collections.namedtuple('MqttState', ['value', 'last_time', 'changed_time'])
+
 class MqttData(object):
     def __init__(self, params):
         self.topic = params['topic']
         self.name = params['name']
         self.timeout = float(params['timeout'])
 
-        self.last_time = time.time()
-        self.value = None
+        now = recorder.now()
+        self.state = MqttState(None, now, now)
+        # unique name, set by the widget.
+        self.key = None
 
-    def update(self, value):
-        self.value = value
-        self.last_time = time.time()
+    @property
+    def value(self):
+        return self.state.value
 
-    def ok(self):
-        dt = time.time() - self.last_time
+    @property
+    def last_time(self):
+        return self.state.last_time
+
+    def update(self, value):
+        state = self.state
+        now = recorder.now()
+        changed_time = state.changed_time
+        if state.value != value:
+            changed_time = now
+        self.state = MqttState(value, now, changed_time)
+        self.notify()
+
+    def notify(self):
+        state = self.state
+        alerts.notify(self.key, {'value': state.value, 'last_time': state.last_time, 'timeout': self.timeout, 'name': self.name})
+
+    def ok(self, state=None):
+        if state is None:
+            state = self.state
+        dt = recorder.now() - state.last_time
 
         if (dt < self.timeout):
             return True
         return False
 
     def draw(self):
-        if self.ok():
+        state = self.state
+        if self.ok(state):
             color = 'good'
         else:
             color = 'stale'
 
         cols = urwid.Columns([])
         cols.contents.append((urwid.AttrMap(urwid.Text(self.name), color), cols.options()))
-        cols.contents.append((urwid.AttrMap(urwid.Text(self.value_text()), color), cols.options()))
+        cols.contents.append((urwid.AttrMap(urwid.Text(self.value_text(state)), color), cols.options()))
         return cols
 
-    def value_text(self):
-        return str(self.value)
+    def value_text(self, state):
+        return str(state.value)
+
+    def signature(self):
+        state = self.state
+        return (self.ok(state), self.value_text(state))
+
+    def getState(self, path):
+        state = self.state
+        return [('%s/%s' % (path, self.name), {'value': self.value_text(state), 'ok': self.ok(state), 'topic': self.topic})]
+
+    def getMetrics(self, labels):
+        ''' Return (name, labels, value) samples for this topic. '''
+        state = self.state
+        labels = dict(labels, name=self.name, topic=self.topic)
+        try:
+            value = float(state.value)
+        except (TypeError, ValueError):
+            value = None
+        return [
+            ('housemon_mqtt_value', labels, value),
+            ('housemon_mqtt_age_seconds', labels, recorder.now() - state.last_time),
+            ('housemon_mqtt_fresh', labels, int(self.ok(state))),
+        ]
 
 class MqttTimedData(MqttData):
     ''' Also print how long the value has been at that value '''
-    def __init__(self, params):
-        MqttData.__init__(self, params)
-        self.changed_time = time.time()
-
-    def update(self, value):
-        if self.value != value:
-            self.changed_time = time.time()
-        MqttData.update(self, value)
+    def value_text(self, state):
+        if state.value is None:
+            return MqttData.value_text(self, state)
 
-    def value_text(self):
-        if self.value is None:
-            return MqttData.value_text(self)
-
-        changed_ago = time.time() - self.changed_time
+        changed_ago = recorder.now() - state.changed_time
 
         SECONDS_PER_MINUTE = 60.0
         SECONDS_PER_HOUR = 60.0 * SECONDS_PER_MINUTE
@@ -76,11 +222,13 @@ class MqttTimedData(MqttData):
         else:
             changed_time =  "%0.0f sec" % changed_ago
 
-        return '%s (%s)' % (MqttData.value_text(self), changed_time)
+        return '%s (%s)' % (MqttData.value_text(self, state), changed_time)
 
 class MqttGroup(object):
     def __init__(self, params):
         self.name = params['name']
+        # the name (or host) of the broker its topics come from, when there's more than one.
+        self.broker = params.get('broker')
         self.messages = {}
         for data in params['messages']:
             if 'timed' in data.keys() and data['timed']:
@@ -93,6 +241,11 @@ class MqttGroup(object):
         if 'divider' in params.keys():
             self.divider = params['divider']
 
+    def setKey(self, path):
+        self.key = '%s/%s' % (path, self.name)
+        for message in self.messages.values():
+            message.key = '%s/%s' % (self.key, message.name)
+
     def update(self, msg):
         if msg.topic in self.messages:
             self.messages[msg.topic].update(msg.payload)
@@ -127,43 +280,299 @@ class MqttGroup(object):
                 return True
         return False
 
+    def signature(self):
+        return tuple([message.signature() for message in self.messages.values()])
+
+    def getState(self, path):
+        path = '%s/%s' % (path, self.name)
+        state = [(path, {'ok': self.ok()})]
+        for message in self.messages.values():
+            state += message.getState(path)
+        return state
+
+    def getMetrics(self, labels):
+        samples = []
+        for message in self.messages.values():
+            samples += message.getMetrics(dict(labels, group=self.name))
+        return samples
+
+#########################################################
+# Brokers
+#########################################################
+
+def inProcess():
+    ''' True when the clients come from a LocalBroker, which other processes can't reach. '''
+    return isinstance(getattr(NewClient, '__self__', None), LocalBroker)
+
+def shardMain(host, port, topics, conn, interval):
+    '''
+    A shard worker process. Subscribes to its topics on the broker, keeps only
+    the latest payload of each, and every interval sends what changed to the
+    display as one marshalled list of (topic number, payload). Number -1 is the
+    connection: 1 up, 0 down.
+    '''
+    index = dict([(topic, i) for i, topic in enumerate(topics)])
+    pending = {}
+    lock = threading.Lock()
+
+    def on_connect(client, userdata, flags, rc):
+        if topics:
+            client.subscribe([(topic, 0) for topic in topics])
+        with lock:
+            pending[-1] = b'1'
+
+    def on_disconnect(client, userdata, rc):
+        with lock:
+            pending[-1] = b'0'
+
+    def on_message(client, userdata, msg):
+        i = index.get(msg.topic)
+        if i is not None:
+            with lock:
+                pending[i] = msg.payload
+
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_message = on_message
+    client.connect_async(host, port=port)
+    client.loop_start()
+    parent = os.getppid()
+    while os.getppid() == parent:
+        time.sleep(interval)
+        with lock:
+            batch = list(pending.items())
+            pending.clear()
+        if batch:
+            try:
+                conn.send_bytes(marshal.dumps(batch))
+            except (IOError, OSError, EOFError, ValueError):
+                break
+    client.disconnect()
+
+class Broker(object):
+    '''
+    One broker, for an MqttWidget. Each has its own client, and so its own
+    network thread, so a slow or flooded broker can't hold up the others.
+
+    With shards, the broker's topics are split between that many worker
+    processes, each with its own connection. The workers boil what they hear
+    down to the latest payload per topic, and send it over a pipe in batches,
+    so a flood costs the display one small message per batch, not one per publish.
+    '''
+    def __init__(self, widget, params, topics, key):
+        self.widget = widget
+        self.host = params['host']
+        self.port = params.get('port', 1883)
+        self.name = params.get('name', self.host)
+        self.shards = int(params.get('shards', 1))
+        self.batch = float(params.get('batch', 0.1))
+        self.topics = sorted(topics)
+        # see brokerKeys
+        self.key = key
+
+        self.client = None
+        self.workers = []
+        # whether each shard is connected, or just the one client.
+        self.links = [False]
+        self.batches = 0
+
+    def settings(self):
+        ''' What needs a new connection if it changes. '''
+        topics = None
+        if self.sharded():
+            topics = self.topics
+        return (self.key, self.host, self.port, self.shards, topics)
+
+    @property
+    def label(self):
+        ''' What tells it apart from the other brokers: its host, or its name if that's shared. '''
+        return self.key.split('/', 1)[1]
+
+    def sharded(self):
+        return self.shards > 1 and not inProcess()
+
+    @property
+    def connected(self):
+        return all(self.links)
+
+    def setLink(self, shard, up):
+        was = self.connected
+        self.links[shard] = up
+        if self.connected != was:
+            alerts.notify(self.key, {'connected': self.connected})
+
+    def start(self):
+        if not self.sharded():
+            self.client = NewClient()
+            self.client.on_connect = self.on_connect
+            self.client.on_message = self.on_message
+            self.client.on_disconnect = self.on_disconnect
+            self.client.connect_async(self.host, port=self.port)
+            self.client.loop_start()
+            return
+
+        self.links = [False] * self.shards
+        for shard in range(self.shards):
+            topics = [t for t in self.topics if zlib.crc32(t.encode('utf-8')) % self.shards == shard]
+            receiver, sender = multiprocessing.Pipe(False)
+            worker = multiprocessing.Process(target=shardMain, args=(self.host, self.port, topics, sender, self.batch))
+            worker.daemon = True
+            worker.start()
+            sender.close()
+            self.workers.append(worker)
+            t = threading.Thread(target=self.receive, args=(shard, topics, receiver))
+            t.setDaemon(True)
+            t.start()
+
+    def stop(self):
+        if self.client:
+            self.client.disconnect()
+            self.client.loop_stop()
+            self.client = None
+        for worker in self.workers:
+            worker.terminate()
+        self.workers = []
+        self.links = [False] * len(self.links)
+
+    def receive(self, shard, topics, conn):
+        ''' Takes a shard's batches, until it goes away. '''
+        while True:
+            try:
+                batch = marshal.loads(conn.recv_bytes())
+            except (IOError, OSError, EOFError, ValueError):
+                self.setLink(shard, False)
+                return
+            self.batches += 1
+            for i, payload in batch:
+                if i < 0:
+                    self.setLink(shard, payload == b'1')
+                else:
+                    self.widget.on_message(self, LocalMessage(topics[i], payload))
+
+    def on_connect(self, client, userdata, flags, rc):
+        client.subscribe('#')
+        self.setLink(0, True)
+
+    def on_disconnect(self, client, userdata, rc):
+        self.setLink(0, False)
+
+    def on_message(self, client, userdata, msg):
+        self.widget.on_message(self, msg)
+
+#########################################################
+# The widget
+#########################################################
+
+def brokerParams(params):
+    ''' The brokers a widget's config asks for: a list under brokers, or just a host and port. '''
+    if 'brokers' in params.keys():
+        return params['brokers']
+    return [{'host': params['host'], 'port': params['port']}]
+
+def brokerKeys(broker_params):
+    '''
+    {broker name: key} for everything from a broker: mqtt/<host>, or mqtt/<name>
+    when more than one broker is on that host, on different ports.
+    '''
+    hosts = collections.Counter([b['host'] for b in broker_params])
+    keys = {}
+    for b in broker_params:
+        name = b.get('name', b['host'])
+        if hosts[b['host']] > 1:
+            keys[name] = 'mqtt/%s' % name
+        else:
+            keys[name] = 'mqtt/%s' % b['host']
+    return keys
+
 class MqttWidget(urwid.Pile):
     ''' Class used to draw the data from the Printer. '''
     def __init__(self, params):
         urwid.Pile.__init__(self, [])
 
-        self.connected = False
-
         self.params = params
-        self.host = params['host']
+        self.brokers = []
         self.machines = []
-        for machine in params['machines']:
-            self.machines.append(MqttGroup(machine))
+        self.started = False
 
-        self.cols = 1
-        if 'columns' in params.keys():
-            self.cols = params['columns']
+        # what the display was last drawn from
+        self.drawn = None
 
-        self.client = mqtt.Client()
+        self.reconfigure(params)
 
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
-        self.client.on_disconnect = self.on_disconnect
+    def reconfigure(self, params):
+        '''
+        Change to a new config. Topics that are still there keep their last message,
+        and a broker's connection is kept unless its settings changed. Returns None.
+        '''
+        states = {}
+        old_keys = set()
+        for machine in self.machines:
+            for topic, data in machine.messages.items():
+                states[(machine.broker, topic)] = data.state
+                old_keys.add(data.key)
 
-        self.stats_lock = threading.Lock()
+        broker_params = brokerParams(params)
+        keys = brokerKeys(broker_params)
+        names = [b.get('name', b['host']) for b in broker_params]
+        topics = dict([(name, set()) for name in names])
 
-    def on_connect(self, client, userdata, flags, rc):
-        client.subscribe('#')
-        self.connected = True
+        machines = []
+        for machine in params['machines']:
+            group = MqttGroup(machine)
+            # groups that don't say are on the first broker.
+            if group.broker is None:
+                group.broker = names[0]
+            if group.broker not in keys:
+                raise KeyError("%s is on broker %s, which isn't in the config" % (group.name, group.broker))
+            group.setKey(keys[group.broker])
+            for topic, data in group.messages.items():
+                if (group.broker, topic) in states:
+                    data.state = states[(group.broker, topic)]
+                old_keys.discard(data.key)
+                data.notify()
+                topics[group.broker].add(topic)
+            machines.append(group)
+        for key in old_keys:
+            alerts.notify(key, None)
 
-    def on_disconnect(self, client, userdata, rc):
-        self.connected = False
+        self.cols = 1
+        if 'columns' in params.keys():
+            self.cols = params['columns']
+        # on_message only ever sees the old list or the new one.
+        self.machines = machines
+        self.drawn = None
+
+        old = dict([(broker.name, broker) for broker in self.brokers])
+        brokers = []
+        for p in broker_params:
+            name = p.get('name', p['host'])
+            broker = Broker(self, p, topics[name], keys[name])
+            current = old.pop(broker.name, None)
+            if current is not None and current.settings() == broker.settings():
+                current.topics = broker.topics
+                brokers.append(current)
+                continue
+            if current is not None:
+                current.stop()
+                if current.key != broker.key:
+                    alerts.notify(current.key, None)
+            if self.started:
+                broker.start()
+            brokers.append(broker)
+        for broker in old.values():
+            broker.stop()
+            alerts.notify(broker.key, None)
+        self.brokers = brokers
+        self.params = params
+        return None
 
-    def on_message(self, client, userdata, msg):
-        self.stats_lock.acquire(True)
+    @instrument.timed('MqttWidget.on_message')
+    def on_message(self, broker, msg):
+        recorder.observe(recorder.MQTT, broker.key, msg.topic, msg.payload)
         for item in self.machines:
-            item.update(msg)
-        self.stats_lock.release()
+            if item.broker == broker.name:
+                item.update(msg)
 
     def getPalette(self):
         ''' Used to populate the pallete. '''
@@ -172,15 +581,26 @@ class MqttWidget(urwid.Pile):
             ('stale', 'light red', '', '', 'light red', ''),
         ]
 
-    def update(self, loop, data):
-        rows = []
+    def headerText(self):
+        def connected(broker):
+            if broker.connected:
+                return "Connected"
+            return "Disconnected"
+        if len(self.brokers) == 1:
+            return 'Mqtt(%s): %s' % (self.brokers[0].host, connected(self.brokers[0]))
+        return 'Mqtt: ' + ', '.join(['%s %s' % (broker.name, connected(broker)) for broker in self.brokers])
+
+    @instrument.timed('MqttWidget.update')
+    def update(self):
+        ''' Redraw the groups. Returns True if anything changed. '''
+        sig = (tuple([broker.connected for broker in self.brokers]), tuple([machine.signature() for machine in self.machines]))
+        if sig == self.drawn:
+            return False
+        self.drawn = sig
 
-        connected = "Disconnected"
-        if self.connected:
-            connected = "Connected"
-        rows.append((urwid.AttrMap(urwid.Text('Mqtt(%s): %s' % (self.host, connected)), 'title'), self.options()))
+        rows = []
 
-        self.stats_lock.acquire(True)
+        rows.append((urwid.AttrMap(urwid.Text(self.headerText()), 'title'), self.options()))
 
         if self.cols <= 1:
             for row in self.machines:
@@ -195,16 +615,46 @@ class MqttWidget(urwid.Pile):
             if cols:
                 rows.append((urwid.Columns(cols), self.options()))
 
-        self.stats_lock.release()
-
         self.contents = rows
-        loop.set_alarm_in(1.0, self.update)
-
-    def start(self, loop):
-        ''' Called to add the initial processes to the loop.'''
-        self.client.connect_async(self.params['host'], port=self.params['port'])
-        self.client.loop_start()
-        self.update(loop, None)
+        return True
+
+    def start(self, scheduler):
+        ''' Called to add the initial processes to the scheduler.'''
+        self.started = True
+        for broker in self.brokers:
+            broker.start()
+        scheduler.every(1.0, self.update, draw=True)
+        # so the rules know when each topic goes stale, even if it never shows up.
+        for machine in self.machines:
+            for message in machine.messages.values():
+                message.notify()
+
+    def getMetrics(self):
+        ''' Return (name, labels, value) samples for the brokers and every topic. '''
+        samples = []
+        labels = {}
+        for broker in self.brokers:
+            samples.append(('housemon_mqtt_connected', {'broker': broker.label}, int(broker.connected)))
+            labels[broker.name] = broker.label
+        for machine in self.machines:
+            samples += machine.getMetrics({'broker': labels.get(machine.broker)})
+        return samples
+
+    def getState(self):
+        ''' Return (key, fields) pairs for the brokers and every topic, for the web view. '''
+        state = []
+        for broker in self.brokers:
+            state.append((broker.key, {'ok': broker.connected, 'connected': broker.connected}))
+            for machine in self.machines:
+                if machine.broker == broker.name:
+                    state += machine.getState(broker.key)
+        return state
+
+    def getReplay(self):
+        ''' Return (kind, key, callback) for everything a recording can feed back in. '''
+        return [(recorder.MQTT, broker.key,
+                 lambda topic, payload, broker=broker: self.on_message(broker, LocalMessage(topic, payload)))
+                for broker in self.brokers]
 
     def getError(self):
         ''' return if there is a problem that I can detect. '''
@@ -213,5 +663,3 @@ class MqttWidget(urwid.Pile):
                 return "%s is not OK" % machine.name
 
         return None
-
-
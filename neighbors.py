@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+import collections
+import socket
+import struct
+import threading
+
+import instrument
+
+#########################################################
+# The kernel's neighbour table
+#########################################################
+
+# neighbour states, from linux/neighbour.h
+NUD_INCOMPLETE = 0x01
+NUD_REACHABLE = 0x02
+NUD_STALE = 0x04
+NUD_DELAY = 0x08
+NUD_PROBE = 0x10
+NUD_FAILED = 0x20
+NUD_NOARP = 0x40
+NUD_PERMANENT = 0x80
+
+STATE_NAMES = {NUD_INCOMPLETE: 'INCOMPLETE', NUD_REACHABLE: 'REACHABLE', NUD_STALE: 'STALE', NUD_DELAY: 'DELAY',
+               NUD_PROBE: 'PROBE', NUD_FAILED: 'FAILED', NUD_NOARP: 'NOARP', NUD_PERMANENT: 'PERMANENT'}
+
+# One entry. state is one of the NUD_ states.
+Neighbor = collections.namedtuple('Neighbor', ['ip', 'mac', 'state'])
+
+NETLINK_ROUTE = 0
+RTM_NEWNEIGH = 28
+RTM_GETNEIGH = 30
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NDA_DST = 1
+NDA_LLADDR = 2
+
+NLMSGHDR = struct.Struct('=IHHII')  # length, type, flags, sequence, port id
+NDMSG = struct.Struct('=BxxxiHBB')  # family, interface, state, flags, type
+RTATTR = struct.Struct('=HH')       # length, type
+
+def align(length):
+    return (length + 3) & ~3
+
+def macText(octets):
+    return ':'.join(['%02x' % o for o in bytearray(octets)])
+
+def dumpNetlink():
+    ''' {ip: Neighbor} for every IPv4 neighbour, from an RTM_GETNEIGH dump. Raises socket.error without netlink. '''
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+        sock.bind((0, 0))
+        body = NDMSG.pack(socket.AF_INET, 0, 0, 0, 0)
+        sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(body), RTM_GETNEIGH, NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + body)
+
+        table = {}
+        while True:
+            data = sock.recv(65536)
+            pos = 0
+            while pos + NLMSGHDR.size <= len(data):
+                length, type, flags, sequence, port = NLMSGHDR.unpack_from(data, pos)
+                if type == NLMSG_DONE:
+                    return table
+                if type == NLMSG_ERROR:
+                    raise socket.error("netlink refused the neighbour dump")
+                if type == RTM_NEWNEIGH:
+                    family, index, state, flags, kind = NDMSG.unpack_from(data, pos + NLMSGHDR.size)
+                    ip = mac = None
+                    attr = pos + NLMSGHDR.size + NDMSG.size
+                    while attr + RTATTR.size <= pos + length:
+                        attr_length, attr_type = RTATTR.unpack_from(data, attr)
+                        if attr_length < RTATTR.size:
+                            break
+                        value = data[attr + RTATTR.size:attr + attr_length]
+                        if attr_type == NDA_DST and len(value) == 4:
+                            ip = socket.inet_ntoa(value)
+                        elif attr_type == NDA_LLADDR:
+                            mac = macText(value)
+                        attr += align(attr_length)
+                    if ip:
+                        table[ip] = Neighbor(ip, mac, state)
+                if length == 0:
+                    break
+                pos += align(length)
+    finally:
+        sock.close()
+
+# /proc/net/arp flags
+ATF_COM = 0x2
+ATF_PERM = 0x4
+
+def readProc(filename='/proc/net/arp'):
+    '''
+    {ip: Neighbor}, from /proc/net/arp. It can't tell a fresh entry from a
+    stale one, so complete entries come back as STALE, and get pinged.
+    '''
+    table = {}
+    try:
+        with open(filename) as f:
+            lines = f.read().split('\n')[1:]
+    except (IOError, OSError):
+        return table
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 4:
+            continue
+        flags = int(fields[2], 16)
+        if flags & ATF_PERM:
+            state = NUD_PERMANENT
+        elif flags & ATF_COM:
+            state = NUD_STALE
+        else:
+            state = NUD_INCOMPLETE
+        table[fields[0]] = Neighbor(fields[0], fields[3], state)
+    return table
+
+# 'netlink' or 'proc', once the first read has found out which works here.
+source = None
+
+@instrument.timed('neighbors.read')
+def read():
+    ''' The whole table, in one go. Netlink if we have it, /proc/net/arp if not. '''
+    global source
+    if source != 'proc':
+        try:
+            table = dumpNetlink()
+            source = 'netlink'
+            return table
+        except (socket.error, AttributeError, struct.error):
+            # no AF_NETLINK on this system, or not allowed to use it.
+            source = 'proc'
+    return readProc()
+
+def alive(neighbor):
+    '''
+    True if the kernel has heard from it lately, so a ping wouldn't tell us
+    anything new. Everything else, missing, STALE or on its way to FAILED,
+    still needs a ping.
+    '''
+    return neighbor is not None and neighbor.state == NUD_REACHABLE
+
+class Snapshot(object):
+    '''
+    The table, read the first time something is looked up in it, then kept.
+    One is made for each round, so all the pings that fail in it share one read.
+    '''
+    def __init__(self):
+        self.table = None
+        self.lock = threading.Lock()
+
+    def get(self, ip):
+        self.lock.acquire(True)
+        if self.table is None:
+            self.table = read()
+        self.lock.release()
+        return self.table.get(ip)
+
+if __name__ == '__main__':
+    table = read()
+    print('%d neighbours, from %s' % (len(table), source))
+    for ip in sorted(table.keys(), key=lambda ip: socket.inet_aton(ip)):
+        neighbor = table[ip]
+        print('%-16s %-18s %s' % (ip, neighbor.mac or '-', STATE_NAMES.get(neighbor.state, neighbor.state)))
@@ -1,21 +1,34 @@
 #!/usr/bin/env python
 
 import sys
-import commands
+import collections
 import socket
+import subprocess
 import threading
 import urwid
 
+import alerts
+import instrument
+import neighbors
+import recorder
+import sysinfo
+
 #########################################################
 # Simple utilities
 #########################################################
 
-def Ping(host):
-    """
-    Ping the host, to determine upiness.
-    """
-    command = "ping -c 1 -w 1 -W 1 " + host
-    (rv, text) = commands.getstatusoutput(command)
+def isIpv6(ip):
+    return ip is not None and ':' in ip
+
+def PingCommand(ip):
+    ''' The ping command line for an address, of either family. '''
+    command = ['ping', '-c', '1', '-w', '1', '-W', '1', ip]
+    if isIpv6(ip):
+        command.insert(1, '-6')
+    return command
+
+def ParsePing(rv, text):
+    ''' (ok, time) from ping's exit status and output. '''
     time = None
     for line in text.split('\n'):
         for word in line.split():
@@ -25,38 +38,85 @@ def Ping(host):
     ok = rv == 0
     return (ok, time)
 
-def HostByName(name):
+@instrument.timed('pinger.ping')
+def PingAll(ips):
     """
-    returns the ip (as a string) of the host you are trying to find.
+    Ping every address at once, one ping process each, and wait for all of them.
+    Returns an (ok, time) for each address, in order. A v4 and a v6 address take
+    as long as the slower of the two, not both.
+    """
+    procs = []
+    for ip in ips:
+        try:
+            procs.append(subprocess.Popen(PingCommand(ip), stdout=subprocess.PIPE, stderr=subprocess.STDOUT))
+        except OSError:
+            procs.append(None)
+
+    results = []
+    for proc in procs:
+        if proc is None:
+            results.append((False, None))
+            continue
+        text = proc.communicate()[0]
+        results.append(ParsePing(proc.returncode, text))
+    return results
+
+def Ping(host):
+    """
+    Ping the host, to determine upiness.
+    """
+    return PingAll([host])[0]
+
+@instrument.timed('pinger.dns')
+def Resolve(name):
+    """
+    returns (v4, v6): the ips (as strings) of the host you are trying to find,
+    either of which can be None. getaddrinfo asks for the A and AAAA records at
+    the same time. Link local v6 addresses are skipped, they can't be pinged
+    without knowing the interface.
     """
     try:
-        return socket.gethostbyname(name)
-    except socket.gaierror:
-        return None
+        infos = socket.getaddrinfo(name, None, socket.AF_UNSPEC, socket.SOCK_DGRAM)
+    except (socket.gaierror, socket.herror, UnicodeError):
+        return (None, None)
+
+    v4 = None
+    v6 = None
+    for family, socktype, proto, canonname, sockaddr in infos:
+        if family == socket.AF_INET and v4 is None:
+            v4 = sockaddr[0]
+        elif family == socket.AF_INET6 and v6 is None and not sockaddr[0].lower().startswith('fe80:'):
+            v6 = sockaddr[0]
+    return (v4, v6)
+
+def Stats(ips, callback):
+    """
+    Ping the ips together, and call the callback with each one's results.
+    """
+    for ip, (rv, time) in zip(ips, PingAll(ips)):
+        callback(None, ip, rv, time)
 
 def IpAsync(host, callback):
     """
-    Call the callback when the results are back from the query.
+    Call the callback when the results are back from the query, once for each
+    family the host has an address in.
     """
     def do(host, callback):
-        ip = HostByName(host)
-        if ip:
-            StatsAsync(ip, callback)
+        ips = [ip for ip in Resolve(host) if ip]
+        if ips:
+            Stats(ips, callback)
 
     t = threading.Thread(target=do, args=(host, callback))
     t.setDaemon(True)
     t.start()
     return t
 
-def StatsAsync(ip, callback):
+def StatsAsync(ips, callback):
     """
-    Call the callback when the results are back from the query.
+    Call the callback when the results are back from the query. All of the ips
+    are pinged at once, from the one thread.
     """
-    def do(ip, callback):
-        rv, time = Ping(ip)
-        callback(None, ip, rv, time)
-
-    t = threading.Thread(target=do, args=(ip, callback))
+    t = threading.Thread(target=Stats, args=(ips, callback))
     t.setDaemon(True)
     t.start()
     return t
@@ -65,6 +125,16 @@ def StatsAsync(ip, callback):
 # Display stuff
 #########################################################
 
+# What the pinger knows about an endpoint. These are replaced, never changed, so
+# the display can read one without locking, and always gets a consistent set.
+# seen is True when the neighbour table vouched for it instead of a ping. ip, ping
+# and history are v4, and ip6, ping6 and history6 the same for v6.
+EndpointState = collections.namedtuple('EndpointState', ['ip', 'ping', 'history', 'seen', 'ip6', 'ping6', 'history6'])
+NetworkState = collections.namedtuple('NetworkState', ['ping_ip', 'lookup', 'ping_ip6', 'lookup6'])
+
+# how many ping results are kept for the loss rate.
+HISTORY = 20
+
 class Endpoint(object):
     '''
     Widget that displays information about a single "computer" or network interface.
@@ -75,23 +145,43 @@ class Endpoint(object):
         '''
         Init
         Attributes read from the map:
-            :host: The hostname of the endpoint.
+            :host: The hostname of the endpoint. Both of its addresses are pinged, if it has a v4 and a v6 one.
             :ip: The ip address (v4) if the hostname won't resolve.
+            :ip6: The ip address (v6) if the hostname won't resolve.
+            :agent: The name of the remote agent that probes this endpoint.
+            :passive: True to believe the neighbour table instead of pinging, when it can.
+                Defaults to the network map's neighbors setting.
         '''
         self.host = None
         if 'host' in map.keys():
             self.host = map['host']
 
-        self.ip = None
+        ip = None
         if 'ip' in map.keys():
-            self.ip = map['ip']
+            ip = map['ip']
+
+        ip6 = None
+        if 'ip6' in map.keys():
+            ip6 = map['ip6']
 
         self.optional = None
         if 'optional' in map.keys():
             self.optional = map['optional']
 
-        self.ping = None
-        self.stats_lock = threading.Lock()
+        self.agent = None
+        if 'agent' in map.keys():
+            self.agent = map['agent']
+
+        self.passive = None
+        if 'passive' in map.keys():
+            self.passive = map['passive']
+
+        # unique name in the map, set by the map.
+        self.key = None
+
+        self.state = EndpointState(ip, None, (), False, ip6, None, ())
+        # both families, and the neighbour table, answer on different threads.
+        self.write_lock = instrument.TimedLock('Endpoint.write_lock')
 
         # this is used to draw multiple endpoints with different background colors
         self.row = ''
@@ -102,61 +192,204 @@ class Endpoint(object):
         if not host:
             host = self.host
 
-        self.stats_lock.acquire(True)
+        state = self.state
         cols = []
         if host:
             cols.append(urwid.Text(host))
         else:
             cols.append(urwid.Text(self.host))
-        cols.append(urwid.Text('IP: %s' % self.ip))
-        if self.ping:
-            if float(self.ping) > 100.0:
-                cols.append(urwid.AttrMap(urwid.Text('Ping: %sms' % self.ping), 'awful_ping' + self.row))
-            elif float(self.ping) > 10.0:
-                cols.append(urwid.AttrMap(urwid.Text('Ping: %sms' % self.ping), 'slow_ping' + self.row))
-            elif float(self.ping) > 1.0:
-                cols.append(urwid.AttrMap(urwid.Text('Ping: %sms' % self.ping), 'ok_ping' + self.row))
+        # a line for each family it has an address in, the v6 one under the v4 one.
+        rows = []
+        if state.ip or not state.ip6:
+            cols.append(urwid.Text('IP: %s' % state.ip))
+            if state.seen and not state.ping:
+                cols.append(urwid.AttrMap(urwid.Text('Ping: (neighbor)'), 'ok_ping' + self.row))
             else:
-                cols.append(urwid.AttrMap(urwid.Text('Ping: %sms' % self.ping), 'fast_ping' + self.row))
-
+                cols.append(self.drawPing('Ping', state.ping))
+            rows.append(urwid.Columns(cols))
+            cols = [urwid.Text('')]
+        if state.ip6:
+            cols.append(urwid.Text('IPv6: %s' % state.ip6))
+            cols.append(self.drawPing('Ping6', state.ping6))
+            rows.append(urwid.Columns(cols))
+
+        if len(rows) == 1:
+            w = rows[0]
         else:
-            cols.append(urwid.Text('Ping: None'))
-
-        w = urwid.Columns(cols)
-        if None == self.ping:
+            w = urwid.Pile(rows)
+        if not self.answers():
             if self.optional:
                 w = urwid.AttrMap(w, 'optional' + self.row)
             else:
                 w = urwid.AttrMap(w, 'warn' + self.row)
         else:
             w = urwid.AttrMap(w, 'ok' + self.row)
-        self.stats_lock.release()
         return w
 
-    def getData(self):
-        ''' Start the process of updating the statistics for this endpoint. '''
-        if self.host and not self.ip:
-            IpAsync(self.host, self.stats_cb)
+    def drawPing(self, label, ping):
+        ''' The ping time, colored by how slow it is. '''
+        if not ping:
+            return urwid.Text('%s: None' % label)
+        if float(ping) > 100.0:
+            color = 'awful_ping'
+        elif float(ping) > 10.0:
+            color = 'slow_ping'
+        elif float(ping) > 1.0:
+            color = 'ok_ping'
+        else:
+            color = 'fast_ping'
+        return urwid.AttrMap(urwid.Text('%s: %sms' % (label, ping)), color + self.row)
+
+    @property
+    def ip(self):
+        return self.state.ip
+
+    @property
+    def ping(self):
+        return self.state.ping
+
+    @property
+    def ip6(self):
+        return self.state.ip6
+
+    def setKey(self, path):
+        ''' Name this endpoint, and return the name. '''
+        self.key = '%s/%s' % (path, self.host or self.ip or self.ip6)
+        return self.key
+
+    def getData(self, agent=None, seen=(), table=None):
+        '''
+        Start the process of updating the statistics for this endpoint.
+            :agent: The agent we are. Only endpoints that belong to it get probed.
+            :seen: keys the neighbour table already vouched for this time, which aren't pinged.
+            :table: a neighbors.Snapshot shared by this round, for passive endpoints whose ping fails.
+        '''
+        if self.agent != agent or self.key in seen:
+            return
+
+        callback = self.stats_cb
+        if self.passive and not agent:
+            if table is None:
+                table = neighbors.Snapshot()
+            callback = lambda host, ip, rv, time: self.passive_cb(host, ip, rv, time, table)
+
+        # one thread for both families. Their pings go out together.
+        ips = [ip for ip in (self.ip, self.ip6) if ip]
+        if self.host and not ips:
+            IpAsync(self.host, callback)
 
-        if self.ip:
-            StatsAsync(self.ip, self.stats_cb)
+        if ips:
+            StatsAsync(ips, callback)
 
     # callback
+    def passive_cb(self, host, ip, rv, time, table):
+        ''' Like stats_cb, but a lost ping that got an ARP answer still counts. Phones do that. '''
+        if not rv and not isIpv6(ip) and neighbors.alive(table.get(ip)):
+            self.neighbor_cb(ip)
+        else:
+            self.stats_cb(host, ip, rv, time)
+
+    # callback
+    @instrument.timed('Endpoint.stats_cb')
     def stats_cb(self, host, ip, rv, time):
-        ''' Gets called when the pinger returns some results. '''
-        self.stats_lock.acquire(True)
-        self.ip = ip
-        if rv:
-            self.ping = time
+        ''' Gets called when the pinger returns some results, once for each family. '''
+        recorder.observe(recorder.PING, self.key, ip, rv, time)
+        if not rv:
+            time = None
+        self.write_lock.acquire(True)
+        state = self.state
+        if isIpv6(ip):
+            history = (state.history6 + (bool(rv),))[-HISTORY:]
+            self.state = state._replace(ip6=ip, ping6=time, history6=history)
         else:
-            self.ping = None
-        self.stats_lock.release()
+            history = (state.history + (bool(rv),))[-HISTORY:]
+            self.state = state._replace(ip=ip, ping=time, history=history, seen=False)
+        self.write_lock.release()
+        self.notify()
+
+    def notify(self):
+        ''' Tell the rules how it's doing, over whichever family is doing better. '''
+        state = self.state
+        history = state.history
+        if self.lossOf(state.history6) < self.lossOf(history):
+            history = state.history6
+        alerts.notify(self.key, {'ok': self.answers(), 'ping': state.ping or state.ping6, 'optional': bool(self.optional),
+                                 'loss': self.lossOf(history),
+                                 'name': getattr(self, 'name', None) or self.host or state.ip or state.ip6})
+
+    @staticmethod
+    def lossOf(history):
+        if not history:
+            return 1.0
+        return 1.0 - float(sum(history)) / len(history)
+
+    # callback
+    def neighbor_cb(self, ip):
+        ''' Gets called when the neighbour table says it's there, instead of a ping. '''
+        recorder.observe(recorder.NEIGHBOR, self.key, ip)
+        self.write_lock.acquire(True)
+        history = (self.state.history + (True,))[-HISTORY:]
+        self.state = self.state._replace(ip=ip, ping=None, history=history, seen=True)
+        self.write_lock.release()
+        self.notify()
+
+    def answers(self):
+        ''' True if it answered over either family, or the neighbour table vouched for it. '''
+        state = self.state
+        return state.ping != None or state.seen or state.ping6 != None
 
     def ok(self):
-        self.stats_lock.acquire(True)
-        ok = self.ping != None
-        self.stats_lock.release()
-        return ok
+        return self.answers()
+
+    def getMetrics(self, name=None):
+        ''' Return (name, labels, value) samples for this endpoint. '''
+        if not name:
+            name = self.host
+
+        state = self.state
+        # a series for each family, told apart by the ip label.
+        families = []
+        if state.ip or not state.ip6:
+            families.append((state.ip, state.ping, state.history, state.seen))
+        if state.ip6:
+            families.append((state.ip6, state.ping6, state.history6, False))
+
+        samples = []
+        for ip, ping, history, seen in families:
+            labels = {'host': name or ip, 'ip': ip or ''}
+
+            rtt = None
+            if ping is not None:
+                rtt = float(ping) / 1000.0
+            loss = None
+            if history:
+                loss = history.count(False) / float(len(history))
+
+            samples += [
+                ('housemon_endpoint_up', labels, int(ping is not None or seen)),
+                ('housemon_endpoint_rtt_seconds', labels, rtt),
+                ('housemon_endpoint_loss_ratio', labels, loss),
+            ]
+        return samples
+
+    def getState(self):
+        ''' Return (key, fields) pairs describing this endpoint, for the web view. '''
+        state = self.state
+        fields = {'ip': state.ip, 'ping': state.ping, 'ip6': state.ip6, 'ping6': state.ping6, 'ok': self.answers(),
+                  'optional': bool(self.optional)}
+        return [(self.key, fields)]
+
+    def getResult(self):
+        ''' The (key, ip, ping) result that an agent sends for this endpoint, with (ip6, ping6) on the end if it has one. '''
+        state = self.state
+        if state.ip6:
+            return (self.key, state.ip, state.ping, state.ip6, state.ping6)
+        return (self.key, state.ip, state.ping)
+
+    def signature(self):
+        ''' Something that changes whenever the drawing would. '''
+        state = self.state
+        return (state.ip, state.ping, state.seen, state.ip6, state.ping6)
 
     def getError(self):
         return None
@@ -174,9 +407,18 @@ class Switch(Endpoint):
             :children: a list of Switch or Endpoint children that are connected only because of this switch
             :host: The hostname if this is a router. None if this is an unmanaged switch
             :ip: The ip address (v4) if the hostname won't resolve.
+            :ip6: The ip address (v6) if the hostname won't resolve.
+            :snmp: {community, port, ports, errors} to poll its interface counters. See snmp.Device.
         '''
         Endpoint.__init__(self, map)
 
+        self.snmp = None
+        if 'snmp' in map.keys() and (self.host or self.ip):
+            # only imported by maps that use it.
+            import snmp
+            self.snmp = snmp.Device(self.host or self.ip, map['snmp'] or {})
+            self.snmp.ip = self.ip
+
         self.name = None
         if 'name' in map.keys():
             self.name = map['name']
@@ -197,6 +439,10 @@ class Switch(Endpoint):
         i = 0
         if 'children' in map.keys():
             for child_map in map['children']:
+                # children are probed by the same agent as their switch, unless they say otherwise.
+                if self.agent and 'agent' not in child_map.keys():
+                    child_map = dict(child_map, agent=self.agent)
+
                 if 'children' in child_map.keys():
                     self.children.append(Switch(child_map))
                 else:
@@ -204,25 +450,73 @@ class Switch(Endpoint):
                     self.children[-1].row = '_%d' % (i % 2)
                     i += 1
 
-    def getData(self):
+    def setKey(self, path):
+        self.key = '%s/%s' % (path, self.name or self.host or self.ip or self.ip6)
+        if self.snmp:
+            self.snmp.key = self.key
+            self.snmp.name = self.name or self.host or self.ip
+        for child in self.children:
+            child.setKey(self.key)
+        return self.key
+
+    def walk(self):
+        ''' This switch, and everything under it. '''
+        yield self
+        for child in self.children:
+            if isinstance(child, Switch):
+                for endpoint in child.walk():
+                    yield endpoint
+            else:
+                yield child
+
+    def getData(self, agent=None, seen=(), table=None):
         ''' Start the process of updating the statistics for this switch. '''
-        Endpoint.getData(self)
+        if self.host or self.ip or self.ip6:
+            Endpoint.getData(self, agent, seen, table)
         for child in self.children:
-            child.getData()
+            child.getData(agent, seen, table)
+
+    def stats_cb(self, host, ip, rv, time):
+        Endpoint.stats_cb(self, host, ip, rv, time)
+        # the poller's socket is v4.
+        if self.snmp and ip and not isIpv6(ip):
+            self.snmp.ip = ip
 
     def drawHeader(self):
         ''' Return the widget that draws at the top of the widget and represents this switch's status. '''
         pile = urwid.Pile([])
-        if self.host or self.ip:
+        if self.host or self.ip or self.ip6:
             pile.contents.append((Endpoint.draw(self, host=self.name), pile.options()))
         else:
             pile.contents.append((urwid.AttrMap(urwid.Text(self.name), 'title'), pile.options()))
 
+        if self.snmp:
+            for port in self.snmp.shown():
+                pile.contents.append((self.drawPort(port), pile.options()))
+
         if self.divider:
             pile.contents.append((urwid.Divider(u'\u2500'), pile.options()))
 
         return pile
 
+    def drawPort(self, port):
+        ''' One row of traffic and errors for a port, from the last SNMP poll. '''
+        errors = None
+        if port.in_error_rate is not None or port.out_error_rate is not None:
+            errors = (port.in_error_rate or 0.0) + (port.out_error_rate or 0.0)
+        cols = [urwid.Text(u'  %s' % port.name),
+                urwid.Text(u'rx %s' % sysinfo.rateText(port.rx_rate)),
+                urwid.Text(u'tx %s' % sysinfo.rateText(port.tx_rate))]
+        if errors:
+            cols.append(urwid.AttrMap(urwid.Text(u'errors %0.1f/s' % errors),
+                                      'warn' if errors > self.snmp.errors else 'slow_ping'))
+        else:
+            cols.append(urwid.Text(u'errors 0'))
+        w = urwid.Columns(cols)
+        if not port.up:
+            return urwid.AttrMap(w, 'optional')
+        return w
+
     def draw(self):
         ''' Return the widget that describes this switch, and all of it's children. '''
         widgets = [self.drawHeader()]
@@ -256,6 +550,45 @@ class Switch(Endpoint):
 
         return False
 
+    def signature(self):
+        polled = self.snmp and self.snmp.state.time
+        return (Endpoint.signature(self), polled, tuple([child.signature() for child in self.children]))
+
+    def getMetrics(self):
+        samples = []
+        if self.host or self.ip or self.ip6:
+            samples += Endpoint.getMetrics(self, name=self.name)
+        if self.snmp:
+            state = self.snmp.state
+            name = self.name or self.host or self.ip
+            samples.append(('housemon_snmp_up', {'host': name}, state.ok and 1 or 0))
+            for port in state.ports:
+                labels = {'host': name, 'port': port.name}
+                samples += [
+                    ('housemon_port_up', labels, int(port.up)),
+                    ('housemon_port_receive_bytes_per_second', labels, port.rx_rate),
+                    ('housemon_port_transmit_bytes_per_second', labels, port.tx_rate),
+                    ('housemon_port_errors_per_second', dict(labels, direction='in'), port.in_error_rate),
+                    ('housemon_port_errors_per_second', dict(labels, direction='out'), port.out_error_rate),
+                ]
+        for child in self.children:
+            samples += child.getMetrics()
+        return samples
+
+    def getState(self):
+        if self.host or self.ip or self.ip6:
+            state = Endpoint.getState(self)
+        else:
+            state = [(self.key, {'ok': self.ok()})]
+        if self.snmp:
+            for port in self.snmp.shown():
+                state.append(('%s/port/%s' % (self.key, port.name),
+                              {'ok': port.up, 'rx': port.rx_rate, 'tx': port.tx_rate,
+                               'in_errors': port.in_error_rate, 'out_errors': port.out_error_rate}))
+        for child in self.children:
+            state += child.getState()
+        return state
+
     def getError(self):
         for child in self.children:
             err = child.getError()
@@ -276,46 +609,157 @@ class NetworkMap(urwid.Pile):
         '''
         urwid.Pile.__init__(self, [])
 
+        self.children = []
+        # every endpoint, by key.
+        self.index = {}
+        self.ip = None
+        self.ip6 = None
+        self.host = None
+
+        # the broker that remote agents report through.
+        self.agents = None
+        self.agentListener = None
+        if 'agents' in map.keys():
+            self.agents = map['agents']
+
+        self.state = NetworkState(None, None, None, None)
+        # the ping and the lookup come back on different threads, and both update
+        # the state. Only they take this, never the display.
+        self.write_lock = instrument.TimedLock('NetworkMap.write_lock')
+
+        # what the display was last drawn from
+        self.drawn = None
+
+        # polls the switches with snmp, if any do.
+        self.poller = None
+        self.started = False
+
+        # endpoints the neighbour table can vouch for, and how many it did last time.
+        self.passive = []
+        self.neighbors_seen = None
+
+        self.reconfigure(map)
+
+    def reconfigure(self, map):
+        '''
+        Build the map from its config. When the config changes, this is called
+        again, and endpoints that are still there (by key) keep what we know about them.
+        Returns None, or what can't be changed without a restart.
+        '''
         if not 'net_ip' in map.keys() or \
            not 'net_host' in map.keys() or \
            not 'routers' in map.keys():
             raise InputError("This isn't configured properly. It's probably my fault, sorry. I give up.")
 
-        self.children = []
+        children = []
         for router_map in map['routers']:
-            self.children.append(Switch(router_map))
-
+            children.append(Switch(router_map))
+            children[-1].setKey('network')
+
+        index = {}
+        passive = []
+        for child in children:
+            for endpoint in child.walk():
+                if endpoint.passive is None:
+                    endpoint.passive = map.get('neighbors', False)
+                if endpoint.passive and not endpoint.agent and (endpoint.host or endpoint.ip):
+                    passive.append(endpoint)
+                old = self.index.get(endpoint.key)
+                if old is not None and old.host == endpoint.host and endpoint.ip in [None, old.ip] and \
+                   endpoint.ip6 in [None, old.ip6]:
+                    endpoint.state = old.state
+                    if getattr(old, 'snmp', None) and getattr(endpoint, 'snmp', None):
+                        endpoint.snmp.state = old.snmp.state
+                        endpoint.snmp.last = old.snmp.last
+                        endpoint.snmp.ip = endpoint.snmp.ip or old.snmp.ip
+                index[endpoint.key] = endpoint
+
+        if (self.ip, self.ip6, self.host) != (map['net_ip'], map.get('net_ip6'), map['net_host']):
+            self.write_lock.acquire(True)
+            self.state = NetworkState(None, None, None, None)
+            self.write_lock.release()
         self.ip = map['net_ip']
+        # an internet address to ping over v6 too, if there is one.
+        self.ip6 = map.get('net_ip6')
         self.host = map['net_host']
 
-        self.ping_ip = None
-        self.lookup = None
-        self.stats_lock = threading.Lock()
+        # swapped in last, so the agents and the display only ever see a whole map.
+        for key in self.index.keys():
+            if key not in index:
+                alerts.notify(key, None)
+        self.children = children
+        self.index = index
+        self.passive = passive
+        self.drawn = None
+
+        if self.poller:
+            self.poller.devices = self.snmpDevices()
+        self.snmp_interval = float(map.get('snmp_interval', 30.0))
+
+        if map.get('agents') != self.agents:
+            return "The network map's agents can't be changed without a restart."
+        if self.snmpDevices() and not self.poller and self.started:
+            return "SNMP polling can't be turned on without a restart."
+        return None
+
+    def snmpDevices(self):
+        ''' The switches to poll. The ones an agent probes aren't reachable from here. '''
+        devices = []
+        for key, endpoint in sorted(self.index.items()):
+            if getattr(endpoint, 'snmp', None) and not endpoint.agent:
+                devices.append(endpoint.snmp)
+        return devices
 
     def drawHeader(self):
         ''' Return the widget that draws at the top of the widget and represents this switch's status. '''
 
-        self.stats_lock.acquire(True)
+        state = self.state
         cols = []
         # cols.append(urwid.Text('Network Map'))
-        if self.ping_ip:
-            cols.append(urwid.AttrMap(urwid.Text('Connection: GOOD (%s: %s)' % (self.ip, self.ping_ip)), 'ok'))
+        if state.ping_ip:
+            cols.append(urwid.AttrMap(urwid.Text('Connection: GOOD (%s: %s)' % (self.ip, state.ping_ip)), 'ok'))
         else:
             cols.append(urwid.AttrMap(urwid.Text('Connection: BAD (%s)' % (self.ip)), 'warn'))
 
-        if self.lookup:
-            cols.append(urwid.AttrMap(urwid.Text('DNS: GOOD (%s->%s)' % (self.host, self.lookup)), 'ok'))
+        if self.ip6:
+            if state.ping_ip6:
+                cols.append(urwid.AttrMap(urwid.Text('IPv6: GOOD (%s: %s)' % (self.ip6, state.ping_ip6)), 'ok'))
+            else:
+                cols.append(urwid.AttrMap(urwid.Text('IPv6: BAD (%s)' % (self.ip6)), 'warn'))
+
+        lookups = [ip for ip in (state.lookup, state.lookup6) if ip]
+        if lookups:
+            cols.append(urwid.AttrMap(urwid.Text('DNS: GOOD (%s->%s)' % (self.host, ', '.join(lookups))), 'ok'))
         else:
             cols.append(urwid.AttrMap(urwid.Text('DNS: BAD (%s)' % (self.host)), 'warn'))
 
         w = urwid.Columns(cols)
-        if None == self.ping_ip or None == self.lookup:
+        if None == self.internet() or None == self.dns():
             w = urwid.AttrMap(w, 'warn')
         else:
             w = urwid.AttrMap(w, 'ok')
-        self.stats_lock.release()
         return w
 
+    @property
+    def ping_ip(self):
+        return self.state.ping_ip
+
+    @property
+    def lookup(self):
+        return self.state.lookup
+
+    def internet(self):
+        ''' The ping time to the internet, over whichever family answered. None if neither did. '''
+        state = self.state
+        if state.ping_ip is not None:
+            return state.ping_ip
+        return state.ping_ip6
+
+    def dns(self):
+        ''' What the internet host resolved to, in either family. None if it didn't. '''
+        state = self.state
+        return state.lookup or state.lookup6
+
 
     def getPalette(self):
         ''' Used to populate the pallete. '''
@@ -344,16 +788,42 @@ class NetworkMap(urwid.Pile):
 
         return palette
 
-    def getData(self, loop, user_data):
-        ''' Start updating each endpoint's data '''
+    @instrument.timed('NetworkMap.getData')
+    def getData(self, agent=None):
+        '''
+        Start updating each endpoint's data
+            :agent: The agent we are. Only its endpoints are probed, and the internet is left to the display.
+        '''
+        seen = ()
+        # read again, at most once, after the pings go out, since they're what gets the ARP answers.
+        table = neighbors.Snapshot()
+        if not agent and self.passive:
+            seen = self.checkNeighbors()
+
         for child in self.children:
-            child.getData()
+            child.getData(agent, seen, table)
+
+        if agent:
+            return
 
         IpAsync(self.host, self.lookup_cb)
 
-        StatsAsync(self.ip, self.ping_cb)
+        StatsAsync([ip for ip in (self.ip, self.ip6) if ip], self.ping_cb)
 
-        loop.set_alarm_in(15.0, self.getData)
+    def checkNeighbors(self):
+        '''
+        Read the kernel's neighbour table once, and mark the passive endpoints
+        it has heard from lately as up. Returns their keys, so they aren't pinged.
+        '''
+        table = neighbors.read()
+        seen = set()
+        for endpoint in self.passive:
+            ip = endpoint.ip
+            if ip and neighbors.alive(table.get(ip)):
+                endpoint.neighbor_cb(ip)
+                seen.add(endpoint.key)
+        self.neighbors_seen = len(seen)
+        return seen
 
     def getError(self):
         ''' Return a human readable string of some normal problems. '''
@@ -368,48 +838,121 @@ class NetworkMap(urwid.Pile):
             if err:
                 return err
 
-        if self.ping_ip == None:
+        if self.internet() == None:
             return "The Intenet is missing. Check for zombies. Better yet, stay inside."
 
-        if self.lookup == None:
+        if self.dns() == None:
             return "There is a problem with name lookups on the Internet. Stupid IT guy."
 
+        if self.agentListener:
+            err = self.agentListener.getError()
+            if err:
+                return err
+
         # I can't diagnose more complicated problems.
         return None
 
     # callback
     def ping_cb(self, host, ip, rv, time):
         ''' Gets called when the pinger returns some results. '''
-        self.stats_lock.acquire(True)
-        if rv:
-            self.ping_ip = time
+        recorder.observe(recorder.INTERNET, 'network', ip, rv, time)
+        if not rv:
+            time = None
+        self.write_lock.acquire(True)
+        if isIpv6(ip):
+            self.state = self.state._replace(ping_ip6=time)
         else:
-            self.ping_ip = None
-        self.stats_lock.release()
+            self.state = self.state._replace(ping_ip=time)
+        self.write_lock.release()
+        alerts.notify('network', {'internet': self.internet()})
 
     def lookup_cb(self, host, ip, rv, time):
         ''' Gets called when the nslookup and ping return. '''
-        self.stats_lock.acquire(True)
-        if rv:
-            self.lookup = ip
+        recorder.observe(recorder.DNS, 'network', ip, rv, time)
+        family = isIpv6(ip)
+        if not rv:
+            ip = None
+        self.write_lock.acquire(True)
+        if family:
+            self.state = self.state._replace(lookup6=ip)
         else:
-            self.lookup = None
-        self.stats_lock.release()
+            self.state = self.state._replace(lookup=ip)
+        self.write_lock.release()
+        alerts.notify('network', {'dns': self.dns()})
+
+    def getMetrics(self):
+        ''' Return (name, labels, value) samples for the whole map. '''
+        state = self.state
+        samples = [
+            ('housemon_internet_up', {'ip': self.ip}, int(state.ping_ip is not None)),
+            ('housemon_dns_up', {'host': self.host}, int(self.dns() is not None)),
+        ]
+        if self.ip6:
+            samples.append(('housemon_internet_up', {'ip': self.ip6}, int(state.ping_ip6 is not None)))
+        if self.passive:
+            samples.append(('housemon_neighbors_seen', {}, self.neighbors_seen))
+        for child in self.children:
+            samples += child.getMetrics()
+        return samples
+
+    def getState(self):
+        ''' Return (key, fields) pairs for the whole map, for the web view. '''
+        current = self.state
+        state = [('network', {'internet': current.ping_ip, 'dns': current.lookup,
+                              'internet6': current.ping_ip6, 'dns6': current.lookup6,
+                              'ok': self.internet() is not None and self.dns() is not None})]
+        for child in self.children:
+            state += child.getState()
+        return state
+
+    def getReplay(self):
+        ''' Return (kind, key, callback) for everything a recording can feed back in. '''
+        replay = [
+            (recorder.INTERNET, 'network', lambda ip, rv, time: self.ping_cb(None, ip, rv, time)),
+            (recorder.DNS, 'network', lambda ip, rv, time: self.lookup_cb(None, ip, rv, time)),
+        ]
+        for key, endpoint in self.index.items():
+            replay.append((recorder.PING, key, lambda ip, rv, time, endpoint=endpoint: endpoint.stats_cb(None, ip, rv, time)))
+            replay.append((recorder.NEIGHBOR, key, endpoint.neighbor_cb))
+        return replay
+
+    def signature(self):
+        state = self.state
+        sig = tuple(state)
+        return (sig, tuple([child.signature() for child in self.children]))
+
+    @instrument.timed('NetworkMap.draw')
+    def draw(self):
+        ''' This updates the widgets used in the pinger part of the display. Returns True if anything changed. '''
+        sig = self.signature()
+        if sig == self.drawn:
+            return False
+        self.drawn = sig
 
-    def draw(self, loop, data):
-        ''' This updates the widgets used in the pinger part of the display. '''
         machine_texts = []
 
         machine_texts.append((self.drawHeader(), self.options()))
         for child in self.children:
             machine_texts.append((child.draw(), self.options()))
         self.contents = machine_texts
-        loop.set_alarm_in(0.5, self.draw)
+        return True
+
+    def start(self, scheduler):
+        ''' Called to add the initial processes to the scheduler.'''
+        self.started = True
+        scheduler.every(15.0, self.getData, priority=1, probe=True)
+        scheduler.every(0.5, self.draw, draw=True)
 
-    def start(self, loop):
-        ''' Called to add the initial processes to the loop.'''
-        self.getData(loop, None)
-        self.draw(loop, None)
+        devices = self.snmpDevices()
+        if devices:
+            import snmp
+            self.poller = snmp.Poller(devices, self.snmp_interval)
+            self.poller.start(scheduler)
+
+        if self.agents:
+            import agent
+            self.agentListener = agent.AgentListener(self, self.agents)
+            self.agentListener.start(scheduler)
 
 if __name__ == '__main__':
     # some test code
@@ -418,9 +961,14 @@ if __name__ == '__main__':
     def cb(host, ip, rv, time):
         print host,ip,rv,time
 
+    # one ping, the plain way.
+    for host in sys.argv[1:]:
+        print host, Ping(host)
+
+    # and the way the map does it, looked up first, over both families.
     threads = []
     for host in sys.argv[1:]:
-        threads.append(StatsAsync(host, cb))
+        threads.append(IpAsync(host, cb))
 
     print 'spawned everything'
 
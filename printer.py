@@ -2,10 +2,14 @@
 
 import json
 import urllib2
-import time
 import threading
 import urwid
 
+import alerts
+import instrument
+import recorder
+
+@instrument.timed('printer.fetch')
 def ReadData(url):
     """ Read data from the printer. """
     try:
@@ -28,18 +32,35 @@ def ReadDataAsync(url, callback):
 # Display stuff
 #########################################################
 
+def UnknownStats(last_update):
+    ''' The stats for a printer that isn't answering. '''
+    return {
+        'state': { 'text': 'Unknown' },
+        'temperature': { 'bed': {"actual": 0.0, "target": 0.0},
+                         'tool0': {"actual": 0.0, "target": 0.0}},
+        'last_update': last_update,
+    }
+
 class PrinterWidget(urwid.Pile):
     ''' Class used to draw the data from the Printer. '''
     def __init__(self, params):
         urwid.Pile.__init__(self, [])
         self.machine = params['host']
         self.key = params['key']
-        self.stats = {}
-        self.stats['state'] = { 'text': 'Unknown' }
-        self.stats['temperature'] = { 'bed': {"actual": 0.0, "target": 0.0},
-                                    'tool0': {"actual": 0.0, "target": 0.0}}
-        self.stats['last_update'] = time.time()
-        self.stats_lock = threading.Lock()
+        # Replaced, never changed, so the display can read it without a lock.
+        self.stats = UnknownStats(recorder.now())
+
+        # what the display was last drawn from
+        self.drawn = None
+
+    def reconfigure(self, params):
+        ''' Change to a new config. Returns None. '''
+        if params['host'] != self.machine:
+            self.stats = UnknownStats(recorder.now())
+            self.drawn = None
+        self.machine = params['host']
+        self.key = params['key']
+        return None
 
     def getPalette(self):
         ''' Used to populate the pallete. '''
@@ -51,46 +72,50 @@ class PrinterWidget(urwid.Pile):
         ]
 
     # callback
+    @instrument.timed('PrinterWidget.stats_cb')
     def stats_cb(self, data):
         ''' Gets called when the data returns. '''
-        self.stats_lock.acquire(True)
+        recorder.observe(recorder.OCTOPRINT, 'octoprint/%s' % self.machine, data)
         if data is not None:
-            self.stats.update(data)
-            self.stats['last_update'] = time.time()
+            stats = dict(self.stats)
+            stats.update(data)
+            stats['last_update'] = recorder.now()
         else:
-            self.stats['state']['text'] = 'Unknown'
-            self.stats['temperature']['bed']['actual'] = 0.0
-            self.stats['temperature']['tool0']['actual'] = 0.0
-            self.stats['temperature']['bed']['target'] = 0.0
-            self.stats['temperature']['tool0']['target'] = 0.0
-        self.stats_lock.release()
-
-    def getData(self, loop, user_data):
-        ''' This looks for all the machines, and then puts itself back into the list of things to get called by loop.'''
+            stats = UnknownStats(self.stats['last_update'])
+        self.stats = stats
+        alerts.notify('octoprint/%s' % self.machine, {'ok': data is not None})
+
+    @instrument.timed('PrinterWidget.getData')
+    def getData(self):
+        ''' This starts a query of the printer. '''
         ReadDataAsync('http://%s/api/printer?apikey=%s' % (self.machine, self.key), self.stats_cb)
-        loop.set_alarm_in(3.0, self.getData)
 
-    def update(self, loop, data):
-        ''' This updates the widgets used in the pinger part of the display. '''
+    @instrument.timed('PrinterWidget.update')
+    def update(self):
+        ''' This updates the widgets used in the printer part of the display. Returns True if anything changed. '''
         rows = []
 
-        self.stats_lock.acquire(True)
+        stats = self.stats
         try:
-            status = self.stats['state']['text']
+            status = stats['state']['text']
         except KeyError as e:
             status = "Unknown"
         try:
-            bed_temp = (float(self.stats['temperature']['bed']['actual']),
-                        float(self.stats['temperature']['bed']['target']))
+            bed_temp = (float(stats['temperature']['bed']['actual']),
+                        float(stats['temperature']['bed']['target']))
         except KeyError as e:
             bed_temp = (0,0)
         try:
-            nozzle_temp = (float(self.stats['temperature']['tool0']['actual']),
-                           float(self.stats['temperature']['tool0']['target']))
+            nozzle_temp = (float(stats['temperature']['tool0']['actual']),
+                           float(stats['temperature']['tool0']['target']))
         except KeyError as e:
             nozzle_temp = (0,0)
-        old = (time.time() - self.stats['last_update']) > 22.0
-        self.stats_lock.release()
+        old = (recorder.now() - stats['last_update']) > 22.0
+
+        sig = (status, bed_temp, nozzle_temp, old)
+        if sig == self.drawn:
+            return False
+        self.drawn = sig
 
         theme = 'title'
         if old:
@@ -117,18 +142,53 @@ class PrinterWidget(urwid.Pile):
         rows.append((cols, self.options()))
 
         self.contents = rows
-        loop.set_alarm_in(0.5, self.update)
-
-    def start(self, loop):
-        ''' Called to add the initial processes to the loop.'''
-        self.getData(loop, None)
-        self.update(loop, None)
+        return True
+
+    def start(self, scheduler):
+        ''' Called to add the initial processes to the scheduler.'''
+        scheduler.every(3.0, self.getData, priority=1, probe=True)
+        scheduler.every(0.5, self.update, draw=True)
+
+    def getMetrics(self):
+        ''' Return (name, labels, value) samples for the printer. '''
+        labels = {'host': self.machine}
+        samples = []
+        stats = self.stats
+        try:
+            samples.append(('housemon_printer_up', labels, int(stats['state']['text'] != 'Unknown')))
+            samples.append(('housemon_printer_data_age_seconds', labels, recorder.now() - stats['last_update']))
+            for sensor in ['bed', 'tool0']:
+                for kind in ['actual', 'target']:
+                    value = stats['temperature'][sensor][kind]
+                    if value is not None:
+                        value = float(value)
+                    samples.append(('housemon_printer_temperature_celsius', dict(labels, sensor=sensor, kind=kind), value))
+        except KeyError:
+            pass
+        return samples
+
+    def getState(self):
+        ''' Return (key, fields) pairs for the printer, for the web view. '''
+        fields = {}
+        stats = self.stats
+        try:
+            fields['state'] = stats['state']['text']
+            fields['ok'] = fields['state'] != 'Unknown'
+            fields['fresh'] = (recorder.now() - stats['last_update']) <= 22.0
+            for sensor in ['bed', 'tool0']:
+                fields[sensor] = stats['temperature'][sensor]['actual']
+                fields[sensor + '_target'] = stats['temperature'][sensor]['target']
+        except KeyError:
+            pass
+        return [('octoprint/%s' % self.machine, fields)]
+
+    def getReplay(self):
+        ''' Return (kind, key, callback) for everything a recording can feed back in. '''
+        return [(recorder.OCTOPRINT, 'octoprint/%s' % self.machine, self.stats_cb)]
 
     def getError(self):
         ''' return if there is a problem that I can detect. '''
-        self.stats_lock.acquire(True)
         state = self.stats['state']
-        self.stats_lock.release()
         if state['text'] == 'Unknown':
             return "Octoprint server %s is not responding" % self.machine
         return None
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import struct
+import threading
+import time
+
+import instrument
+
+#########################################################
+# The clock the collectors see
+#########################################################
+
+# Replaced by a Replayer, so the "how old is this" checks follow the log instead of the wall.
+clock = time.time
+
+def now():
+    return clock()
+
+#########################################################
+# Log format
+#########################################################
+
+# A log is the magic, then records of a header and a payload. Keys are sent
+# once, as a KEY record, and referred to by number after that.
+LOG_MAGIC = b'HMREC001'
+HEADER = struct.Struct('<dBHI') # time, kind, key number, payload length
+
+KEY = 0
+PING = 1        # an endpoint's ping (and lookup): ip, rv, time
+INTERNET = 2    # the network map's internet ping: ip, rv, time
+DNS = 3         # the network map's lookup: ip, rv, time
+MQTT = 4        # a message: topic, payload
+OCTOPRINT = 5   # what /api/printer returned, or None
+NEIGHBOR = 6    # an endpoint the kernel's neighbour table says is there: ip
+
+KIND_NAMES = {KEY: 'key', PING: 'ping', INTERNET: 'internet', DNS: 'dns', MQTT: 'mqtt', OCTOPRINT: 'octoprint',
+              NEIGHBOR: 'neighbor'}
+
+def encode(kind, fields):
+    if kind == MQTT:
+        topic, payload = fields
+        if not isinstance(topic, bytes):
+            topic = topic.encode('utf-8')
+        if payload is None:
+            payload = b''
+        elif not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        return topic + b'\0' + payload
+    return json.dumps(list(fields), separators=(',', ':')).encode('utf-8')
+
+def decode(kind, payload):
+    if kind == MQTT:
+        topic, payload = payload.split(b'\0', 1)
+        return (topic.decode('utf-8'), payload)
+    return tuple(json.loads(payload.decode('utf-8')))
+
+def readLog(filename):
+    ''' Yield (time, kind, key, fields) for every observation in a log, without reading it all in. '''
+    keys = {}
+    with open(filename, 'rb') as f:
+        if f.read(len(LOG_MAGIC)) != LOG_MAGIC:
+            raise IOError("%s is not a housemon recording" % filename)
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            t, kind, number, length = HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                # cut off while it was being written.
+                return
+            if kind == KEY:
+                keys[number] = payload.decode('utf-8')
+                continue
+            yield (t, kind, keys.get(number), decode(kind, payload))
+
+#########################################################
+# Recording
+#########################################################
+
+class Recorder(object):
+    ''' Appends every observation to a log. Called from whatever thread made the observation. '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.file.write(LOG_MAGIC)
+        self.keys = {}
+        self.count = 0
+        self.lock = instrument.TimedLock('Recorder.lock')
+
+    def record(self, kind, key, payload):
+        t = time.time()
+        self.lock.acquire(True)
+        try:
+            number = self.keys.get(key)
+            if number is None:
+                number = len(self.keys)
+                self.keys[key] = number
+                name = key.encode('utf-8')
+                self.file.write(HEADER.pack(t, KEY, number, len(name)) + name)
+            self.file.write(HEADER.pack(t, kind, number, len(payload)) + payload)
+            self.count += 1
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        self.lock.acquire(True)
+        self.file.flush()
+        self.lock.release()
+
+    def close(self):
+        self.lock.acquire(True)
+        self.file.close()
+        self.lock.release()
+
+    def start(self, scheduler):
+        ''' Called to add the initial processes to the scheduler.'''
+        scheduler.every(5.0, self.flush)
+
+# The Recorder, while recording. The collectors check this, so it costs nothing when it's off.
+recording = None
+
+def observe(kind, key, *fields):
+    ''' Called by the collectors with everything they see. '''
+    if recording is not None:
+        recording.record(kind, key, encode(kind, fields))
+
+#########################################################
+# Replay
+#########################################################
+
+class Replayer(object):
+    '''
+    Feeds a log back through the widgets' own callbacks, from a thread, like the
+    probes would. At speed 1 it takes as long as it took to record, at speed 60 an
+    hour goes by in a minute, and at speed 0 it goes as fast as it can.
+
+    While it runs, recorder.now() follows the log, so data goes stale in the
+    display when it went stale then.
+    '''
+    def __init__(self, filename, widgets, speed=1.0):
+        self.filename = filename
+        self.speed = speed
+        self.targets = {}
+        for wid in widgets:
+            for kind, key, callback in wid.getReplay():
+                self.targets[(kind, key)] = callback
+
+        self.position = None
+        self.started = None
+        self.first = None
+        self.fed = 0
+        self.missed = 0
+        self.done = False
+
+    def now(self):
+        if self.position is None:
+            return time.time()
+        if self.speed > 0 and not self.done:
+            return self.first + (time.time() - self.started) * self.speed
+        return self.position
+
+    def run(self):
+        for t, kind, key, fields in readLog(self.filename):
+            if self.first is None:
+                self.first = t
+                self.started = time.time()
+            if self.speed > 0:
+                delay = (t - self.first) / self.speed - (time.time() - self.started)
+                if delay > 0:
+                    time.sleep(delay)
+            self.position = t
+
+            callback = self.targets.get((kind, key))
+            if callback is None:
+                # the config changed since, and nothing matches it now.
+                self.missed += 1
+                continue
+            callback(*fields)
+            self.fed += 1
+        self.done = True
+
+    def getError(self):
+        if self.done:
+            return "Replay of %s is over (%d fed, %d with nowhere to go)." % (self.filename, self.fed, self.missed)
+        return None
+
+    def start(self, scheduler=None):
+        global clock
+        clock = self.now
+        t = threading.Thread(target=self.run, args=())
+        t.setDaemon(True)
+        t.start()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Look inside a housemon recording")
+    parser.add_argument('filename')
+    parser.add_argument('--dump', action='store_true', help="print every observation, not just the summary")
+    args = parser.parse_args()
+
+    counts = {}
+    keys = set()
+    first = last = None
+    for t, kind, key, fields in readLog(args.filename):
+        if first is None:
+            first = t
+        last = t
+        counts[kind] = counts.get(kind, 0) + 1
+        keys.add(key)
+        if args.dump:
+            print('%0.3f %-9s %s %r' % (t, KIND_NAMES.get(kind, kind), key, fields))
+
+    if first is None:
+        print('%s is empty' % args.filename)
+    else:
+        print('%s: %0.1f seconds from %s, %d keys' % (args.filename, last - first, time.ctime(first), len(keys)))
+        for kind in sorted(counts.keys()):
+            print('    %-9s %d' % (KIND_NAMES.get(kind, kind), counts[kind]))
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+import errno
+import heapq
+import math
+import os
+import select
+import time
+import urwid
+
+import instrument
+
+#########################################################
+# One clock for every widget
+#########################################################
+
+class Task(object):
+    ''' Something the scheduler calls over and over. '''
+    def __init__(self, callback, period, priority, draw):
+        self.callback = callback
+        self.period = period
+        self.priority = priority
+        self.draw = draw
+        self.due = 0.0
+
+class Scheduler(object):
+    '''
+    Runs all the widget refreshes from one alarm.
+
+    Task periods are rounded to whole frames, and each task lines up on a multiple
+    of its own period, so things that run every second all run in the same frame.
+    The loop is only woken on frames where something is due, never more than fps
+    times a second.
+
+    Draw tasks return True when they changed what's on the screen, and the screen
+    is only repainted when one did. Data tasks run highest priority first, until
+    the frame's budget (in seconds) is spent. The rest wait for the next frame.
+
+    Probe tasks are the ones that go out and look at the world. They are dropped
+    while a recording is replayed, so only the recording feeds the widgets.
+    '''
+    def __init__(self, loop, fps=4.0, budget=0.05, headless=False, probes=True):
+        self.loop = loop
+        self.frame = 1.0 / fps
+        self.budget = budget
+        # nothing to draw on, so draw tasks are dropped.
+        self.headless = headless
+        self.probes = probes
+        self.tasks = []
+        self.alarm = None
+        self.alarm_time = None
+
+        # counters, so you can see it working.
+        self.frames = 0
+        self.repaints = 0
+        self.deferred = 0
+
+    def quantize(self, t):
+        ''' Round a time up to the next frame boundary. '''
+        return math.ceil(t / self.frame - 1e-6) * self.frame
+
+    def every(self, period, callback, priority=0, draw=False, probe=False):
+        '''
+        Call callback() every period seconds.
+            :priority: higher runs first, and is the last to be deferred.
+            :draw: callback returns True if it changed the screen.
+            :probe: callback goes out to the network for new data.
+        '''
+        if draw and self.headless:
+            return None
+        if probe and not self.probes:
+            return None
+        period = max(self.quantize(period), self.frame)
+        task = Task(callback, period, priority, draw)
+        task.due = self.quantize(math.floor(time.time() / period) * period)
+        self.tasks.append(task)
+        self.tasks.sort(key=lambda t: (not t.draw, -t.priority))
+        self.arm()
+        return task
+
+    def cancel(self, task):
+        if task in self.tasks:
+            self.tasks.remove(task)
+        self.arm()
+
+    def invalidate(self):
+        ''' Something outside of a draw task changed the screen. '''
+        self.loop.dirty = True
+
+    def arm(self):
+        ''' Set the alarm for the next frame that has something due. '''
+        if not self.tasks:
+            return
+        due = max(self.quantize(min([t.due for t in self.tasks])), self.quantize(time.time()))
+        if due == self.alarm_time:
+            return
+        if self.alarm is not None:
+            self.loop.remove_alarm(self.alarm)
+        self.alarm_time = due
+        self.alarm = self.loop.set_alarm_at(due, self.tick)
+
+    @instrument.timed('scheduler.tick')
+    def tick(self, loop=None, data=None):
+        ''' Run everything due in this frame. '''
+        self.alarm = None
+        self.alarm_time = None
+        now = time.time()
+        frame_end = now + self.frame / 2
+        self.frames += 1
+
+        changed = False
+        spent = 0.0
+        # data tasks first, so the draws see the freshest data.
+        for task in sorted(self.tasks, key=lambda t: (t.draw, -t.priority)):
+            if task.due > frame_end:
+                continue
+            if not task.draw and spent > self.budget:
+                self.deferred += 1
+                continue
+
+            start = time.time()
+            result = task.callback()
+            if task.draw:
+                changed = changed or bool(result)
+            else:
+                spent += time.time() - start
+
+            task.due += task.period
+            if task.due <= now:
+                # fell behind, skip ahead rather than running back to back.
+                task.due = self.quantize(math.ceil(now / task.period) * task.period)
+
+        if changed:
+            self.repaints += 1
+            self.invalidate()
+        self.arm()
+
+class MainLoop(urwid.MainLoop):
+    ''' A MainLoop that only repaints when input arrived, or a widget changed. '''
+    def __init__(self, *args, **kwargs):
+        urwid.MainLoop.__init__(self, *args, **kwargs)
+        self.dirty = True
+
+    def process_input(self, keys):
+        self.dirty = True
+        return urwid.MainLoop.process_input(self, keys)
+
+    def entering_idle(self):
+        if self.dirty:
+            self.dirty = False
+            urwid.MainLoop.entering_idle(self)
+
+class HeadlessLoop(object):
+    '''
+    Stands in for the urwid MainLoop when there is no terminal.
+
+    It does the parts the scheduler and widgets use: alarms, watched files and
+    watched pipes.
+    '''
+    def __init__(self):
+        self.alarms = []
+        self.files = {}
+        self.dirty = False
+        self.running = False
+        self.count = 0
+
+    def set_alarm_at(self, tm, callback, user_data=None):
+        self.count += 1
+        alarm = (tm, self.count, callback, user_data)
+        heapq.heappush(self.alarms, alarm)
+        return alarm
+
+    def set_alarm_in(self, sec, callback, user_data=None):
+        return self.set_alarm_at(time.time() + sec, callback, user_data)
+
+    def remove_alarm(self, alarm):
+        try:
+            self.alarms.remove(alarm)
+        except ValueError:
+            return False
+        heapq.heapify(self.alarms)
+        return True
+
+    def watch_file(self, fd, callback):
+        self.files[fd] = callback
+        return fd
+
+    def remove_watch_file(self, fd):
+        return self.files.pop(fd, None) is not None
+
+    def watch_pipe(self, callback):
+        rfd, wfd = os.pipe()
+
+        def cb():
+            data = os.read(rfd, 4096)
+            if callback(data) is False:
+                self.remove_watch_file(rfd)
+                os.close(rfd)
+
+        self.watch_file(rfd, cb)
+        return wfd
+
+    def run(self):
+        self.running = True
+        try:
+            while self.running:
+                timeout = None
+                if self.alarms:
+                    timeout = max(0.0, self.alarms[0][0] - time.time())
+                elif not self.files:
+                    return
+                if self.files:
+                    try:
+                        ready, _, _ = select.select(list(self.files.keys()), [], [], timeout)
+                    except select.error as e:
+                        # a signal handler ran, like the SIGUSR1 dump. Look again.
+                        if e.args[0] != errno.EINTR:
+                            raise
+                        ready = []
+                    for fd in ready:
+                        if fd in self.files:
+                            self.files[fd]()
+                elif timeout:
+                    time.sleep(timeout)
+
+                while self.alarms and self.alarms[0][0] <= time.time():
+                    tm, count, callback, user_data = heapq.heappop(self.alarms)
+                    callback(self, user_data)
+        except urwid.ExitMainLoop:
+            pass
+
+    def stop(self):
+        self.running = False
@@ -0,0 +1,540 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+import random
+import select
+import socket
+import threading
+import time
+
+import alerts
+import instrument
+
+#########################################################
+# Just enough BER for SNMPv2c
+#########################################################
+
+INTEGER = 0x02
+OCTET_STRING = 0x04
+NULL = 0x05
+OID = 0x06
+SEQUENCE = 0x30
+IP_ADDRESS = 0x40
+COUNTER32 = 0x41
+GAUGE32 = 0x42
+TIMETICKS = 0x43
+COUNTER64 = 0x46
+NO_SUCH_OBJECT = 0x80
+NO_SUCH_INSTANCE = 0x81
+END_OF_MIB_VIEW = 0x82
+GET_RESPONSE = 0xa2
+GET_BULK = 0xa5
+
+CONSTRUCTED = [SEQUENCE, GET_RESPONSE, GET_BULK]
+UNSIGNED = [COUNTER32, GAUGE32, TIMETICKS, COUNTER64]
+# what a walk gets back when there's nothing more in a column.
+NOTHING = [NO_SUCH_OBJECT, NO_SUCH_INSTANCE, END_OF_MIB_VIEW]
+
+VERSION_2C = 1
+TOO_BIG = 1
+
+class SnmpError(Exception):
+    pass
+
+def encodeLength(length):
+    if length < 0x80:
+        return bytearray([length])
+    octets = bytearray()
+    while length:
+        octets.insert(0, length & 0xff)
+        length >>= 8
+    return bytearray([0x80 | len(octets)]) + octets
+
+def encodeInteger(value, unsigned=False):
+    octets = bytearray()
+    while True:
+        octets.insert(0, value & 0xff)
+        value >>= 8
+        if value == 0 and (unsigned or not octets[0] & 0x80):
+            break
+        if value == -1 and not unsigned and octets[0] & 0x80:
+            break
+    if unsigned and octets[0] & 0x80:
+        octets.insert(0, 0)
+    return octets
+
+def encodeOid(oid):
+    octets = bytearray([oid[0] * 40 + oid[1]])
+    for arc in oid[2:]:
+        chunk = bytearray([arc & 0x7f])
+        arc >>= 7
+        while arc:
+            chunk.insert(0, 0x80 | (arc & 0x7f))
+            arc >>= 7
+        octets += chunk
+    return octets
+
+def encode(tag, value=None):
+    ''' One TLV. Constructed tags take a list of already encoded children. '''
+    if tag in CONSTRUCTED:
+        body = bytearray().join(value)
+    elif tag == INTEGER:
+        body = encodeInteger(value)
+    elif tag in UNSIGNED:
+        body = encodeInteger(value, unsigned=True)
+    elif tag == OID:
+        body = encodeOid(value)
+    elif tag in [OCTET_STRING, IP_ADDRESS]:
+        body = bytearray(value)
+    else:
+        body = bytearray()
+    return bytearray([tag]) + encodeLength(len(body)) + body
+
+def decode(data, pos=0):
+    ''' Returns (tag, value, position after it). data is a bytearray. '''
+    tag = data[pos]
+    length = data[pos + 1]
+    pos += 2
+    if length & 0x80:
+        count = length & 0x7f
+        length = 0
+        for octet in data[pos:pos + count]:
+            length = (length << 8) | octet
+        pos += count
+    end = pos + length
+    if end > len(data):
+        raise SnmpError("truncated packet")
+    body = data[pos:end]
+
+    if tag in CONSTRUCTED:
+        value = []
+        while pos < end:
+            child_tag, child, pos = decode(data, pos)
+            value.append((child_tag, child))
+    elif tag == INTEGER or tag in UNSIGNED:
+        value = 0
+        for octet in body:
+            value = (value << 8) | octet
+        if tag == INTEGER and body and body[0] & 0x80:
+            value -= 1 << (8 * len(body))
+    elif tag == OID:
+        value = [body[0] // 40, body[0] % 40] if body else []
+        arc = 0
+        for octet in body[1:]:
+            arc = (arc << 7) | (octet & 0x7f)
+            if not octet & 0x80:
+                value.append(arc)
+                arc = 0
+        value = tuple(value)
+    elif tag in NOTHING or tag == NULL:
+        value = None
+    else:
+        value = bytes(body)
+    return (tag, value, end)
+
+def getBulk(community, request_id, oids, repetitions):
+    ''' A GetBulkRequest for the next repetitions rows after each oid. '''
+    varbinds = [encode(SEQUENCE, [encode(OID, oid), encode(NULL)]) for oid in oids]
+    pdu = encode(GET_BULK, [encode(INTEGER, request_id), encode(INTEGER, 0), encode(INTEGER, repetitions),
+                            encode(SEQUENCE, varbinds)])
+    return bytes(encode(SEQUENCE, [encode(INTEGER, VERSION_2C), encode(OCTET_STRING, community), pdu]))
+
+def response(community, request_id, varbinds, error=0):
+    ''' A GetResponse, from (oid, tag, value) varbinds. '''
+    encoded = [encode(SEQUENCE, [encode(OID, oid), encode(tag, value)]) for oid, tag, value in varbinds]
+    pdu = encode(GET_RESPONSE, [encode(INTEGER, request_id), encode(INTEGER, error), encode(INTEGER, 0),
+                                encode(SEQUENCE, encoded)])
+    return bytes(encode(SEQUENCE, [encode(INTEGER, VERSION_2C), encode(OCTET_STRING, community), pdu]))
+
+def parse(packet):
+    '''
+    Returns (community, pdu tag, request id, error status, error index or
+    non-repeaters, max-repetitions or 0, [(oid, tag, value)]).
+    '''
+    tag, message, end = decode(bytearray(packet))
+    if tag != SEQUENCE or len(message) != 3:
+        raise SnmpError("not an SNMP message")
+    community = message[1][1]
+    pdu_tag, pdu = message[2]
+    varbinds = [(vb[0][1], vb[1][0], vb[1][1]) for _, vb in pdu[3][1]]
+    return (community, pdu_tag, pdu[0][1], pdu[1][1], pdu[2][1], varbinds)
+
+#########################################################
+# Interface counters
+#########################################################
+
+IF_TABLE = (1, 3, 6, 1, 2, 1, 2, 2, 1)
+IF_X_TABLE = (1, 3, 6, 1, 2, 1, 31, 1, 1, 1)
+
+# the columns walked on every device. The 64 bit octet counters are used where
+# the device has them, they take years to wrap at gigabit speeds.
+COLUMNS = collections.OrderedDict([
+    ('name', IF_X_TABLE + (1,)),            # ifName
+    ('up', IF_TABLE + (8,)),                # ifOperStatus
+    ('in_octets', IF_TABLE + (10,)),        # ifInOctets
+    ('out_octets', IF_TABLE + (16,)),       # ifOutOctets
+    ('in_errors', IF_TABLE + (14,)),        # ifInErrors
+    ('out_errors', IF_TABLE + (20,)),       # ifOutErrors
+    ('hc_in_octets', IF_X_TABLE + (6,)),    # ifHCInOctets
+    ('hc_out_octets', IF_X_TABLE + (10,)),  # ifHCOutOctets
+])
+
+WIDTHS = {COUNTER32: 1 << 32, COUNTER64: 1 << 64}
+
+def counterDelta(old, new, width):
+    '''
+    How much a counter went up. A 32 bit counter going backwards wrapped. A 64
+    bit one can't have, so the device restarted and there's no delta this time.
+    '''
+    if new >= old:
+        return new - old
+    if width == WIDTHS[COUNTER32]:
+        return new + width - old
+    return None
+
+# One port, as of the last poll. Rates are per second, and None until there
+# have been two polls.
+Port = collections.namedtuple('Port', ['index', 'name', 'up', 'rx_rate', 'tx_rate', 'in_error_rate', 'out_error_rate'])
+# What we know about a device. Replaced, never changed, like the endpoint states.
+DeviceState = collections.namedtuple('DeviceState', ['time', 'ok', 'ports'])
+
+class Device(object):
+    '''
+    The SNMP side of a switch or router.
+    Attributes read from the map:
+        :community: defaults to public.
+        :port: defaults to 161.
+        :ports: names of the ports to show, all of the ones that are up if not given.
+        :errors: errors per second on a port to complain about, 0 if not given.
+    '''
+    def __init__(self, host, map, key=None):
+        self.host = host
+        # what to call it in the alerts.
+        self.name = host
+        # once the switch's own ping has found it, so polls don't each look it up.
+        self.ip = None
+        self.community = map.get('community', 'public')
+        if not isinstance(self.community, bytes):
+            self.community = self.community.encode('utf-8')
+        self.port = int(map.get('port', 161))
+        self.ports = map.get('ports')
+        self.errors = float(map.get('errors', 0.0))
+        self.key = key
+        self.state = DeviceState(None, None, ())
+        # index: (time, counters) from the last poll.
+        self.last = {}
+
+    def address(self):
+        return (self.ip or self.host, self.port)
+
+    def shown(self):
+        if self.ports is None:
+            return [p for p in self.state.ports if p.up]
+        return [p for p in self.state.ports if p.name in self.ports]
+
+    def poll_cb(self, rows):
+        ''' Gets called with {index: {column: (tag, value)}} when a walk is done, or None if it failed. '''
+        now = time.time()
+        if rows is None:
+            self.state = self.state._replace(time=now, ok=False)
+            if self.key:
+                alerts.notify(self.key + '/snmp', {'ok': False, 'name': '%s (snmp)' % self.name})
+            return
+
+        last = {}
+        ports = []
+        for index in sorted(rows.keys()):
+            row = rows[index]
+            counters = {}
+            for name in ['in', 'out']:
+                # the wider counter, if the device has it.
+                for column in ['hc_%s_octets' % name, '%s_octets' % name]:
+                    if row.get(column, (None, None))[0] in WIDTHS:
+                        counters[name + '_octets'] = row[column]
+                        break
+                column = '%s_errors' % name
+                if row.get(column, (None, None))[0] in WIDTHS:
+                    counters[column] = row[column]
+            last[index] = (now, counters)
+
+            rates = {}
+            previous = self.last.get(index)
+            for column, (tag, value) in counters.items():
+                rates[column] = None
+                if previous is None or column not in previous[1] or now <= previous[0]:
+                    continue
+                old_tag, old_value = previous[1][column]
+                if old_tag != tag:
+                    continue
+                delta = counterDelta(old_value, value, WIDTHS[tag])
+                if delta is not None:
+                    rates[column] = delta / (now - previous[0])
+
+            name = row.get('name', (None, None))[1]
+            if name is None:
+                name = str(index)
+            elif not isinstance(name, str):
+                name = name.decode('utf-8', 'replace')
+            ports.append(Port(index, name, row.get('up', (None, None))[1] == 1,
+                              rates.get('in_octets'), rates.get('out_octets'),
+                              rates.get('in_errors'), rates.get('out_errors')))
+        self.last = last
+        self.state = DeviceState(now, True, tuple(ports))
+
+        if self.key:
+            alerts.notify(self.key + '/snmp', {'ok': True, 'name': '%s (snmp)' % self.name})
+            for port in ports:
+                errors = (port.in_error_rate or 0.0) + (port.out_error_rate or 0.0)
+                alerts.notify('%s/port/%s' % (self.key, port.name), {'port_errors': errors, 'limit': self.errors,
+                                                                     'name': '%s port %s' % (self.name, port.name)})
+
+#########################################################
+# Polling
+#########################################################
+
+class Walk(object):
+    ''' One device's walk of the columns, in as few GetBulks as it takes. '''
+    def __init__(self, device, repetitions):
+        self.device = device
+        self.repetitions = repetitions
+        # column name: the oid to carry on from, for the columns that aren't done.
+        self.next = collections.OrderedDict([(name, oid) for name, oid in COLUMNS.items()])
+        self.rows = {}
+        self.request_id = None
+        self.sent = None
+        self.tries = 0
+        self.requests = 0
+
+    def request(self, request_id):
+        self.request_id = request_id
+        self.requests += 1
+        return getBulk(self.device.community, request_id, list(self.next.values()), self.repetitions)
+
+    def take(self, varbinds):
+        ''' Add a response. Returns True when every column is done. '''
+        columns = list(self.next.keys())
+        done = set()
+        for i, (oid, tag, value) in enumerate(varbinds):
+            # one varbind per column, a row at a time.
+            name = columns[i % len(columns)]
+            if name in done:
+                continue
+            root = COLUMNS[name]
+            if tag in NOTHING or oid[:len(root)] != root or len(oid) != len(root) + 1 or oid <= self.next[name]:
+                # off the end of the column, or going backwards on a broken agent.
+                done.add(name)
+                continue
+            self.rows.setdefault(oid[-1], {})[name] = (tag, value)
+            self.next[name] = oid
+        for name in done:
+            del self.next[name]
+        return not self.next
+
+class Poller(object):
+    '''
+    Walks the interface counters of every device at once, over one UDP socket.
+
+    All the first requests go out together, and each answer is matched to its
+    device by the request id, which sends that device's next request right away.
+    So a poll takes as long as the slowest device, not all of them added up.
+    '''
+    def __init__(self, devices, interval=30.0, timeout=2.0, retries=2, repetitions=10):
+        self.devices = devices
+        self.interval = interval
+        self.timeout = timeout
+        self.retries = retries
+        self.repetitions = repetitions
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('', 0))
+        self.request_id = random.randint(1, 1 << 30)
+        self.busy = False
+        self.polls = 0
+        self.requests = 0
+
+    def nextId(self):
+        self.request_id = (self.request_id + 1) & 0x7fffffff
+        return self.request_id
+
+    def send(self, walk, pending):
+        ''' Send the walk's next request, or give up on the device if it can't be sent. '''
+        walk.sent = time.time()
+        try:
+            self.sock.sendto(walk.request(self.nextId()), walk.device.address())
+        except socket.error:
+            walk.device.poll_cb(None)
+            return
+        self.requests += 1
+        pending[walk.request_id] = walk
+
+    @instrument.timed('snmp.poll')
+    def poll(self):
+        ''' Walk every device once. Blocks until they're all done or given up on. '''
+        pending = {}
+        for device in self.devices:
+            self.send(Walk(device, self.repetitions), pending)
+
+        while pending:
+            wait = min([w.sent for w in pending.values()]) + self.timeout - time.time()
+            readable = select.select([self.sock], [], [], max(wait, 0.0))[0]
+            if readable:
+                packet, address = self.sock.recvfrom(65535)
+                try:
+                    community, tag, request_id, error, index, varbinds = parse(packet)
+                except (SnmpError, IndexError, TypeError, ValueError):
+                    continue
+                walk = pending.pop(request_id, None)
+                if walk is None or tag != GET_RESPONSE:
+                    # late, or someone else's.
+                    continue
+                if error == TOO_BIG and walk.repetitions > 1:
+                    walk.repetitions //= 2
+                elif error:
+                    walk.device.poll_cb(None)
+                    continue
+                elif walk.take(varbinds):
+                    walk.device.poll_cb(walk.rows)
+                    continue
+                walk.tries = 0
+                self.send(walk, pending)
+
+            now = time.time()
+            for request_id, walk in list(pending.items()):
+                if now - walk.sent < self.timeout:
+                    continue
+                del pending[request_id]
+                walk.tries += 1
+                if walk.tries > self.retries:
+                    walk.device.poll_cb(None)
+                    continue
+                self.send(walk, pending)
+        self.polls += 1
+
+    def run(self):
+        try:
+            self.poll()
+        finally:
+            self.busy = False
+
+    def pollAsync(self):
+        ''' Start a poll on its own thread, unless the last one is still going. '''
+        if self.busy:
+            return
+        self.busy = True
+        t = threading.Thread(target=self.run, args=())
+        t.setDaemon(True)
+        t.start()
+
+    def start(self, scheduler):
+        ''' Called to add the initial processes to the scheduler.'''
+        scheduler.every(self.interval, self.pollAsync, priority=1, probe=True)
+
+#########################################################
+# A stand in agent, for trying it out
+#########################################################
+
+class FakeAgent(object):
+    '''
+    Answers GetBulks for an interface table, on a local UDP port. Every port's
+    counters go up by rate bytes a second, starting from start, so a start near
+    2**32 exercises the wraparound.
+    '''
+    def __init__(self, ports=4, rate=125000, start=0, hc=True, community=b'public', address='127.0.0.1'):
+        self.rate = rate
+        self.start_value = start
+        self.hc = hc
+        self.community = community
+        self.names = ['port%d' % (i + 1) for i in range(ports)]
+        self.born = time.time()
+        self.requests = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, 0))
+        self.host, self.port = self.sock.getsockname()
+
+    def table(self):
+        ''' Every (oid, tag, value) the agent has, in order. '''
+        elapsed = time.time() - self.born
+        octets = int(self.start_value + self.rate * elapsed)
+        values = {
+            'name': lambda i: (OCTET_STRING, self.names[i - 1].encode('utf-8')),
+            'up': lambda i: (INTEGER, 1 if i % 2 else 2),
+            'in_octets': lambda i: (COUNTER32, (octets * i) % (1 << 32)),
+            'out_octets': lambda i: (COUNTER32, (octets * i // 2) % (1 << 32)),
+            'in_errors': lambda i: (COUNTER32, int(elapsed) * (i == 1)),
+            'out_errors': lambda i: (COUNTER32, 0),
+            'hc_in_octets': lambda i: (COUNTER64, octets * i),
+            'hc_out_octets': lambda i: (COUNTER64, octets * i // 2),
+        }
+        table = []
+        for name, root in COLUMNS.items():
+            if name.startswith('hc_') and not self.hc:
+                continue
+            for i in range(1, len(self.names) + 1):
+                tag, value = values[name](i)
+                table.append((root + (i,), tag, value))
+        return sorted(table)
+
+    def answer(self, packet):
+        community, tag, request_id, non_repeaters, repetitions, varbinds = parse(packet)
+        if community != self.community or tag != GET_BULK:
+            return None
+        table = self.table()
+        rows = [[] for r in range(repetitions)]
+        for oid, _, _ in varbinds:
+            following = [entry for entry in table if entry[0] > oid]
+            for r in range(repetitions):
+                if r < len(following):
+                    rows[r].append(following[r])
+                else:
+                    rows[r].append((oid, END_OF_MIB_VIEW, None))
+        return response(community, request_id, [vb for row in rows for vb in row])
+
+    def serve(self):
+        while True:
+            packet, address = self.sock.recvfrom(65535)
+            self.requests += 1
+            try:
+                reply = self.answer(packet)
+            except (SnmpError, IndexError, TypeError, ValueError):
+                continue
+            if reply:
+                self.sock.sendto(reply, address)
+
+    def start(self):
+        t = threading.Thread(target=self.serve, args=())
+        t.setDaemon(True)
+        t.start()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Poll interface counters over SNMP, or try it on a fake agent")
+    parser.add_argument('hosts', nargs='*', help="devices to poll (default: a fake agent on localhost)")
+    parser.add_argument('--community', default='public')
+    parser.add_argument('--port', type=int, default=161)
+    parser.add_argument('--polls', type=int, default=2)
+    parser.add_argument('--interval', type=float, default=2.0)
+    parser.add_argument('--start', type=int, default=(1 << 32) - 100000,
+                        help="where the fake agent's counters start, near 2**32 to show wraparound")
+    args = parser.parse_args()
+
+    devices = []
+    if args.hosts:
+        for host in args.hosts:
+            devices.append(Device(host, {'community': args.community, 'port': args.port}))
+    else:
+        for hc in [True, False]:
+            agent = FakeAgent(start=args.start, hc=hc)
+            agent.start()
+            devices.append(Device(agent.host, {'port': agent.port}))
+
+    poller = Poller(devices)
+    for i in range(args.polls):
+        if i:
+            time.sleep(args.interval)
+        start = time.time()
+        poller.poll()
+        print('poll %d: %0.1fms, %d requests so far' % (i + 1, (time.time() - start) * 1000.0, poller.requests))
+    for device in devices:
+        print('%s:%d ok=%s' % (device.host, device.port, device.state.ok))
+        for port in device.state.ports:
+            print('    %-8s up=%-5s rx=%s tx=%s errors=%s/%s' % (port.name, port.up, port.rx_rate, port.tx_rate,
+                                                             port.in_error_rate, port.out_error_rate))
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+import gc
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urwid
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2, or a build without it. Object counts still work.
+    tracemalloc = None
+
+import alerts
+import bench
+import display
+import instrument
+import mqtt
+import pinger
+import printer
+import sysinfo
+import touch
+
+# the modules allocation sites are grouped by. Anything else goes under its
+# top level package, or 'other'.
+MODULES = ['pinger', 'mqtt', 'printer', 'touch', 'display', 'sysinfo', 'alerts', 'scheduler', 'instrument',
+           'recorder', 'snmp', 'neighbors', 'timeline', 'urwid', 'paho', 'threading']
+
+#########################################################
+# Samples
+#########################################################
+
+# One look at the process.
+Sample = collections.namedtuple('Sample', ['time', 'rounds', 'rss_kb', 'threads', 'objects', 'traced_kb'])
+
+def moduleOf(filename):
+    ''' Which of MODULES a source file belongs to. '''
+    parts = filename.replace('\\', '/').split('/')
+    name = os.path.splitext(parts[-1])[0]
+    if name in MODULES:
+        return name
+    for part in reversed(parts[:-1]):
+        if part in MODULES:
+            return part
+    return 'other'
+
+def typeCounts():
+    ''' {(module, type name): live objects}, for finding what grows without tracemalloc. '''
+    gc.collect()
+    counts = collections.Counter()
+    for obj in gc.get_objects():
+        cls = type(obj)
+        counts[(getattr(cls, '__module__', None) or '?', cls.__name__)] += 1
+    return counts
+
+def threadCounts():
+    ''' {module: live threads}, from what each thread is running. '''
+    counts = collections.Counter()
+    for thread in threading.enumerate():
+        target = getattr(thread, '_target', None) or getattr(thread, '_Thread__target', None)
+        if target is None:
+            # a subclass, with its own run()
+            target = thread.run
+        counts[getattr(target, '__module__', None) or '?'] += 1
+    return counts
+
+def sample(start, rounds):
+    gc.collect()
+    traced = None
+    if tracemalloc and tracemalloc.is_tracing():
+        traced = tracemalloc.get_traced_memory()[0] // 1024
+    return Sample(time.time() - start, rounds, bench.rss(), threading.active_count(), len(gc.get_objects()), traced)
+
+def growing(values, slack):
+    '''
+    Whether a series keeps going up. The series, after warming up, is cut in
+    thirds, and it's growing if the whole last third is above the whole first
+    third by more than slack. Noise, and things that level off, don't count.
+    Returns (growing, first third mean, last third mean).
+    '''
+    if len(values) < 6:
+        return (False, None, None)
+    third = len(values) // 3
+    first, last = values[:third], values[-third:]
+    mean_first = float(sum(first)) / len(first)
+    mean_last = float(sum(last)) / len(last)
+    return (min(last) > max(first) + slack, mean_first, mean_last)
+
+#########################################################
+# The soak
+#########################################################
+
+class Soak(object):
+    '''
+    Runs the real widgets against bench's fakes, much faster than they'd run
+    for real: every round probes the network map and printers, publishes to
+    every topic, taps a touch screen button, runs the rules, and draws and
+    renders the whole screen, the way display.py lays it out.
+    '''
+    def __init__(self, endpoints=50, topics=100, printers=2, size=(200, 50), ipv6=False):
+        random.seed(1)
+        self.network = bench.FakeNetwork(ipv6=ipv6)
+        self.network.install()
+        self.broker = mqtt.LocalBroker()
+        mqtt.NewClient = self.broker.client
+        self.octoprint = bench.FakeOctoprint()
+        self.octoprint.start()
+        alerts.engine = alerts.Engine(alerts.defaultRules({}))
+
+        config = bench.makeConfig(endpoints, topics, printers, self.octoprint.host)
+        self.netmap = pinger.NetworkMap(config[0]['network map'])
+        self.mqtt_widgets = [mqtt.MqttWidget(c['mqtt']) for c in config if 'mqtt' in c]
+        self.printer_widgets = [printer.PrinterWidget(c['octoprint']) for c in config if 'octoprint' in c]
+        self.system = sysinfo.SystemWidget({})
+        # no device, so nothing is opened. Taps go straight into its event handling.
+        buttons = [{'name': 'b%d' % i, 'command': '', 'minx': i * 100, 'maxx': i * 100 + 99, 'miny': 0, 'maxy': 99}
+                   for i in range(8)]
+        self.touch = touch.TouchWidget({'device': None, 'buttons': buttons})
+        self.widgets = [display.WidgetColumns([self.netmap, self.system], ['network map', 'system'])] + \
+                       self.mqtt_widgets + self.printer_widgets + [self.touch]
+        self.topics = ['/bench/%d/%d' % (j // 8, j) for j in range(topics)]
+        self.rounds = 0
+
+        # the same frame display.py draws, title, status and all.
+        display.clock = urwid.Text(u'')
+        display.threads = urwid.Text(u'')
+        display.hostname = urwid.Text(u'')
+        display.uptime = urwid.Text(u'')
+        display.status = urwid.Text(u'')
+        title = urwid.Columns([display.threads, display.hostname, display.uptime, display.clock])
+        body = urwid.Filler(urwid.Pile([urwid.LineBox(w) for w in self.widgets]), 'top')
+        self.top = urwid.Frame(body, title, display.status)
+        self.size = size
+
+        for wid in self.mqtt_widgets:
+            for broker in wid.brokers:
+                broker.start()
+
+    def round(self):
+        self.netmap.getData()
+        for wid in self.printer_widgets:
+            wid.getData()
+        for topic in self.topics:
+            self.broker.publish(topic, str(self.rounds))
+        self.system.sampler.sample()
+        button = self.touch.buttons[self.rounds % len(self.touch.buttons)]
+        for t, type, code, value in touch.synthesizeTaps([button], 1):
+            self.touch.eventEmitter.handle(type, code, value)
+
+        alerts.engine.evaluate()
+        self.netmap.draw()
+        for wid in self.mqtt_widgets:
+            wid.update()
+        for wid in self.printer_widgets:
+            wid.update()
+        self.system.draw()
+        display.update(self.widgets + [alerts.engine])
+        self.top.render(self.size)
+        self.rounds += 1
+
+    def settle(self, timeout=1.0):
+        ''' Let the probe threads from the last round finish, so they aren't counted as growth. Stuck ones are. '''
+        end = time.time() + timeout
+        while threading.active_count() > self.base_threads and time.time() < end:
+            time.sleep(0.01)
+
+    def run(self, duration, every, interval=0.0, warmup=0.25, report=None):
+        '''
+        Returns the samples, and two tracemalloc snapshots, or two sets of object
+        counts without it: after the warmup fraction of the run, and at the end.
+        '''
+        first_at = max(int(duration / every * warmup) + 1, 2)
+        self.base_threads = threading.active_count()
+        start = time.time()
+        samples = []
+        snapshots = []
+        counts = []
+        next_sample = start
+        while True:
+            now = time.time()
+            if now >= next_sample:
+                self.settle()
+                samples.append(sample(start, self.rounds))
+                if report:
+                    report(samples[-1])
+                next_sample = time.time() + every
+                if len(samples) == first_at:
+                    if tracemalloc:
+                        snapshots.append(tracemalloc.take_snapshot())
+                    else:
+                        counts.append(typeCounts())
+            if now - start >= duration:
+                break
+            self.round()
+            if interval:
+                time.sleep(interval)
+        self.settle()
+        if tracemalloc:
+            snapshots.append(tracemalloc.take_snapshot())
+        else:
+            counts.append(typeCounts())
+        return samples, snapshots, counts
+
+    def stop(self):
+        for wid in self.mqtt_widgets:
+            for broker in wid.brokers:
+                broker.stop()
+        self.octoprint.stop()
+
+#########################################################
+# What grew
+#########################################################
+
+def snapshotReport(first, last, limit):
+    ''' Lines about where the memory went between two tracemalloc snapshots, by module and then by line. '''
+    lines = []
+    by_module = collections.Counter()
+    blocks = collections.Counter()
+    for stat in last.compare_to(first, 'filename'):
+        module = moduleOf(stat.traceback[0].filename)
+        by_module[module] += stat.size_diff
+        blocks[module] += stat.count_diff
+    lines.append('growth by module:')
+    for module, size in by_module.most_common(limit):
+        lines.append('    %-12s %+10.1f kB %+8d blocks' % (module, size / 1024.0, blocks[module]))
+    lines.append('top lines:')
+    for stat in last.compare_to(first, 'lineno')[:limit]:
+        frame = stat.traceback[0]
+        lines.append('    %+10.1f kB %+8d  %s:%d' % (stat.size_diff / 1024.0, stat.count_diff,
+                                                    os.path.basename(frame.filename), frame.lineno))
+    return lines
+
+def countReport(first, last, limit):
+    ''' The same, from object counts by type, for when there's no tracemalloc. '''
+    lines = []
+    diff = collections.Counter(last)
+    diff.subtract(first)
+    by_module = collections.Counter()
+    for (module, name), count in diff.items():
+        if module in ('__main__', 'soak'):
+            # the samples themselves
+            continue
+        by_module[moduleOf(module.replace('.', '/'))] += count
+    lines.append('object growth by module:')
+    for module, count in by_module.most_common(limit):
+        lines.append('    %-12s %+8d' % (module, count))
+    lines.append('top types:')
+    for (module, name), count in diff.most_common(limit):
+        if count <= 0:
+            break
+        if module in ('__main__', 'soak'):
+            continue
+        lines.append('    %+8d  %s.%s' % (count, module, name))
+    return lines
+
+def verdict(samples, warmup, thread_slack, object_slack, rss_slack):
+    ''' Returns a list of what kept growing. Empty means it passed. '''
+    steady = samples[max(int(len(samples) * warmup), 1):]
+    problems = []
+    checks = [
+        ('threads', [s.threads for s in steady], thread_slack, ''),
+        ('objects', [s.objects for s in steady], object_slack, ''),
+        ('rss', [s.rss_kb for s in steady], rss_slack, ' kB'),
+    ]
+    if steady and steady[0].traced_kb is not None:
+        checks.append(('traced memory', [s.traced_kb for s in steady], rss_slack, ' kB'))
+    for name, values, slack, unit in checks:
+        grows, first, last = growing(values, slack)
+        if grows:
+            problems.append('%s keep growing: %0.0f%s to %0.0f%s' % (name, first, unit, last, unit))
+    return problems
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run housemon's widgets hard against fakes, and look for leaks")
+    parser.add_argument('--minutes', type=float, default=5.0, help="how long to run")
+    parser.add_argument('--sample', type=float, default=10.0, help="seconds between samples")
+    parser.add_argument('--interval', type=float, default=0.0, help="seconds to sleep between rounds")
+    parser.add_argument('--endpoints', type=int, default=50)
+    parser.add_argument('--topics', type=int, default=100)
+    parser.add_argument('--printers', type=int, default=2)
+    parser.add_argument('--ipv6', action='store_true', help="give every fake host a v6 address too")
+    parser.add_argument('--warmup', type=float, default=0.25, help="fraction of the samples to ignore at the start")
+    parser.add_argument('--thread-slack', type=int, default=2, help="threads the end can be above the start by")
+    parser.add_argument('--object-slack', type=int, default=2000, help="objects the end can be above the start by")
+    parser.add_argument('--rss-slack', type=int, default=2048, help="kB the end can be above the start by")
+    parser.add_argument('--top', type=int, default=10, help="allocation sites to list")
+    parser.add_argument('--json', help="also write the samples to this file")
+    args = parser.parse_args()
+
+    if tracemalloc:
+        tracemalloc.start()
+    instrument.enabled = False
+
+    soak = Soak(args.endpoints, args.topics, args.printers, ipv6=args.ipv6)
+    print('%8s %8s %9s %7s %9s %9s' % ('seconds', 'rounds', 'rss_kb', 'threads', 'objects', 'traced_kb'))
+    def report(s):
+        print('%8.0f %8d %9d %7d %9d %9s' % (s.time, s.rounds, s.rss_kb, s.threads, s.objects,
+                                             '-' if s.traced_kb is None else s.traced_kb))
+        sys.stdout.flush()
+    samples, snapshots, counts = soak.run(args.minutes * 60.0, args.sample, args.interval, args.warmup, report)
+    soak.stop()
+
+    print('')
+    print('%d rounds in %0.0f seconds, %0.1f a second' % (soak.rounds, samples[-1].time, soak.rounds / max(samples[-1].time, 1e-9)))
+    print('threads at the end by module: ' + ', '.join(['%s %d' % item for item in threadCounts().most_common()]))
+    if len(snapshots) == 2:
+        print('\n'.join(snapshotReport(snapshots[0], snapshots[1], args.top)))
+    elif len(counts) == 2:
+        print('\n'.join(countReport(counts[0], counts[1], args.top)))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump([s._asdict() for s in samples], f)
+
+    problems = verdict(samples, args.warmup, args.thread_slack, args.object_slack, args.rss_slack)
+    if problems:
+        print('FAIL: ' + '; '.join(problems))
+        sys.exit(1)
+    print('PASS: nothing kept growing')
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+import collections
+import platform
+import socket
+import threading
+import time
+import urwid
+
+import alerts
+import instrument
+
+#########################################################
+# Reading the system
+#########################################################
+
+# One look at the system. These are replaced, never changed, so the display can
+# read one without locking, and never waits on the files they came from.
+SystemState = collections.namedtuple('SystemState', [
+    'time', 'hostname', 'ip', 'cpu', 'load', 'mem_total', 'mem_available', 'temperature', 'interfaces'])
+
+# (name, rx bytes/s, tx bytes/s, rx total, tx total)
+Interface = collections.namedtuple('Interface', ['name', 'rx_rate', 'tx_rate', 'rx_bytes', 'tx_bytes'])
+
+def readFile(filename):
+    try:
+        with open(filename) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+def readCpu():
+    ''' (busy, total) jiffies, from the first line of /proc/stat. '''
+    text = readFile('/proc/stat')
+    if not text:
+        return None
+    fields = [int(n) for n in text.split('\n', 1)[0].split()[1:]]
+    # idle and iowait
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+    total = sum(fields[:8])
+    return (total - idle, total)
+
+def readLoad():
+    text = readFile('/proc/loadavg')
+    if not text:
+        return None
+    return tuple([float(n) for n in text.split()[:3]])
+
+def readMemory():
+    ''' (total, available) in bytes. '''
+    text = readFile('/proc/meminfo')
+    if not text:
+        return (None, None)
+    values = {}
+    for line in text.split('\n'):
+        parts = line.split()
+        if len(parts) >= 2:
+            values[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    available = values.get('MemAvailable')
+    if available is None and 'MemFree' in values:
+        # older kernels
+        available = values['MemFree'] + values.get('Buffers', 0) + values.get('Cached', 0)
+    return (values.get('MemTotal'), available)
+
+def readTemperature(zone='/sys/class/thermal/thermal_zone0/temp'):
+    ''' Degrees C, or None if there's no sensor. '''
+    text = readFile(zone)
+    if not text:
+        return None
+    try:
+        return int(text.strip()) / 1000.0
+    except ValueError:
+        return None
+
+def readInterfaces():
+    ''' {name: (rx bytes, tx bytes)}, from /proc/net/dev. '''
+    text = readFile('/proc/net/dev')
+    counters = {}
+    if not text:
+        return counters
+    for line in text.split('\n')[2:]:
+        if ':' not in line:
+            continue
+        name, data = line.split(':', 1)
+        fields = data.split()
+        counters[name.strip()] = (int(fields[0]), int(fields[8]))
+    return counters
+
+def localIp(hostname):
+    '''
+    The address this machine talks to the network from. Connecting a UDP socket
+    sends nothing, it only picks the route, so this doesn't wait on anybody.
+    Falls back to looking up hostname.local.
+    '''
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect(('192.0.2.1', 9))
+        return s.getsockname()[0]
+    except socket.error:
+        pass
+    finally:
+        s.close()
+    try:
+        return socket.gethostbyname(hostname + '.local')
+    except socket.error:
+        return None
+
+class Sampler(object):
+    '''
+    Looks at the system from its own thread, every interval, and publishes a
+    SystemState. Rates are worked out from the change since the last look.
+
+    The hostname is checked every time, but the ip only when the hostname
+    changes, or every ip_interval seconds.
+    '''
+    def __init__(self, interval=2.0, ip_interval=60.0, temperature_zone='/sys/class/thermal/thermal_zone0/temp'):
+        self.interval = interval
+        self.ip_interval = ip_interval
+        self.temperature_zone = temperature_zone
+        self.state = SystemState(time.time(), platform.node(), None, None, None, None, None, None, ())
+        self.ip_time = 0.0
+        self.last_cpu = None
+        self.last_interfaces = None
+        self.running = False
+        # why the last sample failed, or None.
+        self.error = None
+
+    @instrument.timed('sysinfo.sample')
+    def sample(self):
+        old = self.state
+        now = time.time()
+        dt = now - old.time
+
+        hostname = platform.node()
+        ip = old.ip
+        if hostname != old.hostname or now - self.ip_time > self.ip_interval:
+            ip = localIp(hostname)
+            self.ip_time = now
+
+        cpu = None
+        counts = readCpu()
+        if counts and self.last_cpu and counts[1] > self.last_cpu[1]:
+            cpu = float(counts[0] - self.last_cpu[0]) / (counts[1] - self.last_cpu[1])
+        self.last_cpu = counts
+
+        interfaces = []
+        counters = readInterfaces()
+        for name in sorted(counters.keys()):
+            rx, tx = counters[name]
+            rx_rate = tx_rate = None
+            if self.last_interfaces and name in self.last_interfaces and dt > 0:
+                last_rx, last_tx = self.last_interfaces[name]
+                # counters start over when an interface comes back.
+                if rx >= last_rx and tx >= last_tx:
+                    rx_rate = (rx - last_rx) / dt
+                    tx_rate = (tx - last_tx) / dt
+            interfaces.append(Interface(name, rx_rate, tx_rate, rx, tx))
+        self.last_interfaces = counters
+
+        mem_total, mem_available = readMemory()
+        self.state = SystemState(now, hostname, ip, cpu, readLoad(), mem_total, mem_available,
+                                 readTemperature(self.temperature_zone), tuple(interfaces))
+        alerts.notify('system/%s' % hostname, {'temperature': self.state.temperature, 'cpu': cpu,
+                                               'load': self.state.load and self.state.load[0], 'error': None})
+
+    def run(self):
+        while True:
+            try:
+                self.sample()
+                self.error = None
+            except Exception as e:
+                # try again next time, rather than lose the thread, but say why.
+                self.error = '%s: %s' % (e.__class__.__name__, e)
+                alerts.notify('system/%s' % self.state.hostname, {'error': self.error})
+            time.sleep(self.interval)
+
+    def start(self):
+        ''' Start sampling, if it hasn't already. '''
+        if self.running:
+            return
+        self.running = True
+        t = threading.Thread(target=self.run, args=())
+        t.setDaemon(True)
+        t.start()
+
+# The one sampler everything shares, made the first time it's asked for.
+sampler = None
+
+def shared():
+    global sampler
+    if sampler is None:
+        sampler = Sampler()
+    return sampler
+
+#########################################################
+# Display stuff
+#########################################################
+
+def rateText(rate):
+    if rate is None:
+        return '-'
+    for unit in ['B', 'kB', 'MB']:
+        if rate < 1000.0:
+            return '%0.0f%s/s' % (rate, unit)
+        rate /= 1000.0
+    return '%0.1fGB/s' % rate
+
+class SystemWidget(urwid.Pile):
+    '''
+    How this machine is doing: cpu, load, memory, temperature and network traffic.
+
+    Everything comes from the shared Sampler. Drawing only reads its last state.
+    '''
+    def __init__(self, params):
+        urwid.Pile.__init__(self, [])
+        self.reconfigure(params)
+        self.sampler = shared()
+        self.drawn = None
+
+    def reconfigure(self, params):
+        ''' Change to a new config. Returns None. '''
+        if params is None:
+            params = {}
+        # interfaces to show, all but lo if not given.
+        self.interfaces = params.get('interfaces')
+        self.max_temperature = float(params.get('max_temperature', 80.0))
+        self.drawn = None
+        return None
+
+    def getPalette(self):
+        ''' Used to populate the pallete. '''
+        return [
+            ('sys_ok', 'light green', '', '', 'light green', ''),
+            ('sys_hot', 'light red', '', '', 'light red', ''),
+        ]
+
+    def shown(self, state):
+        if self.interfaces is None:
+            return [i for i in state.interfaces if i.name != 'lo']
+        return [i for i in state.interfaces if i.name in self.interfaces]
+
+    @instrument.timed('SystemWidget.draw')
+    def draw(self):
+        ''' Returns True if anything changed. '''
+        state = self.sampler.state
+        if state.time == self.drawn:
+            return False
+        self.drawn = state.time
+
+        rows = [urwid.AttrMap(urwid.Text(u'System: %s (%s)' % (state.hostname, state.ip)), 'title')]
+        cols = []
+        if state.cpu is not None:
+            cols.append(urwid.Text(u'CPU: %0.0f%%' % (state.cpu * 100.0)))
+        if state.load:
+            cols.append(urwid.Text(u'Load: %0.2f %0.2f %0.2f' % state.load))
+        if state.mem_total and state.mem_available is not None:
+            cols.append(urwid.Text(u'Mem: %0.0f/%0.0fMB' % ((state.mem_total - state.mem_available) / 1e6, state.mem_total / 1e6)))
+        if state.temperature is not None:
+            theme = 'sys_ok'
+            if state.temperature > self.max_temperature:
+                theme = 'sys_hot'
+            cols.append(urwid.AttrMap(urwid.Text(u'Temp: %0.1fC' % state.temperature), theme))
+        rows.append(urwid.Columns(cols))
+        for interface in self.shown(state):
+            rows.append(urwid.Columns([urwid.Text(interface.name),
+                                       urwid.Text(u'rx %s' % rateText(interface.rx_rate)),
+                                       urwid.Text(u'tx %s' % rateText(interface.tx_rate))]))
+        self.contents = [(row, self.options()) for row in rows]
+        return True
+
+    def start(self, scheduler):
+        ''' Called to add the initial processes to the scheduler.'''
+        self.sampler.start()
+        scheduler.every(self.sampler.interval, self.draw, draw=True)
+
+    def getMetrics(self):
+        ''' Return (name, labels, value) samples for this machine. '''
+        state = self.sampler.state
+        labels = {'host': state.hostname}
+        samples = [
+            ('housemon_system_cpu_ratio', labels, state.cpu),
+            ('housemon_system_memory_total_bytes', labels, state.mem_total),
+            ('housemon_system_memory_available_bytes', labels, state.mem_available),
+            ('housemon_system_temperature_celsius', labels, state.temperature),
+        ]
+        if state.load:
+            samples.append(('housemon_system_load1', labels, state.load[0]))
+        for interface in state.interfaces:
+            interface_labels = dict(labels, interface=interface.name)
+            samples.append(('housemon_system_network_receive_bytes_total', interface_labels, interface.rx_bytes))
+            samples.append(('housemon_system_network_transmit_bytes_total', interface_labels, interface.tx_bytes))
+        return samples
+
+    def getState(self):
+        ''' Return (key, fields) pairs for this machine, for the web view. '''
+        state = self.sampler.state
+        fields = {'ip': state.ip, 'cpu': state.cpu, 'load': state.load and state.load[0],
+                  'temperature': state.temperature, 'ok': self.getError() is None}
+        for interface in self.shown(state):
+            fields[interface.name + '_rx'] = interface.rx_rate
+            fields[interface.name + '_tx'] = interface.tx_rate
+        return [('system/%s' % state.hostname, fields)]
+
+    def getReplay(self):
+        return []
+
+    def getError(self):
+        ''' return if there is a problem that I can detect. '''
+        if self.sampler.error:
+            return "Can't read how this machine is doing (%s)." % self.sampler.error
+        temperature = self.sampler.state.temperature
+        if temperature is not None and temperature > self.max_temperature:
+            return "This thing is running hot (%0.0fC). Maybe it needs a fan." % temperature
+        return None
@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+import marshal
+import os
+import struct
+import time
+import urwid
+
+import instrument
+import recorder
+
+#########################################################
+# Event log
+#########################################################
+
+# The log is the magic, then fixed size records, one per change of state. Each
+# record points back at the one before it for the same entity, so an entity's
+# history can be read without looking at anybody else's.
+LOG_MAGIC = b'HMTL0001'
+RECORD = struct.Struct('<dIBI') # time, entity number, state, previous record of the entity + 1 (0 for none)
+
+DOWN = 0
+UP = 1
+# not being watched: removed from the config, or housemon wasn't running.
+GONE = 2
+
+STATE_NAMES = {DOWN: 'down', UP: 'up', GONE: 'gone'}
+
+# How an entity did over a window. Times are in seconds, ratios are 0-1, and
+# anything that can't be worked out (no failures, no time known) is None.
+Stats = collections.namedtuple('Stats', ['uptime', 'up', 'down', 'unknown', 'outages', 'mtbf', 'mttr', 'longest'])
+
+class Timeline(object):
+    '''
+    Every time an entity goes up or down, on disk.
+
+    Three files, from one name:
+        name.log: the records.
+        name.keys: entity names, one a line. The line number is the entity number.
+        name.heads: the last record of every entity, so queries start at the
+            right place without reading the log. Rewritten on flush, and brought
+            up to date from the log when it's behind.
+
+    readonly is for looking at one that a running display is writing to.
+    '''
+    def __init__(self, filename, readonly=False):
+        self.filename = filename
+        self.readonly = readonly
+        self.lock = instrument.TimedLock('Timeline.lock')
+
+        self.keys = []
+        self.numbers = {}
+        if os.path.exists(filename + '.keys'):
+            with open(filename + '.keys', 'rb') as f:
+                for line in f.read().decode('utf-8').split('\n')[:-1]:
+                    self.numbers[line] = len(self.keys)
+                    self.keys.append(line)
+
+        if not readonly and (not os.path.exists(filename + '.log') or os.path.getsize(filename + '.log') < len(LOG_MAGIC)):
+            with open(filename + '.log', 'wb') as f:
+                f.write(LOG_MAGIC)
+        self.reader = open(filename + '.log', 'rb')
+        if self.reader.read(len(LOG_MAGIC)) != LOG_MAGIC:
+            raise IOError("%s.log is not a housemon timeline" % filename)
+        size = os.path.getsize(filename + '.log')
+        self.count = (size - len(LOG_MAGIC)) // RECORD.size
+
+        self.writer = self.keys_file = None
+        if not readonly:
+            self.keys_file = open(filename + '.keys', 'ab')
+            self.writer = open(filename + '.log', 'r+b')
+            # cut off a record that was half written when we went down.
+            self.writer.truncate(len(LOG_MAGIC) + self.count * RECORD.size)
+            self.writer.seek(0, os.SEEK_END)
+
+        # entity: (record number, state, time) of its latest record.
+        self.heads = {}
+        # the last time we know we were running.
+        self.alive = 0.0
+        indexed = 0
+        try:
+            with open(filename + '.heads', 'rb') as f:
+                indexed, self.alive, self.heads = marshal.load(f)
+            if indexed > self.count:
+                raise ValueError("heads are ahead of the log")
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            indexed = 0
+            self.heads = {}
+            self.alive = 0.0
+        for number in range(indexed, self.count):
+            t, entity, state, previous = self.read(number)
+            self.heads[entity] = (number, state, t)
+            self.alive = max(self.alive, t)
+
+        if readonly:
+            return
+        # whatever was up or down when we stopped, we don't know about since.
+        for entity, (number, state, t) in list(self.heads.items()):
+            if state != GONE:
+                self.append(entity, GONE, max(self.alive, t))
+        self.flush()
+
+    def read(self, number):
+        ''' (time, entity, state, previous) of one record. '''
+        self.reader.seek(len(LOG_MAGIC) + number * RECORD.size)
+        t, entity, state, previous = RECORD.unpack(self.reader.read(RECORD.size))
+        return (t, entity, state, previous - 1)
+
+    def append(self, entity, state, t):
+        head = self.heads.get(entity)
+        self.writer.write(RECORD.pack(t, entity, state, head[0] + 1 if head else 0))
+        self.heads[entity] = (self.count, state, t)
+        self.count += 1
+        self.alive = max(self.alive, t)
+
+    def record(self, key, up, t=None):
+        ''' Note that key went up (True), down (False) or away (None), if that's news. '''
+        if t is None:
+            t = recorder.now()
+        state = GONE if up is None else (UP if up else DOWN)
+        self.lock.acquire(True)
+        try:
+            entity = self.numbers.get(key)
+            if entity is None:
+                if state == GONE:
+                    return
+                entity = self.numbers[key] = len(self.keys)
+                self.keys.append(key)
+                self.keys_file.write(key.encode('utf-8') + b'\n')
+            head = self.heads.get(entity)
+            if head is None or head[1] != state:
+                # each chain has to get older going back, or reading a window stops early.
+                # The clock can step back (NTP on something without an RTC).
+                if head is not None and t < head[2]:
+                    t = head[2]
+                self.append(entity, state, t)
+        finally:
+            self.lock.release()
+
+    def state(self, key):
+        ''' (state, since) of an entity now, or None if it's never been seen. '''
+        head = self.heads.get(self.numbers.get(key))
+        if head is None:
+            return None
+        return (head[1], head[2])
+
+    def flush(self):
+        ''' Write out what's buffered, and the heads, so the next start doesn't have to read the log. '''
+        if self.readonly:
+            return
+        self.lock.acquire(True)
+        try:
+            self.writer.flush()
+            self.keys_file.flush()
+            self.alive = max(self.alive, recorder.now())
+            try:
+                with open(self.filename + '.heads.tmp', 'wb') as f:
+                    marshal.dump((self.count, self.alive, self.heads), f)
+                os.rename(self.filename + '.heads.tmp', self.filename + '.heads')
+            except (IOError, OSError):
+                # the log is enough on its own, it's just slower to open.
+                pass
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.reader.close()
+        if self.readonly:
+            return
+        for key in list(self.numbers.keys()):
+            self.record(key, None)
+        self.flush()
+        self.writer.close()
+        self.keys_file.close()
+
+    @instrument.timed('timeline.transitions')
+    def transitions(self, key, start, end):
+        '''
+        What happened to key between start and end: (state at start, [(time, state)]).
+        The state at start is GONE if nothing was known then. Only walks back
+        through this entity's records, and stops at the first one before start.
+        '''
+        self.lock.acquire(True)
+        try:
+            if self.writer:
+                self.writer.flush()
+            head = self.heads.get(self.numbers.get(key))
+            events = []
+            before = GONE
+            number = head[0] if head else -1
+            while number >= 0:
+                t, entity, state, previous = self.read(number)
+                if t < start:
+                    before = state
+                    break
+                if t <= end:
+                    events.append((t, state))
+                number = previous
+        finally:
+            self.lock.release()
+        events.reverse()
+        return (before, events)
+
+    def stats(self, key, start, end=None):
+        ''' Stats for key from start to end (now if not given). '''
+        if end is None:
+            end = recorder.now()
+        state, events = self.transitions(key, start, end)
+        totals = {UP: 0.0, DOWN: 0.0, GONE: 0.0}
+        outages = 0
+        # a window that starts in an outage has one to repair too.
+        repairs = int(state == DOWN)
+        longest = 0.0
+        down_since = start if state == DOWN else None
+        last = start
+        for t, new in events + [(end, None)]:
+            totals[state] += t - last
+            last = t
+            if new is None or new == state:
+                continue
+            if new == DOWN:
+                outages += 1
+                repairs += 1
+                down_since = t
+            elif state == DOWN:
+                longest = max(longest, t - down_since)
+            state = new
+        if state == DOWN and down_since is not None:
+            longest = max(longest, end - down_since)
+
+        up, down = totals[UP], totals[DOWN]
+        return Stats(up / (up + down) if up + down > 0 else None, up, down, totals[GONE], outages,
+                     up / outages if outages else None, down / repairs if repairs else None, longest)
+
+    def outages(self, key, start, end=None, limit=20):
+        ''' The most recent (start, end) of the outages in the window. end is None if it's still going. '''
+        if end is None:
+            end = recorder.now()
+        state, events = self.transitions(key, start, end)
+        found = []
+        since = start if state == DOWN else None
+        for t, new in events:
+            if new == DOWN and since is None:
+                since = t
+            elif new != DOWN and since is not None:
+                found.append((since, t))
+                since = None
+        if since is not None:
+            found.append((since, None))
+        return found[-limit:]
+
+#########################################################
+# Watching the widgets
+#########################################################
+
+class Tracker(object):
+    '''
+    Looks at the 'ok' of everything the widgets report through getState, and
+    records the changes. For the first settle seconds only things coming up are
+    recorded, so nothing looks down just because its first probe isn't back yet.
+    '''
+    def __init__(self, timeline, widgets, interval=2.0, settle=60.0):
+        self.timeline = timeline
+        self.widgets = widgets
+        self.interval = interval
+        self.settle = settle
+        self.started = None
+        self.seen = set()
+
+    @instrument.timed('timeline.check')
+    def check(self):
+        now = recorder.now()
+        if self.started is None:
+            self.started = now
+        settled = now - self.started >= self.settle
+
+        seen = set()
+        for wid in self.widgets:
+            for key, fields in wid.getState():
+                ok = fields.get('ok')
+                if ok is None:
+                    continue
+                seen.add(key)
+                if ok or settled:
+                    self.timeline.record(key, bool(ok), now)
+        for key in self.seen - seen:
+            # gone from the config
+            self.timeline.record(key, None, now)
+        self.seen = seen
+
+    def start(self, scheduler):
+        ''' Called to add the initial processes to the scheduler.'''
+        scheduler.every(self.interval, self.check)
+        scheduler.every(5.0, self.timeline.flush)
+
+#########################################################
+# Display stuff
+#########################################################
+
+WINDOWS = [('hour', 3600.0), ('day', 86400.0), ('week', 7 * 86400.0), ('30 days', 30 * 86400.0)]
+
+def durationText(seconds):
+    if seconds is None:
+        return '-'
+    if seconds < 60.0:
+        return '%0.0fs' % seconds
+    if seconds < 3600.0:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    if seconds < 86400.0:
+        return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+    return '%dd%02dh' % (seconds // 86400, seconds % 86400 // 3600)
+
+def uptimeText(uptime):
+    if uptime is None:
+        return '-'
+    return '%0.3f%%' % (uptime * 100.0)
+
+class View(urwid.Pile):
+    '''
+    A page with the uptime of everything, worst first, for flipping to from the
+    dashboard. up and down pick an entity, enter shows its outages, and left
+    and right change the window.
+    '''
+    def __init__(self, timeline, lines=40):
+        self.timeline = timeline
+        self.lines = lines
+        self.heading = urwid.Text(u'')
+        self.text = urwid.Text(u'')
+        urwid.Pile.__init__(self, [urwid.AttrMap(self.heading, 'title'), urwid.Divider(u'\u2500'), self.text])
+        self.visible = False
+        self.window = 1
+        self.selected = 0
+        self.entity = None
+        self.order = []
+
+    def key(self, key):
+        ''' Returns True if the key was for this page. '''
+        if key == 'up':
+            self.selected = max(self.selected - 1, 0)
+        elif key == 'down':
+            self.selected = min(self.selected + 1, max(len(self.order) - 1, 0))
+        elif key == 'left':
+            self.window = max(self.window - 1, 0)
+        elif key == 'right':
+            self.window = min(self.window + 1, len(WINDOWS) - 1)
+        elif key == 'enter' and self.order:
+            self.entity = self.order[self.selected]
+        elif key in ['backspace', 'esc']:
+            self.entity = None
+        else:
+            return False
+        self.update()
+        return True
+
+    def update(self):
+        ''' Draw task. Only does work while the page is showing. '''
+        if not self.visible:
+            return False
+        if self.entity:
+            self.drawEntity()
+        else:
+            self.drawSummary()
+        return True
+
+    def drawSummary(self):
+        name, length = WINDOWS[self.window]
+        now = recorder.now()
+        stats = [(self.timeline.stats(key, now - length, now), key) for key in self.timeline.keys]
+        # worst first, then the ones we know nothing about.
+        stats.sort(key=lambda s: (s[0].uptime is None, s[0].uptime, s[1]))
+        self.order = [key for s, key in stats]
+        self.selected = min(self.selected, max(len(self.order) - 1, 0))
+
+        self.heading.set_text(u'Uptime over the last %s (t to go back, up/down/enter to pick, left/right for the window)' % name)
+        lines = [u'  %-50s %9s %7s %9s %9s %9s' % ('', 'uptime', 'outages', 'mtbf', 'mttr', 'longest')]
+        first = max(0, min(self.selected - self.lines // 2, len(stats) - self.lines))
+        for i, (s, key) in enumerate(stats[first:first + self.lines], first):
+            marker = '>' if i == self.selected else ' '
+            lines.append(u'%s %-50s %9s %7d %9s %9s %9s' % (marker, key[-50:], uptimeText(s.uptime), s.outages,
+                                                            durationText(s.mtbf), durationText(s.mttr), durationText(s.longest)))
+        self.text.set_text(u'\n'.join(lines))
+
+    def drawEntity(self):
+        now = recorder.now()
+        self.heading.set_text(u'%s (backspace for everything, t to go back)' % self.entity)
+        lines = [u'%-10s %9s %7s %9s %9s %9s %9s' % ('', 'uptime', 'outages', 'mtbf', 'mttr', 'longest', 'unknown')]
+        for name, length in WINDOWS:
+            s = self.timeline.stats(self.entity, now - length, now)
+            lines.append(u'%-10s %9s %7d %9s %9s %9s %9s' % (name, uptimeText(s.uptime), s.outages, durationText(s.mtbf),
+                                                             durationText(s.mttr), durationText(s.longest),
+                                                             durationText(s.unknown)))
+        current = self.timeline.state(self.entity)
+        if current:
+            lines.append(u'')
+            lines.append(u'%s since %s' % (STATE_NAMES[current[0]], time.ctime(current[1])))
+        lines.append(u'')
+        lines.append(u'Outages in the last %s:' % WINDOWS[self.window][0])
+        for start, end in reversed(self.timeline.outages(self.entity, now - WINDOWS[self.window][1], now)):
+            if end is None:
+                lines.append(u'  %s  still down, %s so far' % (time.ctime(start), durationText(now - start)))
+            else:
+                lines.append(u'  %s  %s' % (time.ctime(start), durationText(end - start)))
+        self.text.set_text(u'\n'.join(lines))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Uptime from a housemon timeline")
+    parser.add_argument('filename', help="the timeline, without the .log")
+    parser.add_argument('--days', type=float, default=30.0, help="how far back to look")
+    parser.add_argument('--key', default='', help="only entities starting with this")
+    args = parser.parse_args()
+
+    timeline = Timeline(args.filename, readonly=True)
+    now = time.time()
+    start = time.time()
+    rows = [(timeline.stats(key, now - args.days * 86400.0, now), key) for key in timeline.keys if key.startswith(args.key)]
+    elapsed = time.time() - start
+    rows.sort(key=lambda s: (s[0].uptime is None, s[0].uptime, s[1]))
+    print('%-50s %9s %7s %9s %9s %9s' % ('last %g days' % args.days, 'uptime', 'outages', 'mtbf', 'mttr', 'longest'))
+    for s, key in rows:
+        print('%-50s %9s %7d %9s %9s %9s' % (key[-50:], uptimeText(s.uptime), s.outages, durationText(s.mtbf),
+                                             durationText(s.mttr), durationText(s.longest)))
+    print('%d records, %d entities, worked out in %0.1fms' % (timeline.count, len(timeline.keys), elapsed * 1000.0))
@@ -1,12 +1,159 @@
 #!/usr/bin/python
 
-import evdev
-
+import bisect
+import errno
+import fcntl
+import struct
 import threading
+import time
 import urwid
 import os
 import sys
 
+import instrument
+
+# Linux input event codes (linux/input-event-codes.h). These are kept here so
+# recordings can be replayed on machines without evdev.
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_ABS = 0x03
+SYN_REPORT = 0
+SYN_DROPPED = 3
+BTN_TOUCH = 0x14a
+ABS_X = 0x00
+ABS_Y = 0x01
+
+#########################################################
+# Input sources
+#########################################################
+
+# A recording is a magic header, then one fixed size record per event:
+# timestamp (double), type, code (unsigned short) and value (int).
+RECORD_MAGIC = b'HMTOUCH1'
+RECORD = struct.Struct('<dHHi')
+
+def readRecording(filename):
+    ''' Yield the (timestamp, type, code, value) events in a recording. '''
+    with open(filename, 'rb') as f:
+        if f.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+            raise ValueError("%s is not a touch recording" % filename)
+        while True:
+            data = f.read(RECORD.size)
+            if len(data) < RECORD.size:
+                return
+            yield RECORD.unpack(data)
+
+class DeviceSource(object):
+    ''' Reads events from a real evdev input device. '''
+    def __init__(self, devicename):
+        self.devicename = devicename
+        self.device = None
+
+    def open(self):
+        import evdev
+        self.device = evdev.InputDevice(self.devicename)
+
+    def fileno(self):
+        return self.device.fd
+
+    def read(self):
+        ''' Return the waiting events. Raises IOError(EAGAIN) if there are none. '''
+        return [(e.timestamp(), e.type, e.code, e.value) for e in self.device.read()]
+
+    def close(self):
+        self.device.close()
+        self.device = None
+
+class RecordingSource(object):
+    ''' Passes the events of another source through, and writes them to a file. '''
+    def __init__(self, source, filename):
+        self.source = source
+        self.filename = filename
+        self.file = None
+
+    def open(self):
+        self.source.open()
+        self.file = open(self.filename, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(RECORD_MAGIC)
+
+    def fileno(self):
+        return self.source.fileno()
+
+    def read(self):
+        events = self.source.read()
+        self.file.write(b''.join([RECORD.pack(*event) for event in events]))
+        self.file.flush()
+        return events
+
+    def close(self):
+        self.source.close()
+        self.file.close()
+        self.file = None
+
+class ReplaySource(object):
+    '''
+    Plays a recording back through a pipe, so it looks like a device to the main loop.
+
+    :speed: 1.0 plays at the recorded rate, 2.0 twice as fast, and 0 as fast as possible.
+    '''
+    def __init__(self, filename, speed=1.0):
+        self.filename = filename
+        self.speed = speed
+        self.rfd = None
+        self.buffer = b''
+
+    def open(self):
+        self.rfd, wfd = os.pipe()
+        flags = fcntl.fcntl(self.rfd, fcntl.F_GETFL)
+        fcntl.fcntl(self.rfd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        def do(wfd):
+            start = None
+            for event in readRecording(self.filename):
+                if self.speed:
+                    if start is None:
+                        start = (time.time(), event[0])
+                    delay = start[0] + (event[0] - start[1]) / self.speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                os.write(wfd, RECORD.pack(*event))
+            os.close(wfd)
+
+        t = threading.Thread(target=do, args=(wfd,))
+        t.setDaemon(True)
+        t.start()
+
+    def fileno(self):
+        return self.rfd
+
+    def read(self):
+        ''' Return the waiting events. Raises EOFError when the recording is done. '''
+        data = os.read(self.rfd, RECORD.size * 256)
+        if not data:
+            raise EOFError()
+        data = self.buffer + data
+        end = len(data) - len(data) % RECORD.size
+        self.buffer = data[end:]
+        return [RECORD.unpack_from(data, offset) for offset in range(0, end, RECORD.size)]
+
+    def close(self):
+        os.close(self.rfd)
+        self.rfd = None
+
+def createSource(params):
+    ''' Build the input source described by the touch config. '''
+    if 'replay' in params.keys():
+        speed = 1.0
+        if 'replay_speed' in params.keys():
+            speed = float(params['replay_speed'])
+        return ReplaySource(params['replay'], speed)
+
+    source = DeviceSource(params['device'])
+    if 'record' in params.keys():
+        source = RecordingSource(source, params['record'])
+    return source
+
 #########################################################
 # Display stuff
 #########################################################
@@ -22,9 +169,20 @@ class Button(object):
         self.miny = params['miny']
         self.maxy = params['maxy']
 
+        # How long the button has to be held before it fires.
+        self.hold = 3.0
+        if 'hold' in params.keys():
+            self.hold = float(params['hold'])
+
         self.isPushed = False
         self.pushTimer = None
 
+        # Called from the timer thread after firing, so the main loop can react.
+        self.wake = None
+
+        self.label = urwid.AttrMap(urwid.Text(self.name, align="center"), 'idle')
+        self.widget = urwid.LineBox(self.label)
+
     def inBounds(self, x, y):
         return x >= self.minx and \
                x <= self.maxx and \
@@ -39,61 +197,92 @@ class Button(object):
         if 'reboot' in self.command or 'poweroff' in self.command:
             os.system(self.command)
             sys.exit(2)
+        if self.wake is not None:
+            self.wake()
 
     def pushed(self):
         self.isPushed = True
-        self.pushTimer = threading.Timer(3.0, self.fire)
-        self.pushTimer.start()
+        if self.pushTimer is None:
+            self.pushTimer = threading.Timer(self.hold, self.fire)
+            self.pushTimer.start()
+        self.refresh()
 
     def released(self):
         self.isPushed = False
         if self.pushTimer is not None:
             self.pushTimer.cancel()
             self.pushTimer = None
+        self.refresh()
 
-    def draw(self):
+    def refresh(self):
+        ''' Recolor the button in place. Only this button gets redrawn. '''
         if self.isPushed:
             color = 'pushed'
         else:
             color = 'idle'
+        self.label.set_attr_map({None: color})
 
-        button = urwid.LineBox(urwid.Text((color, self.name), align="center"))
-        return button
+    def draw(self):
+        return self.widget
 
 class DebugTouchWidget(object):
     def __init__(self):
         self.x = 0
         self.y = 0
         self.pushed = False
-        self.debug_lock = threading.Lock()
 
-    def setx(self, x):
-        self.debug_lock.acquire(True)
-        self.x = x
-        self.debug_lock.release()
+        self.xText = urwid.Text((u"idle", u"X: 0"))
+        self.yText = urwid.Text((u"idle", u"Y: 0"))
+        self.widget = urwid.Columns([self.xText, self.yText])
 
-    def sety(self, y):
-        self.debug_lock.acquire(True)
+    def set(self, x, y, pushed):
+        self.x = x
         self.y = y
-        self.debug_lock.release()
-
-    def setpushed(self, pushed):
-        self.debug_lock.acquire(True)
         self.pushed = pushed
-        self.debug_lock.release()
 
-    def draw(self):
-        ''' Return the widget that describes this machine, and all of its messages. '''
-        self.debug_lock.acquire(True)
-        pushed = 'idle'
+        color = 'idle'
         if self.pushed:
-            pushed = 'pushed'
+            color = 'pushed'
+        self.xText.set_text((color, u"X: %d" % self.x))
+        self.yText.set_text((color, u"Y: %d" % self.y))
 
-        widget = urwid.Columns([urwid.Text((pushed, u"X: %d" % self.x)), urwid.Text((pushed, u"Y: %d" % self.y))])
-        self.debug_lock.release()
-        return widget
+    def draw(self):
+        ''' Return the widget that shows the last touch. '''
+        return self.widget
+
+class ButtonIndex(object):
+    '''
+    Spatial index of the buttons, so a touch only checks the buttons underneath it.
+
+    The touch area is cut into a grid at every button edge, and each grid cell
+    remembers which buttons cover it. Finding the cell for a touch is two bisects.
+    '''
+    def __init__(self, buttons):
+        self.xs = sorted(set([b.minx for b in buttons] + [b.maxx + 1 for b in buttons]))
+        self.ys = sorted(set([b.miny for b in buttons] + [b.maxy + 1 for b in buttons]))
+        self.cells = {}
+
+        for button in buttons:
+            for i in range(bisect.bisect_left(self.xs, button.minx), bisect.bisect_left(self.xs, button.maxx + 1)):
+                for j in range(bisect.bisect_left(self.ys, button.miny), bisect.bisect_left(self.ys, button.maxy + 1)):
+                    self.cells.setdefault((i, j), []).append(button)
+
+    def lookup(self, x, y):
+        ''' Return the buttons that contain x, y. '''
+        i = bisect.bisect_right(self.xs, x) - 1
+        j = bisect.bisect_right(self.ys, y) - 1
+        if i < 0 or j < 0:
+            return []
+        return self.cells.get((i, j), [])
 
 class EventEmitter(object):
+    '''
+    Groups the raw evdev events into frames.
+
+    The kernel sends X, Y and the touch state as separate events, and ends each
+    frame with a SYN_REPORT. Nothing is emitted until the frame is complete, so the
+    callback never sees a half updated coordinate, and gets one touch per frame.
+    '''
     def __init__(self, callback):
         self.callback = callback
         self.reset()
@@ -102,6 +291,7 @@ class EventEmitter(object):
         self.x = None
         self.y = None
         self.isPushed = None
+        self.changed = False
 
     def checkAndEmit(self):
         if self.x is not None and self.y is not None and self.isPushed is not None:
@@ -112,35 +302,105 @@ class EventEmitter(object):
 
     def setX(self, x):
         self.x = x
-        self.checkAndEmit()
+        self.changed = True
 
     def setY(self, y):
         self.y = y
-        self.checkAndEmit()
+        self.changed = True
 
     def push(self, pushed):
         self.isPushed = pushed
-        self.checkAndEmit()
+        self.changed = True
+
+    def sync(self):
+        ''' End of a frame. Emit the touch, if anything changed. '''
+        if self.changed:
+            self.changed = False
+            self.checkAndEmit()
+
+    def dropped(self):
+        ''' The kernel dropped events, so the current frame can't be trusted. '''
+        self.reset()
+
+    def handle(self, type, code, value):
+        ''' Feed a single evdev event in. '''
+        if type == EV_KEY:
+            if code == BTN_TOUCH:
+                # Touch or release of touch screen
+                self.push(value)
+        elif type == EV_ABS:
+            if code == ABS_X:
+                # X location
+                self.setX(value)
+            elif code == ABS_Y:
+                # Y location
+                self.setY(value)
+        elif type == EV_SYN:
+            if code == SYN_REPORT:
+                self.sync()
+            elif code == SYN_DROPPED:
+                self.dropped()
 
 class TouchWidget(urwid.Pile):
-    ''' Class used to draw the data from the Printer. '''
+    '''
+    Class used to draw the touch screen buttons.
+
+    The input device is watched by the main loop, so nothing runs until the screen
+    is touched, and then only the buttons that changed get redrawn.
+    '''
     def __init__(self, params):
         urwid.Pile.__init__(self, [])
 
-        self.devicename = params['device']
-        self.device = None
+        self.params = params
+        self.devicename = params.get('device', params.get('replay'))
+        self.source = createSource(params)
         self.connected = False
+        # what the main loop gave back for the device, to stop watching it with.
+        self.watch_handle = None
+        self.loop = None
+        self.scheduler = None
+        self.wakeup_fd = None
 
         self.debug = False
         if 'debug' in params.keys():
             self.debug = params['debug']
 
         self.debugWidget = DebugTouchWidget()
+        self.eventEmitter = EventEmitter(self.onTouch)
+        self.titleText = urwid.Text('Controls')
+        self.buttons = []
+        self.setButtons(params['buttons'])
 
+    def setButtons(self, buttons):
+        for button in self.buttons:
+            if button.pushTimer:
+                button.pushTimer.cancel()
         self.buttons = []
-        for button in params['buttons']:
+        for button in buttons:
             self.buttons.append(Button(button))
+            if self.wakeup_fd is not None:
+                self.buttons[-1].wake = self.wake
+        self.buttonIndex = ButtonIndex(self.buttons)
 
+        rows = [urwid.AttrMap(self.titleText, 'title')]
+        rows.append(urwid.Columns([button.draw() for button in self.buttons]))
+        if self.debug:
+            rows.append(self.debugWidget.draw())
+        self.contents = [(row, self.options()) for row in rows]
+
+    def reconfigure(self, params):
+        '''
+        Change the buttons to a new config. The input device is kept open.
+        Returns None, or what can't be changed without a restart.
+        '''
+        source_keys = ['device', 'replay', 'replay_speed', 'record']
+        self.debug = params.get('debug', False)
+        self.setButtons(params['buttons'])
+        changed = [key for key in source_keys if params.get(key) != self.params.get(key)]
+        self.params = params
+        if changed:
+            return "The touch screen's %s can't be changed without a restart." % changed[0]
+        return None
 
     def getPalette(self):
         ''' Used to populate the pallete. '''
@@ -149,70 +409,258 @@ class TouchWidget(urwid.Pile):
             ('pushed', 'light red', '', '', 'light red', ''),
         ]
 
-    def update(self, loop, data):
-        if quit:
-            raise urwid.ExitMainLoop()
-        rows = []
-
+    def updateTitle(self):
+        if not self.debug:
+            return
         connected = "Disconnected"
         if self.connected:
             connected = "Connected"
-        if self.debug:
-            rows.append((urwid.AttrMap(urwid.Text('Controls(%s): %s' % (self.devicename, connected)), 'title'), self.options()))
-        else:
-            rows.append((urwid.AttrMap(urwid.Text('Controls'), 'title'), self.options()))
-
-        cols = []
-        for button in self.buttons:
-            cols.append(button.draw())
-        rows.append((urwid.Columns(cols), self.options()))
-
-        if self.debug:
-            rows.append((self.debugWidget.draw(), self.options()))
-
-        self.contents = rows
-        loop.set_alarm_in(0.1, self.update)
+        self.titleText.set_text('Controls(%s): %s' % (self.devicename, connected))
 
+    @instrument.timed('TouchWidget.onTouch')
     def onTouch(self, keys):
+        if self.scheduler is not None:
+            self.scheduler.invalidate()
         for key in keys:
             event, pushed, x, y = key
-            for button in self.buttons:
-                if button.inBounds(x, y):
-                    if pushed:
-                        button.pushed()
-                    else:
-                        button.released()
-
-    def start(self, loop):
+            if self.debug:
+                self.debugWidget.set(x, y, pushed)
+            for button in self.buttonIndex.lookup(x, y):
+                if pushed:
+                    button.pushed()
+                else:
+                    button.released()
+
+    @instrument.timed('TouchWidget.onReadable')
+    def onReadable(self):
+        ''' Called by the main loop when the input device has events waiting. '''
+        try:
+            for timestamp, type, code, value in self.source.read():
+                self.eventEmitter.handle(type, code, value)
+        except EOFError:
+            # The end of a replay.
+            self.disconnect()
+        except (IOError, OSError) as e:
+            if e.errno == errno.EAGAIN:
+                return
+            # The device went away, try again in a bit.
+            self.disconnect()
+            self.loop.set_alarm_in(5.0, self.connect)
+
+    def onWakeup(self, data):
+        ''' Called by the main loop when a button fired in the timer thread. '''
+        if quit:
+            raise urwid.ExitMainLoop()
+        return True
+
+    def wake(self):
+        os.write(self.wakeup_fd, b'!')
+
+    def connect(self, loop=None, data=None):
+        try:
+            self.source.open()
+        except (IOError, OSError):
+            self.loop.set_alarm_in(5.0, self.connect)
+            return
+        self.watch_handle = self.loop.watch_file(self.source.fileno(), self.onReadable)
+        self.connected = True
+        self.updateTitle()
+        self.scheduler.invalidate()
+
+    def disconnect(self):
+        if self.watch_handle is not None:
+            self.loop.remove_watch_file(self.watch_handle)
+            self.watch_handle = None
+        try:
+            self.source.close()
+        except (IOError, OSError):
+            pass
+        self.connected = False
+        self.eventEmitter.reset()
+        self.updateTitle()
+        self.scheduler.invalidate()
+
+    def start(self, scheduler):
         ''' Called to add the initial processes to the loop.'''
+        self.scheduler = scheduler
+        self.loop = scheduler.loop
+        self.wakeup_fd = self.loop.watch_pipe(self.onWakeup)
+        for button in self.buttons:
+            button.wake = self.wake
+        self.updateTitle()
+        self.connect()
 
-        self.eventEmitter = EventEmitter(self.onTouch)
+    def getMetrics(self):
+        return []
 
-        def do():
-            self.connected = True
-            self.device = evdev.InputDevice(self.devicename)
-            for event in self.device.read_loop():
-                if event.type == evdev.ecodes.EV_KEY:
-                    if event.code == evdev.ecodes.BTN_TOUCH:
-                        # Touch or release of touch screen
-                        self.debugWidget.setpushed(event.value)
-                        self.eventEmitter.push(event.value)
-                if event.type == evdev.ecodes.EV_ABS:
-                    if event.code == evdev.ecodes.ABS_X:
-                        # X location
-                        self.debugWidget.setx(event.value)
-                        self.eventEmitter.setX(event.value)
-                    elif event.code == evdev.ecodes.ABS_Y:
-                        # Y location
-                        self.debugWidget.sety(event.value)
-                        self.eventEmitter.setY(event.value)
-
-        t = threading.Thread(target=do, args=())
-        t.setDaemon(True)
-        t.start()
-        self.update(loop, None)
+    def getState(self):
+        return []
+
+    def getReplay(self):
+        return []
 
     def getError(self):
         ''' return if there is a problem that I can detect. '''
         return None
 
+#########################################################
+# Record and benchmark
+#########################################################
+
+def synthesizeTaps(buttons, taps, moves=3):
+    ''' Make the events for a tap in the middle of each button, over and over. '''
+    t = 0.0
+    for i in range(taps):
+        button = buttons[i % len(buttons)]
+        x = (button.minx + button.maxx) // 2
+        y = (button.miny + button.maxy) // 2
+        for dx in range(moves):
+            t += 0.01
+            yield (t, EV_ABS, ABS_X, x + dx)
+            yield (t, EV_ABS, ABS_Y, y)
+            if dx == 0:
+                yield (t, EV_KEY, BTN_TOUCH, 1)
+            yield (t, EV_SYN, SYN_REPORT, 0)
+        t += 0.01
+        yield (t, EV_KEY, BTN_TOUCH, 0)
+        yield (t, EV_SYN, SYN_REPORT, 0)
+
+def record(devicename, filename):
+    ''' Record a device until Ctrl-C. '''
+    import select
+    source = RecordingSource(DeviceSource(devicename), filename)
+    source.open()
+    count = 0
+    try:
+        while True:
+            select.select([source.fileno()], [], [])
+            try:
+                count += len(source.read())
+            except (IOError, OSError) as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+    except KeyboardInterrupt:
+        pass
+    source.close()
+    print("Recorded %d events to %s" % (count, filename))
+
+def benchmark(params, events, fires=20):
+    '''
+    Push events through the same EventEmitter and onTouch path the widget uses,
+    as fast as possible, and time it. Then hold a few buttons down until they fire,
+    to time the fire timers.
+
+    Buttons are neutered (no command), so nothing actually gets rebooted.
+    '''
+    widget = TouchWidget(params)
+
+    pressed = {}
+    pushLatency = []
+    fireLatency = []
+    frameStart = [0.0]
+
+    for button in widget.buttons:
+        button.command = ''
+
+        def pushed(button=button, pushed=button.pushed):
+            if button.pushTimer is None:
+                pressed[button] = time.time()
+                pushLatency.append(pressed[button] - frameStart[0])
+            pushed()
+        button.pushed = pushed
+
+        def wake(button=button):
+            fireLatency.append(time.time() - pressed[button] - button.hold)
+        button.wake = wake
+
+    def feed(type, code, value):
+        if type == EV_SYN:
+            frameStart[0] = time.time()
+        widget.eventEmitter.handle(type, code, value)
+
+    count = 0
+    start = time.time()
+    for timestamp, type, code, value in events:
+        feed(type, code, value)
+        count += 1
+    elapsed = time.time() - start
+    for button in widget.buttons:
+        button.released()
+    del fireLatency[:]
+
+    for i in range(fires):
+        button = widget.buttons[i % len(widget.buttons)]
+        for type, code, value in [(EV_ABS, ABS_X, button.minx), (EV_ABS, ABS_Y, button.miny),
+                                  (EV_KEY, BTN_TOUCH, 1), (EV_SYN, SYN_REPORT, 0)]:
+            feed(type, code, value)
+        time.sleep(button.hold * 1.5)
+        for type, code, value in [(EV_KEY, BTN_TOUCH, 0), (EV_SYN, SYN_REPORT, 0)]:
+            feed(type, code, value)
+
+    def ms(values):
+        if not values:
+            return "n/a"
+        return "avg %0.3fms p99 %0.3fms max %0.3fms" % (
+            1000.0 * sum(values) / len(values),
+            1000.0 * instrument.percentile(values, 0.99),
+            1000.0 * max(values))
+
+    print("%d events in %0.3fs: %0.0f events/sec" % (count, elapsed, count / max(elapsed, 1e-9)))
+    print("press -> pushed: %s (%d presses)" % (ms(pushLatency), len(pushLatency)))
+    print("fire after hold: %s (%d fires)" % (ms(fireLatency), len(fireLatency)))
+
+def findTouch(config):
+    ''' The params of the first touch widget in a config, looking inside columns too, or None. '''
+    for wid in config:
+        type = list(wid.keys())[0]
+        if type == 'touch':
+            return dict(wid['touch'])
+        if type == 'columns':
+            params = findTouch(wid['columns'])
+            if params is not None:
+                return params
+    return None
+
+if __name__ == '__main__':
+    import argparse
+    import yaml
+
+    parser = argparse.ArgumentParser(description="Record touch input, or benchmark the touch handling.")
+    sub = parser.add_subparsers(dest='command')
+    rec = sub.add_parser('record', help="record a device to a file")
+    rec.add_argument('device')
+    rec.add_argument('filename')
+    bench = sub.add_parser('bench', help="replay a recording (or synthetic taps) as fast as possible")
+    bench.add_argument('--config', default='config.yaml', help="config with a touch widget, for the buttons")
+    bench.add_argument('--recording', help="recording to replay, instead of synthetic taps")
+    bench.add_argument('--taps', type=int, default=10000, help="number of synthetic taps")
+    bench.add_argument('--buttons', type=int, default=64, help="number of synthetic buttons, when there is no config")
+    bench.add_argument('--hold', type=float, default=0.05, help="hold time for the buttons")
+    bench.add_argument('--fires', type=int, default=20, help="number of held presses to time")
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.device, args.filename)
+        sys.exit(0)
+
+    params = None
+    if os.path.isfile(args.config):
+        with open(args.config, 'r') as config_file:
+            params = findTouch(yaml.load(config_file))
+    if params is None:
+        # a grid of square buttons
+        side = int(args.buttons ** 0.5) or 1
+        params = {'device': None, 'buttons': []}
+        for i in range(args.buttons):
+            x = (i % side) * 100
+            y = (i // side) * 100
+            params['buttons'].append({'name': 'b%d' % i, 'command': '',
+                'minx': x, 'maxx': x + 99, 'miny': y, 'maxy': y + 99})
+    for button in params['buttons']:
+        button['hold'] = args.hold
+
+    if args.recording:
+        events = list(readRecording(args.recording))
+    else:
+        events = list(synthesizeTaps([Button(b) for b in params['buttons']], args.taps))
+    benchmark(params, events, args.fires)
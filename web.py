@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+import json
+import threading
+
+import instrument
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    import Queue as queue
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    import queue
+
+#########################################################
+# Shared state
+#########################################################
+
+# Sent to a viewer that fell too far behind, so it gets a fresh snapshot.
+RESYNC = object()
+
+def flatten(entities):
+    ''' Turn (key, fields) pairs into one {"key|field": value} dict. '''
+    state = {}
+    for key, fields in entities:
+        for field, value in fields.items():
+            state['%s|%s' % (key, field)] = value
+    return state
+
+def encodeEvent(event, version, data):
+    ''' Encode one Server-Sent Event. '''
+    return ('id: %d\nevent: %s\ndata: %s\n\n' % (version, event, json.dumps(data, sort_keys=True))).encode('utf-8')
+
+class Hub(object):
+    '''
+    Keeps the last state of the widgets, and fans changes out to the viewers.
+
+    The scheduler calls refresh, which diffs the widget state against the last
+    one. Only the fields that changed are encoded, once, and the same bytes are
+    queued for every viewer. A viewer that connects gets the whole state first.
+    '''
+    def __init__(self, widgets, backlog=64):
+        self.widgets = widgets
+        self.backlog = backlog
+        self.state = {}
+        self.version = 0
+        self.snapshot = None
+        self.clients = []
+        self.lock = instrument.TimedLock('Hub.lock')
+
+    def errors(self):
+        errors = []
+        for wid in self.widgets:
+            error = wid.getError()
+            if error:
+                errors.append(error)
+        return errors
+
+    def collect(self):
+        entities = [('status', {'errors': self.errors()})]
+        for wid in self.widgets:
+            entities += wid.getState()
+        return flatten(entities)
+
+    @instrument.timed('web.refresh')
+    def refresh(self):
+        ''' Look for changes, and send them to everyone. '''
+        state = self.collect()
+        changed = {}
+        for key, value in state.items():
+            if key not in self.state or self.state[key] != value:
+                changed[key] = value
+        removed = [key for key in self.state.keys() if key not in state]
+        if not changed and not removed:
+            return
+
+        self.lock.acquire(True)
+        self.state = state
+        self.version += 1
+        self.snapshot = None
+        delta = encodeEvent('delta', self.version, {'set': changed, 'del': removed})
+        for client in self.clients:
+            self.send(client, delta)
+        self.lock.release()
+
+    def send(self, client, data):
+        try:
+            client.put_nowait(data)
+        except queue.Full:
+            # too slow to keep up, throw its backlog away and start it over.
+            while not client.empty():
+                try:
+                    client.get_nowait()
+                except queue.Empty:
+                    break
+            client.put_nowait(RESYNC)
+
+    def getSnapshot(self):
+        ''' The whole state as an event. Call with the lock held. '''
+        if self.snapshot is None:
+            self.snapshot = encodeEvent('snapshot', self.version, self.state)
+        return self.snapshot
+
+    def subscribe(self):
+        ''' Returns the snapshot, and a queue that the changes after it will show up in. '''
+        client = queue.Queue(self.backlog)
+        self.lock.acquire(True)
+        snapshot = self.getSnapshot()
+        self.clients.append(client)
+        self.lock.release()
+        return snapshot, client
+
+    def resubscribe(self, client):
+        ''' A snapshot for a client that fell behind. '''
+        self.lock.acquire(True)
+        snapshot = self.getSnapshot()
+        self.lock.release()
+        return snapshot
+
+    def unsubscribe(self, client):
+        self.lock.acquire(True)
+        if client in self.clients:
+            self.clients.remove(client)
+        self.lock.release()
+
+#########################################################
+# HTTP
+#########################################################
+
+PAGE = u'''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>Evil House Monitor</title>
+<style>
+body { background: #000; color: #ccc; font-family: monospace; margin: 0.5em; }
+h1 { color: #8af; font-size: 1.2em; }
+#status { color: #f66; }
+#status.good { color: #6f6; }
+table { border-collapse: collapse; width: 100%; }
+td { padding: 0.1em 0.6em; border-bottom: 1px solid #222; vertical-align: top; }
+tr.ok td:first-child { color: #6f6; }
+tr.bad td:first-child { color: #f66; }
+.field { margin-right: 1.5em; }
+.field b { color: #888; font-weight: normal; }
+</style>
+</head>
+<body>
+<h1>Evil House Monitor</h1>
+<div id="status">Connecting...</div>
+<table id="entities"></table>
+<script>
+var state = {};
+var rows = {};
+
+function entityOf(key) { return key.slice(0, key.lastIndexOf('|')); }
+
+function draw(entity) {
+    var row = rows[entity];
+    if (!row) {
+        row = document.createElement('tr');
+        row.appendChild(document.createElement('td')).textContent = entity;
+        row.appendChild(document.createElement('td'));
+        rows[entity] = row;
+        var keys = Object.keys(rows).sort();
+        var table = document.getElementById('entities');
+        table.insertBefore(row, rows[keys[keys.indexOf(entity) + 1]] || null);
+    }
+    var fields = [];
+    var ok = null;
+    for (var key in state) {
+        if (entityOf(key) != entity) continue;
+        var field = key.slice(entity.length + 1);
+        if (field == 'ok') { ok = state[key]; continue; }
+        fields.push('<span class="field"><b>' + field + ':</b> ' + String(state[key]).replace(/</g, '&lt;') + '</span>');
+    }
+    if (fields.length == 0 && ok === null) {
+        row.parentNode.removeChild(row);
+        delete rows[entity];
+        return;
+    }
+    row.className = ok === null ? '' : (ok ? 'ok' : 'bad');
+    row.lastChild.innerHTML = fields.sort().join('');
+}
+
+function drawStatus() {
+    var errors = state['status|errors'] || [];
+    var status = document.getElementById('status');
+    status.className = errors.length ? '' : 'good';
+    status.textContent = errors.length ? errors.join(' / ') : 'I think things are OK, but I have no brain, so use yours.';
+}
+
+function apply(set, del) {
+    var touched = {};
+    for (var key in set) { state[key] = set[key]; touched[entityOf(key)] = true; }
+    for (var i = 0; i < del.length; i++) { delete state[del[i]]; touched[entityOf(del[i])] = true; }
+    for (var entity in touched) {
+        if (entity != 'status') draw(entity);
+    }
+    drawStatus();
+}
+
+var source = new EventSource('events');
+source.addEventListener('snapshot', function(e) {
+    var old = Object.keys(state);
+    state = {};
+    apply(JSON.parse(e.data), old);
+});
+source.addEventListener('delta', function(e) {
+    var delta = JSON.parse(e.data);
+    apply(delta.set, delta.del);
+});
+source.onerror = function() {
+    document.getElementById('status').textContent = 'Lost the connection, retrying...';
+};
+</script>
+</body>
+</html>
+'''.encode('utf-8')
+
+class WebServer(object):
+    '''
+    Serves a live page of the house, to as many viewers as want it.
+
+    Nothing is probed for a viewer. They all share the one Hub, and get the changes
+    streamed to them as Server-Sent Events.
+    '''
+    def __init__(self, widgets, port, address=''):
+        self.hub = Hub(widgets)
+        hub = self.hub
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/':
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/html; charset=utf-8')
+                    self.send_header('Content-Length', str(len(PAGE)))
+                    self.end_headers()
+                    self.wfile.write(PAGE)
+                elif path == '/events':
+                    self.stream()
+                else:
+                    self.send_error(404)
+
+            def stream(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+
+                snapshot, client = hub.subscribe()
+                try:
+                    self.wfile.write(snapshot)
+                    self.wfile.flush()
+                    while True:
+                        try:
+                            data = client.get(True, 15.0)
+                        except queue.Empty:
+                            # keep the connection (and any proxies) awake
+                            data = b': keepalive\n\n'
+                        if data is RESYNC:
+                            data = hub.resubscribe(client)
+                        self.wfile.write(data)
+                        self.wfile.flush()
+                except (IOError, OSError):
+                    # the viewer went away
+                    pass
+                finally:
+                    hub.unsubscribe(client)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server((address, port), Handler)
+
+    def start(self, scheduler, interval=1.0):
+        ''' Called to add the initial processes to the scheduler.'''
+        scheduler.every(interval, self.hub.refresh)
+        t = threading.Thread(target=self.server.serve_forever, args=())
+        t.setDaemon(True)
+        t.start()